@@ -1,10 +1,259 @@
-import streamlit.web.cli as stcli
+import argparse
+import json
+import os
 import sys
+import time
+from typing import List, Optional
 
 
-def main() -> None:
+def _run_streamlit(args: argparse.Namespace) -> int:
+    import streamlit.web.cli as stcli
+
     sys.argv = ["streamlit", "run", "streamlit_app.py"]
-    sys.exit(stcli.main())
+    return stcli.main()
+
+
+def _migrate(args: argparse.Namespace) -> int:
+    from app import db
+
+    before = db.get_schema_version()
+    applied = db.migrate()
+    if applied:
+        print(f"[MyFanCRM] Schéma migré v{before} -> v{applied[-1]} ({db._DB_PATH})")
+    else:
+        print(f"[MyFanCRM] Schéma déjà à jour (v{before}, {db._DB_PATH})")
+    return 0
+
+
+def _serve(args: argparse.Namespace) -> int:
+    from app.api import serve
+
+    serve(host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+
+def _stub(args: argparse.Namespace) -> int:
+    from app.stub_server import StubConfig, parse_latency, serve
+
+    config = StubConfig(
+        latency=parse_latency(args.latency),
+        token_interval_s=args.token_interval,
+        reply_words=args.reply_words,
+        error_rate=args.error_rate,
+        rate_429=args.rate_429,
+        retry_after_s=args.retry_after,
+        stream=None if args.stream == "off" else args.stream,
+        seed=args.seed,
+    )
+    serve(args.host, args.port, config)
+    return 0
+
+
+def _loadtest(args: argparse.Namespace) -> int:
+    from app.loadtest import format_report, run_loadtest
+    from app.stub_server import StubConfig, parse_latency
+
+    report = run_loadtest(
+        fans=args.fans,
+        turns=args.turns,
+        concurrency=args.concurrency,
+        mix=args.mix,
+        api_url=args.api_url,
+        db_path=args.db,
+        think_time_s=args.think_time,
+        pay_probability=args.pay_probability,
+        stub_config=StubConfig(
+            latency=parse_latency(args.latency),
+            error_rate=args.error_rate,
+            rate_429=args.rate_429,
+            seed=args.seed,
+        ),
+        seed=args.seed,
+    )
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report["lock_errors"] else 0
+
+
+def _bench(args: argparse.Namespace) -> int:
+    from app import bench, db
+
+    path = os.path.abspath(args.db or bench.default_db_path(args.scale))
+    if path == os.path.abspath(db._DB_PATH):
+        print("[MyFanCRM] Refus: --db pointe sur la base applicative (MYFANCRM_DB_PATH)", file=sys.stderr)
+        return 2
+    log = lambda msg: print(f"  {msg}", flush=True)  # noqa: E731
+    if args.regenerate or not os.path.exists(path):
+        print(f"[MyFanCRM] Génération de la base {args.scale} ({path})", flush=True)
+        started = time.perf_counter()
+        counts = bench.generate_database(path, seed=args.seed, progress=log, **bench.SCALES[args.scale])
+        print(f"[MyFanCRM] Base générée en {time.perf_counter() - started:.1f} s: {json.dumps(counts)}", flush=True)
+    db._DB_PATH = path
+    db.close_pools()
+
+    report = bench.run_benchmarks(
+        name_filter=args.filter,
+        min_iterations=args.min_iterations,
+        min_time_s=args.min_time,
+        seed=args.seed,
+        progress=log,
+    )
+    report["meta"]["scale"] = args.scale
+    if report["uncovered"]:
+        print(f"[MyFanCRM] Fonctions app.db sans benchmark: {', '.join(report['uncovered'])}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[MyFanCRM] Résultats écrits dans {args.out}")
+    if args.compare:
+        rows = bench.compare(report, bench.load_report(args.compare), threshold=args.threshold)
+        regressions = [r for r in rows if r["regression"]]
+        for r in rows:
+            flag = "  RÉGRESSION" if r["regression"] else ""
+            print(f"  {r['name']:<42} {r['previous_ms']:>9.3f} -> {r['current_ms']:>9.3f} ms  x{r['ratio']}{flag}")
+        if regressions:
+            print(f"[MyFanCRM] {len(regressions)} régression(s) au-delà de x{args.threshold}")
+            return 1
+    return 0
+
+
+def _queryplan(args: argparse.Namespace) -> int:
+    from app import bench, db, queryplan
+
+    path = os.path.abspath(args.db or bench.default_db_path(args.scale))
+    if path == os.path.abspath(db._DB_PATH):
+        print("[MyFanCRM] Refus: --db pointe sur la base applicative (MYFANCRM_DB_PATH)", file=sys.stderr)
+        return 2
+    if not os.path.exists(path):
+        print(f"[MyFanCRM] Génération de la base {args.scale} ({path})", flush=True)
+        bench.generate_database(path, seed=args.seed, **bench.SCALES[args.scale])
+    db._DB_PATH = path
+    db.close_pools()
+    report = queryplan.check_query_plans(min_rows=args.min_rows, seed=args.seed)
+    print(queryplan.format_report(report, verbose=args.verbose))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report["failures"] else 0
+
+
+def _slowlog(args: argparse.Namespace) -> int:
+    from app import slowlog
+
+    path = args.file or slowlog.log_path()
+    entries = slowlog.read_log(path, window=args.window)
+    rows = slowlog.summarize(entries, top=args.top, sort=args.sort)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print(slowlog.format_report(rows, path, len(entries)))
+    return 0
+
+
+def _profile(args: argparse.Namespace) -> int:
+    from app import profiling
+
+    directory = args.dir or profiling.PROFILE_DIR
+    if not directory:
+        print("[MyFanCRM] --dir requis (ou MYFANCRM_PROFILE_DIR)", file=sys.stderr)
+        return 2
+    summary = profiling.summarize_session(directory, session=args.session, page=args.page, top=args.top, sort=args.sort)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print(profiling.format_summary(summary, sort=args.sort))
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app")
+    sub = parser.add_subparsers(dest="command")
+
+    p_run = sub.add_parser("run", help="Lance l'UI Streamlit (défaut)")
+    p_run.set_defaults(func=_run_streamlit)
+
+    p_migrate = sub.add_parser("migrate", help="Applique les migrations de schéma SQLite")
+    p_migrate.set_defaults(func=_migrate)
+
+    p_serve = sub.add_parser("serve", help="Lance l'API HTTP headless du moteur de conversation")
+    p_serve.add_argument("--host", default=os.environ.get("MYFANCRM_API_HOST") or "127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=int(os.environ.get("MYFANCRM_API_PORT") or 8080))
+    p_serve.add_argument("--workers", type=int, default=int(os.environ.get("MYFANCRM_API_WORKERS") or 2))
+    p_serve.set_defaults(func=_serve)
+
+    p_stub = sub.add_parser("stub", help="Lance un faux Sinhome_llm local (tests de charge, benchmarks)")
+    p_stub.add_argument("--host", default="127.0.0.1")
+    p_stub.add_argument("--port", type=int, default=8000)
+    p_stub.add_argument("--latency", default="fixed:0.2", help="fixed:S | uniform:A,B | normal:M,SD | lognormal:MU,SIGMA | exp:M")
+    p_stub.add_argument("--token-interval", type=float, default=0.02, help="Délai entre tokens en streaming (s)")
+    p_stub.add_argument("--reply-words", type=int, default=24)
+    p_stub.add_argument("--error-rate", type=float, default=0.0, help="Fraction de réponses 500/502/503")
+    p_stub.add_argument("--rate-429", type=float, default=0.0, help="Fraction de réponses 429")
+    p_stub.add_argument("--retry-after", type=int, default=1, help="En-tête Retry-After des 429 (s)")
+    p_stub.add_argument("--stream", choices=("off", "sse", "ndjson", "text"), default="off")
+    p_stub.add_argument("--seed", type=int, default=None)
+    p_stub.set_defaults(func=_stub)
+
+    p_load = sub.add_parser("loadtest", help="Test de charge (fans synthétiques, flux free/script/paywall)")
+    p_load.add_argument("--fans", type=int, default=50)
+    p_load.add_argument("--turns", type=int, default=10, help="Tours par fan")
+    p_load.add_argument("--concurrency", type=int, default=16, help="Fans joués en parallèle")
+    p_load.add_argument("--mix", default="free=0.4,script=0.3,paywall=0.3")
+    p_load.add_argument("--db", default=None, help="Fichier SQLite (défaut: fichier temporaire neuf)")
+    p_load.add_argument("--api-url", default=None, help="Sinhome_llm réel (défaut: stub dans le process)")
+    p_load.add_argument("--think-time", type=float, default=0.0, help="Pause moyenne entre deux messages d'un fan (s)")
+    p_load.add_argument("--pay-probability", type=float, default=0.5, help="Probabilité qu'un fan paie un paywall")
+    p_load.add_argument("--latency", default="fixed:0.05", help="Latence du stub (voir `stub --help`)")
+    p_load.add_argument("--error-rate", type=float, default=0.0)
+    p_load.add_argument("--rate-429", type=float, default=0.0)
+    p_load.add_argument("--seed", type=int, default=0)
+    p_load.add_argument("--json", default=None, help="Écrit le rapport complet en JSON")
+    p_load.set_defaults(func=_loadtest)
+
+    p_bench = sub.add_parser("bench", help="Benchmarks des fonctions app.db sur une base synthétique")
+    p_bench.add_argument("--scale", choices=("small", "medium", "full"), default="small")
+    p_bench.add_argument("--db", default=None, help="Fichier de la base de benchmark (défaut: dossier temporaire)")
+    p_bench.add_argument("--regenerate", action="store_true", help="Recrée la base même si le fichier existe")
+    p_bench.add_argument("--filter", default=None, help="Ne lance que les benchmarks dont le nom contient ce texte")
+    p_bench.add_argument("--min-iterations", type=int, default=20)
+    p_bench.add_argument("--min-time", type=float, default=0.3, help="Durée minimale par benchmark (s)")
+    p_bench.add_argument("--out", default=None, help="Écrit les résultats en JSON")
+    p_bench.add_argument("--compare", default=None, help="JSON d'un run précédent à comparer (code 1 si régression)")
+    p_bench.add_argument("--threshold", type=float, default=1.5, help="Ratio de médiane considéré comme régression")
+    p_bench.add_argument("--seed", type=int, default=0)
+    p_bench.set_defaults(func=_bench)
+
+    p_plan = sub.add_parser("queryplan", help="Vérifie les plans de requêtes app.db (SCAN / TEMP B-TREE)")
+    p_plan.add_argument("--scale", choices=("small", "medium", "full"), default="small")
+    p_plan.add_argument("--db", default=None, help="Base peuplée à utiliser (défaut: base de benchmark, générée au besoin)")
+    p_plan.add_argument("--min-rows", type=int, default=1000, help="Taille à partir de laquelle une table est volumineuse")
+    p_plan.add_argument("--verbose", action="store_true", help="Affiche le plan de chaque requête")
+    p_plan.add_argument("--json", default=None)
+    p_plan.add_argument("--seed", type=int, default=0)
+    p_plan.set_defaults(func=_queryplan)
+
+    p_slow = sub.add_parser("slowlog", help="Top-N des requêtes SQLite lentes (MYFANCRM_SLOW_QUERY_MS)")
+    p_slow.add_argument("--file", default=None, help="Journal JSONL (défaut: MYFANCRM_SLOW_QUERY_FILE ou <base>.slowlog.jsonl)")
+    p_slow.add_argument("--top", type=int, default=20)
+    p_slow.add_argument("--window", type=int, default=10000, help="Nombre de dernières entrées prises en compte")
+    p_slow.add_argument("--sort", choices=("total", "max", "count", "recent"), default="total")
+    p_slow.add_argument("--json", action="store_true", help="Sortie JSON")
+    p_slow.set_defaults(func=_slowlog)
+
+    p_prof = sub.add_parser("profile", help="Hotspots des reruns Streamlit profilés (MYFANCRM_PROFILE_DIR)")
+    p_prof.add_argument("--dir", default=None, help="Dossier des profils (défaut: MYFANCRM_PROFILE_DIR)")
+    p_prof.add_argument("--session", default=None, help="Session à résumer (défaut: la plus récente)")
+    p_prof.add_argument("--page", default=None, help="Ne garde que les pages dont le nom contient ce texte")
+    p_prof.add_argument("--top", type=int, default=25)
+    p_prof.add_argument("--sort", choices=("cumulative", "tottime"), default="cumulative")
+    p_prof.add_argument("--json", action="store_true", help="Sortie JSON")
+    p_prof.set_defaults(func=_profile)
+
+    args = parser.parse_args(argv)
+    func = getattr(args, "func", _run_streamlit)
+    sys.exit(func(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,502 @@
+"""API HTTP headless (WSGI) du moteur de conversation.
+
+Lancement: `python -m app serve --workers 4` (pré-fork stdlib), ou sous n'importe quel
+serveur WSGI, ex. `gunicorn -w 4 app.api:application`. `serve` partage les limites SINHOME_MAX_CONCURRENCY
+et SINHOME_RATE_PER_S entre ses workers; sous gunicorn elles s'appliquent par worker (les diviser par -w).
+"""
+
+import json
+import os
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from app import db
+from app import engine
+from app import governor
+from app import metrics
+from app import sinhome_client
+from app.sinhome_client import SinhomeClientError
+
+DEFAULT_API_URL = os.environ.get("SINHOME_API_URL") or "http://127.0.0.1:8000"
+MAX_BATCH_SIZE = int(os.environ.get("MYFANCRM_API_MAX_BATCH") or 100)
+_BATCH_CONCURRENCY = int(os.environ.get("MYFANCRM_API_BATCH_CONCURRENCY") or 8)
+_MAX_BODY_BYTES = 1024 * 1024
+# Attente max d'un tour de même clé d'idempotence lancé par un autre process
+_IDEMPOTENCY_WAIT_S = float(os.environ.get("MYFANCRM_IDEMPOTENCY_WAIT_S") or 120)
+# Attente max de la fin du tour en cours sur la même conversation (API, worker ou autre process)
+_TURN_WAIT_S = float(os.environ.get("MYFANCRM_TURN_WAIT_S") or 120)
+_IDEMPOTENCY_POLL_S = 0.2
+
+_STATUS_TEXT = {
+    200: "200 OK",
+    400: "400 Bad Request",
+    404: "404 Not Found",
+    405: "405 Method Not Allowed",
+    409: "409 Conflict",
+    413: "413 Payload Too Large",
+    502: "502 Bad Gateway",
+}
+
+
+class _Text:
+    def __init__(self, body: str, content_type: str) -> None:
+        self.body = body
+        self.content_type = content_type
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _conversation_state(row: Any) -> Dict[str, Any]:
+    return {
+        "id": int(row["id"]),
+        "subscriber_id": int(row["subscriber_id"]),
+        "bot_id": int(row["bot_id"]),
+        "script_id": int(row["script_id"]) if row["script_id"] else None,
+        "mode": row["mode"],
+        "current_step": int(row["current_step"]),
+        "paywall_unlocked": bool(int(row["paywall_unlocked"])),
+        "script_started": bool(int(row["script_started"])),
+        "paywall_counter": int(row["paywall_counter"]),
+        "updated_at": row["updated_at"],
+    }
+
+
+def _require_conversation(conversation_id: int) -> Any:
+    row = db.get_conversation(conversation_id)
+    if not row:
+        raise ApiError(404, f"Conversation {conversation_id} introuvable")
+    return row
+
+
+def _resolve_conversation_id(item: Dict[str, Any]) -> int:
+    # Soit conversation_id, soit username (abonné + conversation créés au besoin, mode free)
+    if item.get("conversation_id") is not None:
+        try:
+            return int(item["conversation_id"])
+        except (TypeError, ValueError):
+            raise ApiError(400, "conversation_id invalide")
+    username = str(item.get("username") or "").strip()
+    if not username:
+        raise ApiError(400, "conversation_id ou username requis")
+    subscriber_id = db.upsert_subscriber(None, username, str(item.get("display_name") or ""))
+    row = db.get_latest_conversation_for_subscriber(subscriber_id)
+    if row:
+        return int(row["id"])
+    bot_id = db.get_default_bot_id()
+    if bot_id is None:
+        raise ApiError(400, "Aucune créatrice configurée")
+    return db.create_conversation(subscriber_id=subscriber_id, bot_id=bot_id, mode="free", script_id=None)
+
+
+class _SingleFlight:
+    """Appels concurrents de même clé dans le process: un seul s'exécute, les autres partagent son résultat."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: Dict[Any, "Future[Any]"] = {}
+
+    def do(self, key: Any, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+
+_single_flight = _SingleFlight()
+
+
+class _ConversationLocks:
+    """Un verrou par conversation dans le process (libéré du dict quand plus personne ne l'attend)."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.locks: Dict[int, Tuple[threading.Lock, int]] = {}
+
+    def acquire(self, conversation_id: int, timeout_s: float) -> threading.Lock:
+        with self.lock:
+            lock, users = self.locks.get(conversation_id, (None, 0))
+            lock = lock or threading.Lock()
+            self.locks[conversation_id] = (lock, users + 1)
+        if lock.acquire(timeout=timeout_s):
+            return lock
+        self._forget(conversation_id)
+        raise ApiError(409, "Un autre tour est en cours sur cette conversation")
+
+    def release(self, conversation_id: int, lock: threading.Lock) -> None:
+        lock.release()
+        self._forget(conversation_id)
+
+    def _forget(self, conversation_id: int) -> None:
+        with self.lock:
+            lock, users = self.locks[conversation_id]
+            if users <= 1:
+                del self.locks[conversation_id]
+            else:
+                self.locks[conversation_id] = (lock, users - 1)
+
+
+_conversation_locks = _ConversationLocks()
+
+
+def _turn_result(conversation_id: int, reply: str, error: Optional[str]) -> Dict[str, Any]:
+    text, paywall = engine.parse_paywall_marker(reply)
+    return {
+        "conversation_id": conversation_id,
+        "reply": text,
+        "paywall": paywall,
+        "error": error,
+        "state": _conversation_state(_require_conversation(conversation_id)),
+    }
+
+
+def _generate_turn(
+    conversation_id: int,
+    message: str,
+    session_id: str,
+    api_url: str,
+    pending_turn_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    with metrics.turn_trace(conversation_id, "api"):
+        plan = engine.start_turn(conversation_id, message, session_id)
+        error = None
+        try:
+            reply = engine.finish_turn(plan, engine.generate_reply(api_url, plan), pending_turn_id=pending_turn_id)
+        except SinhomeClientError as e:
+            error = str(e)
+            reply = engine.finish_turn(plan, None, error=error, pending_turn_id=pending_turn_id)
+        else:
+            # Résumé hors chemin critique: la réponse n'attend pas un second appel Sinhome_llm
+            engine.after_turn_background(api_url, plan)
+    return _turn_result(conversation_id, reply, error)
+
+
+def _replay_turn(conversation_id: int, pending_turn_id: int) -> Dict[str, Any]:
+    # Tour de même clé (autre requête, éventuellement autre process): on attend son résultat
+    deadline = time.monotonic() + _IDEMPOTENCY_WAIT_S
+    while True:
+        row = db.get_pending_turn(pending_turn_id)
+        if row is None:
+            raise ApiError(409, "Tour de même clé d'idempotence introuvable")
+        if row["status"] == "done":
+            reply = str(row["result"] or "")
+            error = reply[len(engine.API_ERROR_PREFIX):] if reply.startswith(engine.API_ERROR_PREFIX) else None
+            return {**_turn_result(conversation_id, reply, error), "replayed": True}
+        if row["status"] == "error":
+            raise ApiError(409, f"Le tour de même clé a échoué: {row['error']}")
+        if time.monotonic() >= deadline:
+            raise ApiError(409, "Un tour de même clé d'idempotence est encore en cours")
+        time.sleep(_IDEMPOTENCY_POLL_S)
+
+
+def _run_pending_turn(
+    conversation_id: int, message: str, session_id: str, api_url: str, pending_turn_id: int
+) -> Dict[str, Any]:
+    # Un tour à la fois par conversation: verrou local entre threads, puis pending_turns entre
+    # process et vis-à-vis d'app.worker (comme claim_pending_turn)
+    deadline = time.monotonic() + _TURN_WAIT_S
+    try:
+        lock = _conversation_locks.acquire(conversation_id, _TURN_WAIT_S)
+    except ApiError as e:
+        db.fail_pending_turn(pending_turn_id, e.message)
+        raise
+    try:
+        while not db.start_pending_turn(pending_turn_id):
+            if time.monotonic() >= deadline:
+                raise ApiError(409, "Un autre tour est en cours sur cette conversation")
+            time.sleep(_IDEMPOTENCY_POLL_S)
+        return _generate_turn(conversation_id, message, session_id, api_url, pending_turn_id=pending_turn_id)
+    except Exception as e:
+        # Échec avant commit: la même clé pourra être rejouée. Après commit (ex. lecture de l'état
+        # qui échoue), le tour reste 'done' (fail_pending_turn n'y touche pas) et un rejeu le relit.
+        db.fail_pending_turn(pending_turn_id, e.message if isinstance(e, ApiError) else str(e))
+        raise
+    finally:
+        _conversation_locks.release(conversation_id, lock)
+
+
+def _run_idempotent_turn(conversation_id: int, message: str, session_id: str, api_url: str, key: str) -> Dict[str, Any]:
+    row, created = db.register_pending_turn(
+        conversation_id, message, session_id, api_url, idempotency_key=key, status="waiting"
+    )
+    if not created:
+        return _replay_turn(conversation_id, int(row["id"]))
+    return _run_pending_turn(conversation_id, message, session_id, api_url, int(row["id"]))
+
+
+def _run_turn(item: Dict[str, Any]) -> Dict[str, Any]:
+    message = str(item.get("message") or "")
+    if not message.strip():
+        raise ApiError(400, "message requis")
+    conversation_id = _resolve_conversation_id(item)
+    _require_conversation(conversation_id)
+    # session_id stable par conversation: les caches côté Sinhome_llm restent chauds
+    session_id = str(item.get("session_id") or f"conv-{conversation_id}")
+    api_url = str(item.get("api_url") or DEFAULT_API_URL)
+    key = str(item.get("idempotency_key") or "").strip()
+    if not key:
+        row, _ = db.register_pending_turn(conversation_id, message, session_id, api_url, status="waiting")
+        return _run_pending_turn(conversation_id, message, session_id, api_url, int(row["id"]))
+    if len(key) > 255:
+        raise ApiError(400, "idempotency_key trop longue (255 max)")
+    return _single_flight.do(
+        (conversation_id, key), lambda: _run_idempotent_turn(conversation_id, message, session_id, api_url, key)
+    )
+
+
+def _with_idempotency_header(environ: Dict[str, Any], body: Dict[str, Any]) -> Dict[str, Any]:
+    # En-tête Idempotency-Key accepté comme alternative au champ idempotency_key du corps
+    header = environ.get("HTTP_IDEMPOTENCY_KEY")
+    if header and not body.get("idempotency_key"):
+        return {**body, "idempotency_key": header}
+    return body
+
+
+def _run_batch(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Conversations traitées en parallèle; messages d'une même conversation dans l'ordre reçu
+    groups: Dict[Any, List[Tuple[int, Dict[str, Any]]]] = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ApiError(400, f"messages[{i}] doit être un objet")
+        key = item.get("conversation_id") if item.get("conversation_id") is not None else f"u:{item.get('username')}"
+        groups.setdefault(key, []).append((i, item))
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+
+    def _run_group(group: List[Tuple[int, Dict[str, Any]]]) -> None:
+        for i, item in group:
+            try:
+                results[i] = _run_turn(item)
+            except ApiError as e:
+                results[i] = {"error": e.message, "status": e.status}
+            except Exception as e:
+                # Un message en échec ne fait pas perdre les résultats des autres
+                results[i] = {"error": f"Erreur interne: {e}", "status": 500}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(_BATCH_CONCURRENCY, len(groups)))) as pool:
+        list(pool.map(_run_group, groups.values()))
+    return [r or {} for r in results]
+
+
+# --- Handlers ---
+
+def _health(environ: Dict[str, Any], body: Dict[str, Any]) -> Tuple[int, Any]:
+    return 200, {
+        "status": "ok",
+        "schema_version": db.get_schema_version(),
+        "pid": os.getpid(),
+        "sinhome_breakers": sinhome_client.breaker_states(),
+        "sinhome_backends": sinhome_client.backend_states(),
+        "sinhome_queue": governor.stats(),
+    }
+
+
+def _metrics(environ: Dict[str, Any], body: Dict[str, Any]) -> Tuple[int, Any]:
+    # Métriques du worker qui répond (un registre par process en mode pré-fork)
+    return 200, _Text(metrics.REGISTRY.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+
+
+def _post_message(environ: Dict[str, Any], body: Dict[str, Any], conversation_id: str) -> Tuple[int, Any]:
+    result = _run_turn({**_with_idempotency_header(environ, body), "conversation_id": int(conversation_id)})
+    return (502 if result["error"] else 200), result
+
+
+def _post_inbound(environ: Dict[str, Any], body: Dict[str, Any]) -> Tuple[int, Any]:
+    result = _run_turn(_with_idempotency_header(environ, body))
+    return (502 if result["error"] else 200), result
+
+
+def _post_batch(environ: Dict[str, Any], body: Dict[str, Any]) -> Tuple[int, Any]:
+    items = body.get("messages")
+    if not isinstance(items, list) or not items:
+        raise ApiError(400, "messages (liste non vide) requis")
+    if len(items) > MAX_BATCH_SIZE:
+        raise ApiError(413, f"Au plus {MAX_BATCH_SIZE} messages par lot")
+    return 200, {"results": _run_batch(items)}
+
+
+def _get_conversation(environ: Dict[str, Any], body: Dict[str, Any], conversation_id: str) -> Tuple[int, Any]:
+    return 200, _conversation_state(_require_conversation(int(conversation_id)))
+
+
+def _lock_script(environ: Dict[str, Any], body: Dict[str, Any], conversation_id: str) -> Tuple[int, Any]:
+    row = _require_conversation(int(conversation_id))
+    if row["mode"] != "script" or not row["script_id"]:
+        raise ApiError(400, "La conversation n'est pas en mode script")
+    if not db.list_steps(int(row["script_id"])):
+        raise ApiError(400, "Le script n'a pas d'étapes")
+    db.lock_script(int(conversation_id))
+    return 200, _conversation_state(_require_conversation(int(conversation_id)))
+
+
+def _unlock_script(environ: Dict[str, Any], body: Dict[str, Any], conversation_id: str) -> Tuple[int, Any]:
+    _require_conversation(int(conversation_id))
+    db.set_script_started(int(conversation_id), False)
+    return 200, _conversation_state(_require_conversation(int(conversation_id)))
+
+
+def _unlock_paywall(environ: Dict[str, Any], body: Dict[str, Any], conversation_id: str) -> Tuple[int, Any]:
+    _require_conversation(int(conversation_id))
+    db.unlock_paywall(int(conversation_id))
+    return 200, _conversation_state(_require_conversation(int(conversation_id)))
+
+
+_ROUTES: List[Tuple[str, "re.Pattern[str]", Callable[..., Tuple[int, Any]]]] = [
+    ("GET", re.compile(r"^/health$"), _health),
+    ("GET", re.compile(r"^/metrics$"), _metrics),
+    ("POST", re.compile(r"^/inbound$"), _post_inbound),
+    ("POST", re.compile(r"^/inbound/batch$"), _post_batch),
+    ("GET", re.compile(r"^/conversations/(\d+)$"), _get_conversation),
+    ("POST", re.compile(r"^/conversations/(\d+)/messages$"), _post_message),
+    ("POST", re.compile(r"^/conversations/(\d+)/script/lock$"), _lock_script),
+    ("POST", re.compile(r"^/conversations/(\d+)/script/unlock$"), _unlock_script),
+    ("POST", re.compile(r"^/conversations/(\d+)/paywall/unlock$"), _unlock_paywall),
+]
+
+
+def _read_json(environ: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if length > _MAX_BODY_BYTES:
+        raise ApiError(413, "Corps de requête trop gros")
+    if length <= 0:
+        return {}
+    try:
+        data = json.loads(environ["wsgi.input"].read(length))
+    except ValueError:
+        raise ApiError(400, "JSON invalide")
+    if not isinstance(data, dict):
+        raise ApiError(400, "Objet JSON attendu")
+    return data
+
+
+def application(environ: Dict[str, Any], start_response: Callable[..., Any]) -> Iterable[bytes]:
+    db.init_db()
+    method = environ.get("REQUEST_METHOD", "GET").upper()
+    path = environ.get("PATH_INFO") or "/"
+    status, payload = 404, {"error": "Not found"}
+    try:
+        path_matched = False
+        for route_method, pattern, handler in _ROUTES:
+            match = pattern.match(path)
+            if not match:
+                continue
+            path_matched = True
+            if route_method != method:
+                continue
+            status, payload = handler(environ, _read_json(environ), *match.groups())
+            break
+        else:
+            if path_matched:
+                status, payload = 405, {"error": "Method not allowed"}
+    except ApiError as e:
+        status, payload = e.status, {"error": e.message}
+    if isinstance(payload, _Text):
+        body, content_type = payload.body.encode("utf-8"), payload.content_type
+    else:
+        body, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+    start_response(
+        _STATUS_TEXT.get(status, f"{status} Error"),
+        [("Content-Type", content_type), ("Content-Length", str(len(body)))],
+    )
+    return [body]
+
+
+# --- Serveur pré-fork (stdlib) ---
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format: str, *args: Any) -> None:
+        if os.environ.get("MYFANCRM_API_ACCESS_LOG"):
+            super().log_message(format, *args)
+
+
+def _serve_on(sock: socket.socket, host: str, port: int) -> None:
+    server = _ThreadingWSGIServer((host, port), _QuietHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_name = host
+    server.server_port = port
+    server.setup_environ()
+    server.set_app(application)
+    server.serve_forever()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8080, workers: int = 1) -> None:
+    # Migrations une fois dans le parent, puis chaque worker ouvre ses propres connexions
+    db.init_db()
+    db.close_pools()
+    sock = socket.create_server((host, port), backlog=256)
+    print(f"[MyFanCRM] API sur http://{host}:{port} ({workers} worker(s), DB {db._DB_PATH})", flush=True)
+    if workers <= 1 or not hasattr(os, "fork"):
+        _serve_on(sock, host, port)
+        return
+
+    # Régulateur par process: chaque worker reçoit sa part des limites Sinhome_llm
+    budget = governor.split(workers)
+    concurrency = budget["max_concurrency"] or "sans limite"
+    rate = f"{budget['rate_per_s']:.2f} req/s" if budget["rate_per_s"] else "débit sans limite"
+    print(
+        f"[MyFanCRM] Sinhome_llm par worker: {concurrency} appel(s) simultané(s), {rate}"
+        f" (SINHOME_MAX_CONCURRENCY={governor.MAX_CONCURRENCY}, SINHOME_RATE_PER_S={governor.RATE_PER_S:g}"
+        f" répartis sur {workers} workers)",
+        flush=True,
+    )
+    if governor.MAX_CONCURRENCY and governor.MAX_CONCURRENCY < workers:
+        print(f"[MyFanCRM] Attention: {workers} workers > SINHOME_MAX_CONCURRENCY, au plus {workers} appels simultanés", flush=True)
+
+    children: List[int] = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                _serve_on(sock, host, port)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def _stop(signum: int, frame: Any) -> None:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for pid in children:
+        os.waitpid(pid, 0)
@@ -0,0 +1,593 @@
+"""Micro-benchmarks de la couche stockage (app.db) sur une base synthétique réaliste.
+
+    python -m app bench --scale full --db /tmp/bench.sqlite3 --out bench.json
+    python -m app bench --scale full --db /tmp/bench.sqlite3 --compare bench.json
+
+La base générée est réutilisée si le fichier existe déjà (--regenerate pour la recréer).
+
+Chaque fonction publique de app.db est chronométrée (min / médiane / p95 en ms) et le
+résultat est écrit en JSON pour comparer les runs dans le temps.
+"""
+
+import inspect
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app import db
+from app import vectors
+
+SCALES: Dict[str, Dict[str, int]] = {
+    "small": {"subscribers": 1_000, "messages": 50_000, "scripts": 30, "steps_per_script": 12},
+    "medium": {"subscribers": 5_000, "messages": 300_000, "scripts": 100, "steps_per_script": 20},
+    "full": {"subscribers": 10_000, "messages": 1_200_000, "scripts": 300, "steps_per_script": 25},
+}
+
+# Fonctions volontairement hors benchmark (plomberie, pas des requêtes)
+_NOT_BENCHMARKED = {"get_conn", "get_read_conn", "close_pools", "migrate", "set_statement_tracer", "set_message_listener"}
+
+_WORDS = (
+    "coucou salut bébé mon coeur chéri tu me manques trop ce soir demain aujourd'hui photo vidéo "
+    "selfie surprise cadeau privé exclusif regarde envoie montre voir envie plaisir douche plage "
+    "vacances week-end travail fatigué sport salle dîner restaurant film série musique danse "
+    "robe lingerie rouge noir dentelle soleil nuit matin réveil lit canapé bain massage bisous "
+    "câlin adorable magnifique sublime belle sexy mignon drôle rire sourire yeux cheveux "
+    "lèvres peau parfum message vocal appel prix payer débloquer offre promo abonné fan "
+    "merci vraiment toujours jamais encore peut-être bientôt vite doucement lentement"
+).split()
+_GLUE = "je tu il on nous vous et mais donc ou avec pour sans dans sur le la les un une des ça c'est".split()
+
+_STEP_TYPES = ("text", "text", "media_text", "paywall_text", "paywall_media_text")
+
+
+def _sentence(rng: random.Random, min_words: int = 3, max_words: int = 25) -> str:
+    n = rng.randint(min_words, max_words)
+    return " ".join(rng.choice(_WORDS) if rng.random() < 0.6 else rng.choice(_GLUE) for _ in range(n))
+
+
+def _iso(dt: datetime) -> str:
+    return dt.replace(microsecond=0).isoformat()
+
+
+def default_db_path(scale: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f"myfancrm-bench-{scale}.sqlite3")
+
+
+def _remove_db_files(path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def generate_database(
+    path: str,
+    subscribers: int,
+    messages: int,
+    scripts: int,
+    steps_per_script: int,
+    seed: int = 0,
+    progress: Optional[Callable[[str], None]] = None,
+) -> Dict[str, int]:
+    """Crée une base neuve peuplée (insertions en masse, hors API publique pour aller vite)."""
+    log = progress or (lambda msg: None)
+    rng = random.Random(seed)
+    _remove_db_files(path)
+    db._DB_PATH = path
+    db.close_pools()
+    db.init_db()
+    bot_id = db.get_default_bot_id()
+    now = datetime.now(timezone.utc)
+    origin = now - timedelta(days=180)
+
+    with db.get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        log(f"{scripts} scripts x {steps_per_script} étapes")
+        script_ids: List[int] = []
+        step_rows = []
+        for i in range(scripts):
+            ts = _iso(origin + timedelta(minutes=rng.randrange(180 * 24 * 60)))
+            cur = conn.execute(
+                "INSERT INTO scripts(name, description, bot_id, created_at, updated_at) VALUES(?, ?, ?, ?, ?)",
+                (f"Script {i:04d} {rng.choice(_WORDS)}", _sentence(rng, 5, 15), bot_id, ts, ts),
+            )
+            script_id = int(cur.lastrowid)
+            script_ids.append(script_id)
+            for pos in range(1, steps_per_script + 1):
+                step_type = rng.choice(_STEP_TYPES)
+                step_rows.append(
+                    (
+                        script_id,
+                        pos,
+                        step_type,
+                        f"Étape {pos} {rng.choice(_WORDS)}",
+                        _sentence(rng, 10, 40),
+                        _sentence(rng, 3, 8) if "media" in step_type else None,
+                        1 if step_type.startswith("paywall_") else 0,
+                        f"{rng.choice((4.99, 9.99, 14.99, 29.99))}" if step_type.startswith("paywall_") else None,
+                        ts,
+                        ts,
+                    )
+                )
+        conn.executemany(
+            """
+            INSERT INTO script_steps(script_id, position, step_type, title, script_text, media_desc, is_paywall, price, created_at, updated_at)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            step_rows,
+        )
+
+        log(f"{subscribers} abonnés")
+        sub_created = sorted(origin + timedelta(seconds=rng.randrange(150 * 86400)) for _ in range(subscribers))
+        first_sub_id = int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM subscribers").fetchone()[0]) + 1
+        conn.executemany(
+            "INSERT INTO subscribers(username, display_name, created_at) VALUES(?, ?, ?)",
+            [(f"fan_{i:06d}_{rng.choice(_WORDS)}", f"Fan {i}", _iso(ts)) for i, ts in enumerate(sub_created)],
+        )
+
+        # ~1.2 conversation par abonné (certains ont aussi une conversation script)
+        conv_rows = []
+        conv_created: List[datetime] = []
+        for i, ts in enumerate(sub_created):
+            n_conv = 2 if rng.random() < 0.2 else 1
+            for _ in range(n_conv):
+                mode = rng.choices(("free", "script", "chloe"), weights=(0.7, 0.25, 0.05))[0]
+                script_id = rng.choice(script_ids) if mode == "script" and script_ids else None
+                created = ts + timedelta(minutes=rng.randrange(60 * 24))
+                conv_created.append(created)
+                conv_rows.append(
+                    [
+                        first_sub_id + i,
+                        bot_id,
+                        script_id,
+                        mode,
+                        rng.randint(1, steps_per_script) if script_id else 1,
+                        0,
+                        1 if script_id and rng.random() < 0.8 else 0,
+                        rng.randint(0, 3) if script_id else 0,
+                        _iso(created),
+                        _iso(created),
+                    ]
+                )
+        log(f"{len(conv_rows)} conversations")
+        first_conv_id = int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM conversations").fetchone()[0]) + 1
+        conn.executemany(
+            """
+            INSERT INTO conversations(subscriber_id, bot_id, script_id, mode, current_step, paywall_unlocked, script_started, paywall_counter, created_at, updated_at)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            conv_rows,
+        )
+
+        # Répartition très inégale des messages (quelques gros fans, beaucoup de petits)
+        cum_weights: List[float] = []
+        total = 0.0
+        for _ in conv_rows:
+            total += rng.paretovariate(1.16)
+            cum_weights.append(total)
+        last_role: Dict[int, str] = {}
+        last_ts: Dict[int, datetime] = {}
+        counts: Dict[int, int] = {}
+        batch_size = 50_000
+        inserted = 0
+        first_msg_id = int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]) + 1
+        timeline_start = origin + timedelta(days=150)
+        timeline_s = max(1.0, (now - timeline_start).total_seconds())
+        while inserted < messages:
+            n = min(batch_size, messages - inserted)
+            picks = rng.choices(range(len(conv_rows)), cum_weights=cum_weights, k=n)
+            msg_rows = []
+            vec_rows = []
+            for j, idx in enumerate(picks):
+                conv_id = first_conv_id + idx
+                role = "assistant" if last_role.get(idx) == "user" else "user"
+                last_role[idx] = role
+                counts[idx] = counts.get(idx, 0) + 1
+                # Timeline globale croissante, messages des conversations entrelacés comme en prod
+                ts = max(conv_created[idx], timeline_start + timedelta(seconds=timeline_s * (inserted + j) / messages))
+                last_ts[idx] = ts
+                content = _sentence(rng, 2, 30 if role == "user" else 45)
+                msg_rows.append((conv_id, role, content, _iso(ts)))
+                vec_rows.append((first_msg_id + inserted + j, conv_id, vectors.pack(vectors.term_counts(content))))
+            conn.executemany(
+                "INSERT INTO messages(conversation_id, role, content, created_at) VALUES(?, ?, ?, ?)",
+                msg_rows,
+            )
+            conn.executemany(
+                "INSERT INTO message_vectors(message_id, conversation_id, terms) VALUES(?, ?, ?)",
+                vec_rows,
+            )
+            inserted += n
+            log(f"messages {inserted}/{messages}")
+
+        conn.executemany(
+            "UPDATE conversations SET updated_at = ? WHERE id = ?",
+            [(_iso(ts), first_conv_id + idx) for idx, ts in last_ts.items()],
+        )
+
+        # Résumés roulants pour les longues conversations, historique de tours traités
+        long_convs = [idx for idx, c in counts.items() if c > 200]
+        conn.executemany(
+            "INSERT INTO conversation_summaries(conversation_id, summary, last_message_id, updated_at) VALUES(?, ?, ?, ?)",
+            [
+                (first_conv_id + idx, _sentence(rng, 40, 120), first_msg_id + rng.randrange(max(1, inserted)), _iso(now))
+                for idx in long_convs
+            ],
+        )
+        n_turns = min(inserted // 20, 50_000)
+        conn.executemany(
+            """
+            INSERT INTO pending_turns(conversation_id, user_msg, session_id, api_url, status, result, created_at, started_at, finished_at)
+            VALUES(?, ?, ?, 'http://127.0.0.1:8000', 'done', ?, ?, ?, ?)
+            """,
+            [
+                (
+                    first_conv_id + idx,
+                    _sentence(rng, 2, 12),
+                    f"conv-{first_conv_id + idx}",
+                    _sentence(rng, 5, 20),
+                    _iso(last_ts.get(idx, now)),
+                    _iso(last_ts.get(idx, now)),
+                    _iso(last_ts.get(idx, now)),
+                )
+                for idx in rng.choices(range(len(conv_rows)), cum_weights=cum_weights, k=n_turns)
+            ],
+        )
+    db.close_pools()
+    return table_counts()
+
+
+def table_counts() -> Dict[str, int]:
+    tables = ("bots", "scripts", "script_steps", "subscribers", "conversations", "messages", "pending_turns", "conversation_summaries")
+    with db.get_read_conn() as conn:
+        return {t: int(conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]) for t in tables}
+
+
+# --- Benchmarks ---
+
+def public_functions() -> List[str]:
+    return sorted(
+        name
+        for name, fn in vars(db).items()
+        if not name.startswith("_") and inspect.isfunction(fn) and fn.__module__ == db.__name__
+    )
+
+
+def _fixtures(rng: random.Random) -> Dict[str, Any]:
+    # Identifiants réels piochés dans la base (lecture directe, hors chronométrage)
+    with db.get_read_conn() as conn:
+        heavy = conn.execute(
+            "SELECT conversation_id, COUNT(*) AS n FROM messages GROUP BY conversation_id ORDER BY n DESC LIMIT 1"
+        ).fetchone()
+        conversations = list(
+            conn.execute(
+                "SELECT id, subscriber_id, bot_id, mode, script_id FROM conversations ORDER BY random() LIMIT 1000"
+            )
+        )
+        subscribers = list(conn.execute("SELECT id, username FROM subscribers ORDER BY random() LIMIT 1000"))
+        script_ids = [int(r[0]) for r in conn.execute("SELECT id FROM scripts ORDER BY random() LIMIT 200")]
+        heavy_ids = [
+            int(r[0])
+            for r in conn.execute(
+                "SELECT id FROM messages WHERE conversation_id = ? ORDER BY id", (int(heavy["conversation_id"]),)
+            )
+        ]
+        summary_conv = conn.execute("SELECT conversation_id FROM conversation_summaries LIMIT 1").fetchone()
+    bot_id = db.get_default_bot_id()
+    # Objets jetables pour les fonctions qui modifient/suppriment
+    scratch_sub = db.upsert_subscriber(None, f"bench_scratch_{rng.randrange(10**9)}", "Bench")
+    scratch_conv = db.create_conversation(scratch_sub, bot_id, mode="free", script_id=None)
+    scratch_script = db.upsert_script(None, "bench-scratch", "Script jetable du benchmark", bot_id)
+    scratch_steps = [
+        db.add_step(scratch_script, "text", f"Étape {i}", _sentence(rng, 10, 30), None, None) for i in range(20)
+    ]
+    # add_step / delete_step grossissent ce script-là, pas celui de move_step
+    grow_script = db.upsert_script(None, "bench-grow", "Script jetable du benchmark", bot_id)
+    free_convs = [r for r in conversations if r["mode"] == "free"]
+    script_convs = [r for r in conversations if r["script_id"]]
+    # Curseur "profond" (page 40) pour la pagination keyset
+    cursor = None
+    for _ in range(40):
+        _, cursor = db.list_conversations_page(limit=25, cursor=cursor)
+        if cursor is None:
+            break
+    return {
+        "bot_id": bot_id,
+        "heavy_conv": int(heavy["conversation_id"]),
+        "heavy_ids": heavy_ids,
+        "conv_ids": [int(r["id"]) for r in conversations],
+        "free_convs": free_convs or conversations,
+        "script_convs": script_convs or conversations,
+        "subscribers": subscribers,
+        "script_ids": script_ids,
+        "deep_cursor": cursor,
+        "summary_conv": int(summary_conv[0]) if summary_conv else int(heavy["conversation_id"]),
+        "scratch_sub": scratch_sub,
+        "scratch_conv": scratch_conv,
+        "scratch_script": scratch_script,
+        "scratch_steps": scratch_steps,
+        "grow_script": grow_script,
+    }
+
+
+Case = Tuple[str, str, Callable[[random.Random, Dict[str, Any]], Callable[[], Any]]]
+
+
+def _cases() -> List[Case]:
+    # (nom du benchmark, fonction app.db couverte, fabrique: prépare hors chrono et renvoie l'appel chronométré)
+    def conv(r: random.Random, f: Dict[str, Any]) -> int:
+        return r.choice(f["conv_ids"])
+
+    def heavy_mid(r: random.Random, f: Dict[str, Any]) -> int:
+        ids = f["heavy_ids"]
+        return ids[len(ids) // 2]
+
+    def new_pending(r: random.Random, f: Dict[str, Any]) -> int:
+        return db.enqueue_pending_turn(conv(r, f), "bench", None, "http://127.0.0.1:8000")
+
+    def move(r: random.Random, f: Dict[str, Any]) -> Callable[[], Any]:
+        step_id = r.choice(f["scratch_steps"])
+        return lambda: db.move_step(f["scratch_script"], step_id, r.choice(("up", "down")))
+
+    def save_summary(r: random.Random, f: Dict[str, Any]) -> Callable[[], Any]:
+        row = db.get_conversation_summary(f["scratch_conv"])
+        last = int(row["last_message_id"]) if row else 0
+        return lambda: db.save_conversation_summary(f["scratch_conv"], _sentence(r, 40, 80), last + 1, last)
+
+    def register_new(r: random.Random, f: Dict[str, Any]) -> Callable[[], Any]:
+        cid = conv(r, f)
+        return lambda: db.register_pending_turn(cid, "bench", None, "http://127.0.0.1:8000", idempotency_key=f"bench-{r.randrange(10**18)}")
+
+    def register_duplicate(r: random.Random, f: Dict[str, Any]) -> Callable[[], Any]:
+        cid, key = conv(r, f), f"bench-{r.randrange(10**18)}"
+        db.register_pending_turn(cid, "bench", None, "http://127.0.0.1:8000", idempotency_key=key)
+        return lambda: db.register_pending_turn(cid, "bench", None, "http://127.0.0.1:8000", idempotency_key=key)
+
+    def claim(r: random.Random, f: Dict[str, Any]) -> Callable[[], Any]:
+        new_pending(r, f)
+        return db.claim_pending_turn
+
+    def reset(r: random.Random, f: Dict[str, Any]) -> Callable[[], Any]:
+        for _ in range(20):
+            db.add_message(f["scratch_conv"], "user", _sentence(r))
+        return lambda: db.reset_conversation(f["scratch_conv"])
+
+    return [
+        # Schéma
+        ("get_schema_version", "get_schema_version", lambda r, f: db.get_schema_version),
+        ("init_db (fast path)", "init_db", lambda r, f: db.init_db),
+        # Bots
+        ("list_bots", "list_bots", lambda r, f: db.list_bots),
+        ("get_bot", "get_bot", lambda r, f: lambda: db.get_bot(f["bot_id"])),
+        ("get_default_bot_id", "get_default_bot_id", lambda r, f: db.get_default_bot_id),
+        ("get_creator_bot_id", "get_creator_bot_id", lambda r, f: db.get_creator_bot_id),
+        ("parse_persona_json", "parse_persona_json", lambda r, f: (lambda row: lambda: db.parse_persona_json(row))(db.get_bot(f["bot_id"]))),
+        (
+            "upsert_bot (update)",
+            "upsert_bot",
+            lambda r, f: (lambda row: lambda: db.upsert_bot(f["bot_id"], row["name"], db.parse_persona_json(row)))(db.get_bot(f["bot_id"])),
+        ),
+        ("delete_bot", "delete_bot", lambda r, f: (lambda bid: lambda: db.delete_bot(bid))(db.upsert_bot(None, "bench", {}))),
+        # Scripts / étapes
+        ("list_scripts", "list_scripts", lambda r, f: db.list_scripts),
+        ("list_scripts_for_bot", "list_scripts_for_bot", lambda r, f: lambda: db.list_scripts_for_bot(f["bot_id"])),
+        ("get_script", "get_script", lambda r, f: lambda: db.get_script(r.choice(f["script_ids"]))),
+        ("upsert_script (update)", "upsert_script", lambda r, f: lambda: db.upsert_script(f["scratch_script"], "bench-scratch", "maj", f["bot_id"])),
+        ("delete_script", "delete_script", lambda r, f: (lambda sid: lambda: db.delete_script(sid))(db.upsert_script(None, "bench-del", "", f["bot_id"]))),
+        ("list_steps", "list_steps", lambda r, f: lambda: db.list_steps(r.choice(f["script_ids"]))),
+        ("add_step", "add_step", lambda r, f: lambda: db.add_step(f["grow_script"], "text", "Ajout", _sentence(r), None, None)),
+        ("update_step", "update_step", lambda r, f: lambda: db.update_step(r.choice(f["scratch_steps"]), "text", "Maj", _sentence(r), None, None)),
+        ("delete_step", "delete_step", lambda r, f: (lambda sid: lambda: db.delete_step(sid))(db.add_step(f["grow_script"], "text", "Tmp", "tmp", None, None))),
+        ("move_step", "move_step", move),
+        ("search_script_steps", "search_script_steps", lambda r, f: lambda: db.search_script_steps(r.choice(_WORDS), limit=20)),
+        # Abonnés
+        ("list_subscribers", "list_subscribers", lambda r, f: db.list_subscribers),
+        ("get_subscriber", "get_subscriber", lambda r, f: lambda: db.get_subscriber(int(r.choice(f["subscribers"])["id"]))),
+        (
+            "upsert_subscriber (existing)",
+            "upsert_subscriber",
+            lambda r, f: (lambda s: lambda: db.upsert_subscriber(None, s["username"], "Fan"))(r.choice(f["subscribers"])),
+        ),
+        ("upsert_subscriber (new)", "upsert_subscriber", lambda r, f: (lambda u: lambda: db.upsert_subscriber(None, u, "Nouveau"))(f"bench_new_{r.randrange(10**12)}")),
+        (
+            "delete_subscriber",
+            "delete_subscriber",
+            lambda r, f: (lambda sid: lambda: db.delete_subscriber(sid))(db.upsert_subscriber(None, f"bench_del_{r.randrange(10**12)}", "")),
+        ),
+        # Conversations
+        ("list_conversations", "list_conversations", lambda r, f: db.list_conversations),
+        ("list_conversations_page (first)", "list_conversations_page", lambda r, f: lambda: db.list_conversations_page(limit=25)),
+        ("list_conversations_page (page 40)", "list_conversations_page", lambda r, f: lambda: db.list_conversations_page(limit=25, cursor=f["deep_cursor"])),
+        ("list_conversations_page (prefix)", "list_conversations_page", lambda r, f: lambda: db.list_conversations_page(limit=25, username_prefix=f"fan_00{r.randrange(10)}")),
+        ("create_conversation", "create_conversation", lambda r, f: lambda: db.create_conversation(f["scratch_sub"], f["bot_id"], "free", None)),
+        (
+            "get_or_create_conversation (free)",
+            "get_or_create_conversation",
+            lambda r, f: (lambda c: lambda: db.get_or_create_conversation(c["subscriber_id"], c["bot_id"], c["mode"], c["script_id"]))(r.choice(f["free_convs"])),
+        ),
+        (
+            "get_or_create_conversation (script)",
+            "get_or_create_conversation",
+            lambda r, f: (lambda c: lambda: db.get_or_create_conversation(c["subscriber_id"], c["bot_id"], c["mode"], c["script_id"]))(r.choice(f["script_convs"])),
+        ),
+        ("get_conversation", "get_conversation", lambda r, f: lambda: db.get_conversation(conv(r, f))),
+        (
+            "get_latest_conversation_for_subscriber",
+            "get_latest_conversation_for_subscriber",
+            lambda r, f: lambda: db.get_latest_conversation_for_subscriber(int(r.choice(f["subscribers"])["id"])),
+        ),
+        ("update_conversation_state", "update_conversation_state", lambda r, f: lambda: db.update_conversation_state(conv(r, f), 1, False)),
+        ("update_conversation_mode", "update_conversation_mode", lambda r, f: lambda: db.update_conversation_mode(f["scratch_conv"], "free", None)),
+        ("set_script_started", "set_script_started", lambda r, f: lambda: db.set_script_started(f["scratch_conv"], False)),
+        ("set_paywall_counter", "set_paywall_counter", lambda r, f: lambda: db.set_paywall_counter(conv(r, f), 0)),
+        ("increment_paywall_counter", "increment_paywall_counter", lambda r, f: lambda: db.increment_paywall_counter(conv(r, f))),
+        ("lock_script", "lock_script", lambda r, f: lambda: db.lock_script(f["scratch_conv"])),
+        ("unlock_paywall", "unlock_paywall", lambda r, f: lambda: db.unlock_paywall(conv(r, f))),
+        ("reset_conversation (20 msgs)", "reset_conversation", reset),
+        (
+            "delete_conversation",
+            "delete_conversation",
+            lambda r, f: (lambda cid: lambda: db.delete_conversation(cid))(db.create_conversation(f["scratch_sub"], f["bot_id"], "free", None)),
+        ),
+        # Messages / historique
+        ("add_message", "add_message", lambda r, f: lambda: db.add_message(conv(r, f), "user", _sentence(r))),
+        ("list_messages (random conv)", "list_messages", lambda r, f: lambda: db.list_messages(conv(r, f), limit=50)),
+        ("list_messages (heavy conv)", "list_messages", lambda r, f: lambda: db.list_messages(f["heavy_conv"], limit=50)),
+        ("list_messages (heavy, before_id)", "list_messages", lambda r, f: lambda: db.list_messages(f["heavy_conv"], limit=50, before_id=heavy_mid(r, f))),
+        ("list_messages (heavy, after_id)", "list_messages", lambda r, f: lambda: db.list_messages(f["heavy_conv"], limit=50, after_id=heavy_mid(r, f))),
+        ("build_history", "build_history", lambda r, f: lambda: db.build_history(f["heavy_conv"])),
+        ("build_history_budgeted", "build_history_budgeted", lambda r, f: lambda: db.build_history_budgeted(f["heavy_conv"], 1500)),
+        ("load_turn_state (random conv)", "load_turn_state", lambda r, f: lambda: db.load_turn_state(conv(r, f))),
+        ("load_turn_state (heavy conv)", "load_turn_state", lambda r, f: lambda: db.load_turn_state(f["heavy_conv"])),
+        ("commit_turn", "commit_turn", lambda r, f: lambda: db.commit_turn(conv(r, f), _sentence(r), _sentence(r))),
+        ("list_messages_between", "list_messages_between", lambda r, f: lambda: db.list_messages_between(f["heavy_conv"], f["heavy_ids"][0], heavy_mid(r, f), limit=100)),
+        ("get_messages_by_ids", "get_messages_by_ids", lambda r, f: lambda: db.get_messages_by_ids(r.sample(f["heavy_ids"], min(3, len(f["heavy_ids"]))))),
+        ("list_message_vectors (heavy, full)", "list_message_vectors", lambda r, f: lambda: db.list_message_vectors(f["heavy_conv"], 0)),
+        ("list_message_vectors (catch-up)", "list_message_vectors", lambda r, f: lambda: db.list_message_vectors(f["heavy_conv"], f["heavy_ids"][-10])),
+        ("search_messages (global)", "search_messages", lambda r, f: lambda: db.search_messages(r.choice(_WORDS), limit=20)),
+        ("search_messages (global, 2 terms)", "search_messages", lambda r, f: lambda: db.search_messages(f"{r.choice(_WORDS)} {r.choice(_WORDS)[:3]}", limit=20)),
+        ("search_messages (conversation)", "search_messages", lambda r, f: lambda: db.search_messages(r.choice(_WORDS), limit=20, conversation_id=f["heavy_conv"])),
+        ("search_messages (global, all history)", "search_messages", lambda r, f: lambda: db.search_messages(r.choice(_WORDS), limit=20, recent_only=False)),
+        ("message_search_truncated", "message_search_truncated", lambda r, f: lambda: db.message_search_truncated(r.choice(_WORDS))),
+        # Résumés
+        ("get_conversation_summary", "get_conversation_summary", lambda r, f: lambda: db.get_conversation_summary(f["summary_conv"])),
+        ("save_conversation_summary", "save_conversation_summary", save_summary),
+        # File de tours
+        ("enqueue_pending_turn", "enqueue_pending_turn", lambda r, f: lambda: new_pending(r, f)),
+        ("register_pending_turn (new key)", "register_pending_turn", register_new),
+        ("register_pending_turn (duplicate)", "register_pending_turn", register_duplicate),
+        ("claim_pending_turn", "claim_pending_turn", claim),
+        ("start_pending_turn", "start_pending_turn", lambda r, f: (lambda pid: lambda: db.start_pending_turn(pid))(
+            int(db.register_pending_turn(conv(r, f), "bench", None, "http://127.0.0.1:8000", status="waiting")[0]["id"])
+        )),
+        ("update_pending_turn_partial", "update_pending_turn_partial", lambda r, f: (lambda pid: lambda: db.update_pending_turn_partial(pid, _sentence(r)))(new_pending(r, f))),
+        ("fail_pending_turn", "fail_pending_turn", lambda r, f: (lambda pid: lambda: db.fail_pending_turn(pid, "bench"))(new_pending(r, f))),
+        ("requeue_stale_pending_turns", "requeue_stale_pending_turns", lambda r, f: lambda: db.requeue_stale_pending_turns(300)),
+        ("list_pending_turns", "list_pending_turns", lambda r, f: lambda: db.list_pending_turns(conv(r, f))),
+        ("get_pending_turn", "get_pending_turn", lambda r, f: (lambda pid: lambda: db.get_pending_turn(pid))(new_pending(r, f))),
+    ]
+
+
+def _time_case(
+    make_call: Callable[[random.Random, Dict[str, Any]], Callable[[], Any]],
+    rng: random.Random,
+    fixtures: Dict[str, Any],
+    min_iterations: int,
+    max_iterations: int,
+    min_time_s: float,
+    max_time_s: float,
+) -> Dict[str, Any]:
+    make_call(rng, fixtures)()  # chauffe (cache de pages, statements préparés)
+    samples: List[float] = []
+    result: Any = None
+    started = time.perf_counter()
+    while len(samples) < max_iterations:
+        elapsed = time.perf_counter() - started
+        if len(samples) >= min_iterations and elapsed >= min_time_s:
+            break
+        if len(samples) >= 3 and elapsed >= max_time_s:
+            break
+        call = make_call(rng, fixtures)
+        t0 = time.perf_counter()
+        result = call()
+        samples.append(time.perf_counter() - t0)
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        result = result[0]
+    return {
+        "iterations": len(samples),
+        "min_ms": round(ordered[0] * 1000, 4),
+        "median_ms": round(statistics.median(ordered) * 1000, 4),
+        "p95_ms": round(p95 * 1000, 4),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "max_ms": round(ordered[-1] * 1000, 4),
+        "rows": len(result) if isinstance(result, list) else None,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    import subprocess
+
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            timeout=5,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_benchmarks(
+    name_filter: Optional[str] = None,
+    min_iterations: int = 20,
+    max_iterations: int = 2000,
+    min_time_s: float = 0.3,
+    max_time_s: float = 5.0,
+    seed: int = 0,
+    progress: Optional[Callable[[str], None]] = None,
+) -> Dict[str, Any]:
+    """Chronomètre les fonctions app.db sur la base courante (db._DB_PATH)."""
+    log = progress or (lambda msg: None)
+    rng = random.Random(seed)
+    db.init_db()
+    fixtures = _fixtures(rng)
+    results: Dict[str, Dict[str, Any]] = {}
+    covered = set()
+    for name, function, make_call in _cases():
+        covered.add(function)
+        if name_filter and name_filter not in name:
+            continue
+        stats = _time_case(make_call, rng, fixtures, min_iterations, max_iterations, min_time_s, max_time_s)
+        results[name] = {"function": function, **stats}
+        log(f"{name:<42} médiane {stats['median_ms']:>9.3f} ms  p95 {stats['p95_ms']:>9.3f} ms  ({stats['iterations']} it.)")
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "db_path": db._DB_PATH,
+            "db_size_mb": round(os.path.getsize(db._DB_PATH) / 1024 / 1024, 1) if os.path.exists(db._DB_PATH) else None,
+            "schema_version": db.get_schema_version(),
+            "tables": table_counts(),
+        },
+        "results": results,
+        "uncovered": sorted(set(public_functions()) - covered - _NOT_BENCHMARKED),
+    }
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any], threshold: float = 1.5, floor_ms: float = 0.05) -> List[Dict[str, Any]]:
+    """Compare les médianes; une régression = ratio > threshold et écart > floor_ms (bruit)."""
+    rows = []
+    for name, cur in current["results"].items():
+        prev = previous.get("results", {}).get(name)
+        if not prev or not prev.get("median_ms"):
+            continue
+        ratio = cur["median_ms"] / prev["median_ms"]
+        rows.append(
+            {
+                "name": name,
+                "previous_ms": prev["median_ms"],
+                "current_ms": cur["median_ms"],
+                "ratio": round(ratio, 2),
+                "regression": ratio > threshold and cur["median_ms"] - prev["median_ms"] > floor_ms,
+            }
+        )
+    return rows
+
+
+def load_report(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -1,160 +1,292 @@
+import inspect
 import json
 import os
+import queue
 import sqlite3
+import threading
 from contextlib import contextmanager
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from app import metrics
+from app import slowlog
+from app import vectors
+from app.history import MAX_HISTORY_MESSAGES, budget_for_mode, estimate_tokens, fit_history
 
 _DB_PATH = os.environ.get("MYFANCRM_DB_PATH") or os.path.join(
     os.path.dirname(os.path.dirname(__file__)),
     "myfancrm.sqlite3",
 )
 
+# Réglages SQLite appliqués une seule fois par connexion (surcharge possible par env)
+_POOL_SIZE = int(os.environ.get("MYFANCRM_DB_POOL_SIZE") or 8)
+_CACHE_SIZE_KB = int(os.environ.get("MYFANCRM_DB_CACHE_KB") or 16384)
+_MMAP_SIZE_MB = int(os.environ.get("MYFANCRM_DB_MMAP_MB") or 256)
+_BUSY_TIMEOUT_MS = int(os.environ.get("MYFANCRM_DB_BUSY_TIMEOUT_MS") or 5000)
+# Recherche plein texte: seuls les N résultats les plus récents sont triés par pertinence
+SEARCH_CANDIDATES = int(os.environ.get("MYFANCRM_SEARCH_CANDIDATES") or 500)
+
+# Callback recevant le SQL (paramètres inclus) de chaque requête exécutée (outils: loadtest, queryplan)
+_statement_tracer: Optional[Callable[[str], None]] = None
+# Appelé avec conversation_id après chaque écriture de messages committée (app.retrieval garde son index chaud)
+_message_listener: Optional[Callable[[int], None]] = None
+
 
 def _utc_now_iso() -> str:
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
 
-@contextmanager
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(_DB_PATH, check_same_thread=False)
+def _open_connection(path: str, readonly: bool) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=_BUSY_TIMEOUT_MS / 1000)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute(f"PRAGMA busy_timeout = {_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {_MMAP_SIZE_MB * 1024 * 1024}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    if slowlog.ENABLED:
+        # Journal des requêtes lentes (MYFANCRM_SLOW_QUERY_MS); appelle aussi _statement_tracer
+        slowlog.attach(conn, _statement_tracer)
+    elif _statement_tracer is not None:
+        conn.set_trace_callback(_statement_tracer)
+    return conn
+
+
+def _close_connection(conn: sqlite3.Connection) -> None:
+    slowlog.detach(conn)
+    conn.close()
+
+
+class _ConnectionPool:
+    """Pool LIFO de connexions SQLite réutilisées entre threads (reruns Streamlit)."""
+
+    def __init__(self, path: str, size: int, readonly: bool = False) -> None:
+        self.path = path
+        self.readonly = readonly
+        self.pid = os.getpid()
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=max(1, size))
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _open_connection(self.path, self.readonly)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        if slowlog.ENABLED:
+            slowlog.finish(conn)
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            _close_connection(conn)
+
+    def close(self) -> None:
+        while True:
+            try:
+                _close_connection(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_pools: Dict[bool, _ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(readonly: bool) -> _ConnectionPool:
+    pool = _pools.get(readonly)
+    # Après un fork (workers), on ne réutilise jamais les connexions du parent
+    if pool is not None and pool.pid == os.getpid() and pool.path == _DB_PATH:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(readonly)
+        if pool is None or pool.pid != os.getpid() or pool.path != _DB_PATH:
+            if pool is not None and pool.pid == os.getpid():
+                pool.close()
+            pool = _ConnectionPool(_DB_PATH, _POOL_SIZE, readonly=readonly)
+            _pools[readonly] = pool
+        return pool
+
+
+def close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            if pool.pid == os.getpid():
+                pool.close()
+        _pools.clear()
+
+
+def set_statement_tracer(tracer: Optional[Callable[[str], None]]) -> None:
+    global _statement_tracer
+    _statement_tracer = tracer
+    # Les connexions déjà dans le pool n'ont pas (ou plus) le callback
+    close_pools()
+
+
+def set_message_listener(listener: Optional[Callable[[int], None]]) -> None:
+    global _message_listener
+    _message_listener = listener
+
+
+def _messages_written(conversation_id: int) -> None:
+    if _message_listener is not None:
+        _message_listener(conversation_id)
+
+
+@contextmanager
+def get_conn() -> Iterator[sqlite3.Connection]:
+    pool = _get_pool(readonly=False)
+    conn = pool.acquire()
     try:
         yield conn
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
+        pool.release(conn)
 
 
-def init_db() -> None:
-    with get_conn() as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+@contextmanager
+def get_read_conn() -> Iterator[sqlite3.Connection]:
+    # Connexion en lecture seule (PRAGMA query_only) pour les listes / lectures
+    pool = _get_pool(readonly=True)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS bots (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                persona_json TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            )
-            """
+
+def _migration_001_base_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            persona_json TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
         )
+        """
+    )
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS scripts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT,
-                bot_id INTEGER,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                FOREIGN KEY(bot_id) REFERENCES bots(id) ON DELETE SET NULL
-            )
-            """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scripts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            bot_id INTEGER,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(bot_id) REFERENCES bots(id) ON DELETE SET NULL
         )
+        """
+    )
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS script_steps (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                script_id INTEGER NOT NULL,
-                position INTEGER NOT NULL,
-                step_type TEXT NOT NULL,
-                title TEXT,
-                script_text TEXT NOT NULL,
-                media_desc TEXT,
-                is_paywall INTEGER NOT NULL DEFAULT 0,
-                price TEXT,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                FOREIGN KEY(script_id) REFERENCES scripts(id) ON DELETE CASCADE
-            )
-            """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS script_steps (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            script_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            step_type TEXT NOT NULL,
+            title TEXT,
+            script_text TEXT NOT NULL,
+            media_desc TEXT,
+            is_paywall INTEGER NOT NULL DEFAULT 0,
+            price TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(script_id) REFERENCES scripts(id) ON DELETE CASCADE
         )
+        """
+    )
 
-        # Migration légère (ajout colonne price)
-        step_cols = {r["name"] for r in conn.execute("PRAGMA table_info(script_steps)")}
-        if "price" not in step_cols:
-            conn.execute("ALTER TABLE script_steps ADD COLUMN price TEXT")
+    # Migration légère (ajout colonne price)
+    step_cols = {r["name"] for r in conn.execute("PRAGMA table_info(script_steps)")}
+    if "price" not in step_cols:
+        conn.execute("ALTER TABLE script_steps ADD COLUMN price TEXT")
 
-        if "title" not in step_cols:
-            conn.execute("ALTER TABLE script_steps ADD COLUMN title TEXT")
+    if "title" not in step_cols:
+        conn.execute("ALTER TABLE script_steps ADD COLUMN title TEXT")
 
-        # Migration logique: si anciennes étapes paywall (is_paywall=1), les convertir en step_type paywall_*
-        conn.execute(
-            """
-            UPDATE script_steps
-            SET step_type = CASE
-                WHEN step_type = 'media_text' THEN 'paywall_media_text'
-                ELSE 'paywall_text'
-            END
-            WHERE is_paywall = 1 AND step_type NOT LIKE 'paywall_%'
-            """
-        )
+    # Migration logique: si anciennes étapes paywall (is_paywall=1), les convertir en step_type paywall_*
+    conn.execute(
+        """
+        UPDATE script_steps
+        SET step_type = CASE
+            WHEN step_type = 'media_text' THEN 'paywall_media_text'
+            ELSE 'paywall_text'
+        END
+        WHERE is_paywall = 1 AND step_type NOT LIKE 'paywall_%'
+        """
+    )
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subscribers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                display_name TEXT,
-                created_at TEXT NOT NULL
-            )
-            """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subscribers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            display_name TEXT,
+            created_at TEXT NOT NULL
         )
+        """
+    )
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                subscriber_id INTEGER NOT NULL,
-                bot_id INTEGER NOT NULL,
-                script_id INTEGER,
-                mode TEXT NOT NULL,
-                current_step INTEGER NOT NULL DEFAULT 1,
-                paywall_unlocked INTEGER NOT NULL DEFAULT 0,
-                script_started INTEGER NOT NULL DEFAULT 0,
-                paywall_counter INTEGER NOT NULL DEFAULT 0,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                FOREIGN KEY(subscriber_id) REFERENCES subscribers(id) ON DELETE CASCADE,
-                FOREIGN KEY(bot_id) REFERENCES bots(id) ON DELETE CASCADE,
-                FOREIGN KEY(script_id) REFERENCES scripts(id) ON DELETE SET NULL
-            )
-            """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subscriber_id INTEGER NOT NULL,
+            bot_id INTEGER NOT NULL,
+            script_id INTEGER,
+            mode TEXT NOT NULL,
+            current_step INTEGER NOT NULL DEFAULT 1,
+            paywall_unlocked INTEGER NOT NULL DEFAULT 0,
+            script_started INTEGER NOT NULL DEFAULT 0,
+            paywall_counter INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(subscriber_id) REFERENCES subscribers(id) ON DELETE CASCADE,
+            FOREIGN KEY(bot_id) REFERENCES bots(id) ON DELETE CASCADE,
+            FOREIGN KEY(script_id) REFERENCES scripts(id) ON DELETE SET NULL
         )
+        """
+    )
 
-        # Migration légère (si DB existante créée avant ces colonnes)
-        cols = {r["name"] for r in conn.execute("PRAGMA table_info(conversations)")}
-        if "script_started" not in cols:
-            conn.execute("ALTER TABLE conversations ADD COLUMN script_started INTEGER NOT NULL DEFAULT 0")
-        if "paywall_counter" not in cols:
-            conn.execute("ALTER TABLE conversations ADD COLUMN paywall_counter INTEGER NOT NULL DEFAULT 0")
+    # Migration légère (si DB existante créée avant ces colonnes)
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(conversations)")}
+    if "script_started" not in cols:
+        conn.execute("ALTER TABLE conversations ADD COLUMN script_started INTEGER NOT NULL DEFAULT 0")
+    if "paywall_counter" not in cols:
+        conn.execute("ALTER TABLE conversations ADD COLUMN paywall_counter INTEGER NOT NULL DEFAULT 0")
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversation_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
-            )
-            """
-        )
-
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_steps_script_pos ON script_steps(script_id, position)"
-        )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_messages_conv_id ON messages(conversation_id, id)"
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
         )
+        """
+    )
 
-        _ensure_single_creator(conn)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_steps_script_pos ON script_steps(script_id, position)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_conv_id ON messages(conversation_id, id)"
+    )
 
 
 def _default_creator_persona() -> Dict[str, Any]:
@@ -196,22 +328,292 @@ def _ensure_single_creator(conn: sqlite3.Connection) -> None:
         )
         conn.execute(f"DELETE FROM bots WHERE id IN ({placeholders})", tuple(other_ids))
 
-    # Normalise le nom affiché
+    # Normalise le nom affiché (sans réécrire une ligne déjà conforme: rejoué à chaque init_db)
+    conn.execute(
+        "UPDATE bots SET name = ?, updated_at = ? WHERE id = ? AND name IS NOT ?",
+        ("Créatrice", now, keep_id, "Créatrice"),
+    )
+
+
+def _migration_003_pending_turns(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pending_turns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            user_msg TEXT NOT NULL,
+            session_id TEXT,
+            api_url TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            partial TEXT NOT NULL DEFAULT '',
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_pending_turns_status ON pending_turns(status, id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_pending_turns_conv ON pending_turns(conversation_id, status)"
+    )
+
+
+def _migration_004_conversation_list_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at, id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_subscriber ON conversations(subscriber_id, updated_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscribers_username_nocase ON subscribers(username COLLATE NOCASE)"
+    )
+
+
+def _migration_005_conversation_summaries(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            conversation_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+
+def _migration_006_message_vectors(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_vectors (
+            message_id INTEGER PRIMARY KEY,
+            conversation_id INTEGER NOT NULL,
+            terms BLOB NOT NULL,
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_vectors_conv ON message_vectors(conversation_id, message_id)"
+    )
+    # Backfill des messages existants, par lots
+    last_id = 0
+    while True:
+        rows = list(
+            conn.execute(
+                "SELECT id, conversation_id, content FROM messages WHERE id > ? ORDER BY id ASC LIMIT 5000",
+                (last_id,),
+            )
+        )
+        if not rows:
+            break
+        conn.executemany(
+            "INSERT OR IGNORE INTO message_vectors(message_id, conversation_id, terms) VALUES(?, ?, ?)",
+            [(r["id"], r["conversation_id"], vectors.pack(vectors.term_counts(r["content"]))) for r in rows],
+        )
+        last_id = int(rows[-1]["id"])
+
+
+def _fts5_available(conn: sqlite3.Connection) -> bool:
+    return any(r[0] == "ENABLE_FTS5" for r in conn.execute("PRAGMA compile_options"))
+
+
+def _migration_007_fulltext_search(conn: sqlite3.Connection) -> None:
+    # Sans FTS5 (build SQLite minimal), les fonctions search_* retombent sur un LIKE
+    if not _fts5_available(conn):
+        return
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            content='messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """
+    )
+
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS script_steps_fts USING fts5(
+            title,
+            script_text,
+            content='script_steps',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS script_steps_fts_ai AFTER INSERT ON script_steps BEGIN
+            INSERT INTO script_steps_fts(rowid, title, script_text) VALUES (new.id, new.title, new.script_text);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS script_steps_fts_ad AFTER DELETE ON script_steps BEGIN
+            INSERT INTO script_steps_fts(script_steps_fts, rowid, title, script_text)
+            VALUES ('delete', old.id, old.title, old.script_text);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS script_steps_fts_au AFTER UPDATE OF title, script_text ON script_steps BEGIN
+            INSERT INTO script_steps_fts(script_steps_fts, rowid, title, script_text)
+            VALUES ('delete', old.id, old.title, old.script_text);
+            INSERT INTO script_steps_fts(rowid, title, script_text) VALUES (new.id, new.title, new.script_text);
+        END
+        """
+    )
+
+    # Backfill des lignes existantes
+    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO script_steps_fts(script_steps_fts) VALUES ('rebuild')")
+
+
+def _migration_008_listing_and_fk_indexes(conn: sqlite3.Connection) -> None:
+    # Listes triées par date (sans tri temporaire)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscribers_created ON subscribers(created_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bots_updated ON bots(updated_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scripts_updated ON scripts(updated_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scripts_bot_updated ON scripts(bot_id, updated_at, id)")
+    # Clés étrangères: sans index, supprimer un bot/script parcourt toutes les conversations
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_bot ON conversations(bot_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_script ON conversations(script_id)")
+    # Tours actifs d'une conversation, déjà dans l'ordre (index partiel: reste minuscule)
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_pending_turns_active
+        ON pending_turns(conversation_id, id) WHERE status IN ('pending', 'running')
+        """
+    )
+
+
+def _migration_009_pending_turn_idempotency(conn: sqlite3.Connection) -> None:
+    # Double envoi (entrée x2, reruns concurrents, retry client API): un seul tour par clé,
+    # garanti par SQLite donc aussi entre process
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(pending_turns)")}
+    if "idempotency_key" not in cols:
+        conn.execute("ALTER TABLE pending_turns ADD COLUMN idempotency_key TEXT")
     conn.execute(
-        "UPDATE bots SET name = ?, updated_at = ? WHERE id = ?",
-        ("Créatrice", now, keep_id),
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_turns_idempotency
+        ON pending_turns(conversation_id, idempotency_key) WHERE idempotency_key IS NOT NULL
+        """
     )
 
 
+# --- Migrations ---
+# Chaque étape est numérotée par sa position (PRAGMA user_version = n une fois appliquée).
+# Ne jamais modifier/réordonner une étape déjà livrée: en ajouter une nouvelle à la fin.
+
+_MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migration_001_base_schema,
+    _ensure_single_creator,
+    _migration_003_pending_turns,
+    _migration_004_conversation_list_indexes,
+    _migration_005_conversation_summaries,
+    _migration_006_message_vectors,
+    _migration_007_fulltext_search,
+    _migration_008_listing_and_fk_indexes,
+    _migration_009_pending_turn_idempotency,
+]
+
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+# Chemins DB déjà migrés dans ce process (fast path des reruns Streamlit)
+_migrated_paths: Set[str] = set()
+_migrate_lock = threading.Lock()
+
+
+def get_schema_version() -> int:
+    with get_read_conn() as conn:
+        return int(conn.execute("PRAGMA user_version").fetchone()[0])
+
+
+def migrate() -> List[int]:
+    applied: List[int] = []
+    with _migrate_lock:
+        with get_conn() as conn:
+            for version, step in enumerate(_MIGRATIONS, start=1):
+                # BEGIN IMMEDIATE: un seul process applique une étape donnée
+                conn.execute("BEGIN IMMEDIATE")
+                current = int(conn.execute("PRAGMA user_version").fetchone()[0])
+                if current >= version:
+                    conn.rollback()
+                    continue
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+                applied.append(version)
+        _ensure_invariants()
+        _migrated_paths.add(_DB_PATH)
+    return applied
+
+
+def _ensure_invariants() -> None:
+    # Rejoué à chaque init_db (une fois par process et par base), pas seulement à la migration:
+    # étapes idempotentes dont le résultat peut disparaître ou manquer après coup
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _ensure_single_creator(conn)
+        if _fts5_available(conn) and not (_has_fts(conn, "messages_fts") and _has_fts(conn, "script_steps_fts")):
+            # Base migrée par un SQLite sans FTS5 (étape 7 sautée): tables créées dès que FTS5 est là
+            _migration_007_fulltext_search(conn)
+
+
+def init_db() -> None:
+    if _DB_PATH in _migrated_paths:
+        return
+    if get_schema_version() < SCHEMA_VERSION:
+        migrate()
+        return
+    with _migrate_lock:
+        _ensure_invariants()
+        _migrated_paths.add(_DB_PATH)
+
+
 # --- Bots ---
 
 def list_bots() -> List[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return list(conn.execute("SELECT * FROM bots ORDER BY updated_at DESC, id DESC"))
 
 
 def get_bot(bot_id: int) -> Optional[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return conn.execute("SELECT * FROM bots WHERE id = ?", (bot_id,)).fetchone()
 
 
@@ -265,12 +667,12 @@ def parse_persona_json(bot_row: sqlite3.Row) -> Dict[str, Any]:
 # --- Scripts ---
 
 def list_scripts() -> List[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return list(conn.execute("SELECT * FROM scripts ORDER BY updated_at DESC, id DESC"))
 
 
 def list_scripts_for_bot(bot_id: int) -> List[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return list(
             conn.execute(
                 "SELECT * FROM scripts WHERE bot_id = ? ORDER BY updated_at DESC, id DESC",
@@ -280,7 +682,7 @@ def list_scripts_for_bot(bot_id: int) -> List[sqlite3.Row]:
 
 
 def get_script(script_id: int) -> Optional[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return conn.execute("SELECT * FROM scripts WHERE id = ?", (script_id,)).fetchone()
 
 
@@ -308,7 +710,7 @@ def delete_script(script_id: int) -> None:
 # --- Steps ---
 
 def list_steps(script_id: int) -> List[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return list(
             conn.execute(
                 "SELECT * FROM script_steps WHERE script_id = ? ORDER BY position ASC",
@@ -404,12 +806,12 @@ def move_step(script_id: int, step_id: int, direction: str) -> None:
 # --- Subscribers ---
 
 def list_subscribers() -> List[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return list(conn.execute("SELECT * FROM subscribers ORDER BY created_at DESC, id DESC"))
 
 
 def get_subscriber(subscriber_id: int) -> Optional[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return conn.execute("SELECT * FROM subscribers WHERE id = ?", (subscriber_id,)).fetchone()
 
 
@@ -456,29 +858,62 @@ def delete_subscriber(subscriber_id: int) -> None:
         conn.execute("DELETE FROM subscribers WHERE id = ?", (subscriber_id,))
 
 
+_CONVERSATION_LIST_SELECT = """
+    SELECT
+        c.*,
+        s.username AS subscriber_username,
+        COALESCE(s.display_name, '') AS subscriber_display_name,
+        b.name AS bot_name,
+        COALESCE(sc.name, '') AS script_name
+    FROM conversations c
+    JOIN subscribers s ON s.id = c.subscriber_id
+    JOIN bots b ON b.id = c.bot_id
+    LEFT JOIN scripts sc ON sc.id = c.script_id
+"""
+
+
 def list_conversations() -> List[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return list(
-            conn.execute(
-                """
-                SELECT
-                    c.*, 
-                    s.username AS subscriber_username,
-                    COALESCE(s.display_name, '') AS subscriber_display_name,
-                    b.name AS bot_name,
-                    COALESCE(sc.name, '') AS script_name
-                FROM conversations c
-                JOIN subscribers s ON s.id = c.subscriber_id
-                JOIN bots b ON b.id = c.bot_id
-                LEFT JOIN scripts sc ON sc.id = c.script_id
-                ORDER BY c.updated_at DESC, c.id DESC
-                """
-            )
+            conn.execute(_CONVERSATION_LIST_SELECT + " ORDER BY c.updated_at DESC, c.id DESC")
         )
 
 
+ConversationCursor = Tuple[str, int]
+
+
+def list_conversations_page(
+    limit: int = 25,
+    cursor: Optional[ConversationCursor] = None,
+    username_prefix: Optional[str] = None,
+) -> Tuple[List[sqlite3.Row], Optional[ConversationCursor]]:
+    # Pagination keyset sur (updated_at, id) décroissants; renvoie (page, curseur suivant ou None)
+    where: List[str] = []
+    params: List[Any] = []
+    if cursor is not None:
+        # Comparaison de row values: SQLite parcourt l'index sans tri temporaire
+        where.append("(c.updated_at, c.id) < (?, ?)")
+        params.extend([cursor[0], int(cursor[1])])
+    prefix = (username_prefix or "").strip()
+    if prefix:
+        # Plage sur l'index NOCASE plutôt qu'un LIKE (qui ne l'utiliserait pas)
+        where.append("s.username >= ? COLLATE NOCASE AND s.username < ? COLLATE NOCASE")
+        params.extend([prefix, prefix + "\U0010ffff"])
+    sql = _CONVERSATION_LIST_SELECT
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY c.updated_at DESC, c.id DESC LIMIT ?"
+    params.append(int(limit) + 1)
+    with get_read_conn() as conn:
+        rows = list(conn.execute(sql, params))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (str(rows[-1]["updated_at"]), int(rows[-1]["id"]))
+
+
 def get_default_bot_id() -> Optional[int]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         row = conn.execute("SELECT id FROM bots ORDER BY updated_at DESC, id DESC LIMIT 1").fetchone()
         return int(row["id"]) if row else None
 
@@ -501,11 +936,11 @@ def get_or_create_conversation(
         row = conn.execute(
             """
             SELECT * FROM conversations
-            WHERE subscriber_id = ? AND bot_id = ? AND mode = ? AND (script_id IS ? OR script_id = ?)
+            WHERE subscriber_id = ? AND bot_id = ? AND mode = ? AND script_id IS ?
             ORDER BY updated_at DESC, id DESC
             LIMIT 1
             """,
-            (subscriber_id, bot_id, mode, script_id, script_id),
+            (subscriber_id, bot_id, mode, script_id),
         ).fetchone()
         if row:
             return int(row["id"])
@@ -520,7 +955,7 @@ def get_or_create_conversation(
 
 
 def get_conversation(conversation_id: int) -> Optional[sqlite3.Row]:
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         return conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
 
 
@@ -593,10 +1028,43 @@ def increment_paywall_counter(conversation_id: int) -> int:
         return new_val
 
 
+def lock_script(conversation_id: int) -> None:
+    # "Lock": démarre le script à l'étape 1, paywall verrouillé, compteur à zéro
+    now = _utc_now_iso()
+    with get_conn() as conn:
+        conn.execute(
+            """
+            UPDATE conversations
+            SET script_started = 1, current_step = 1, paywall_unlocked = 0, paywall_counter = 0, updated_at = ?
+            WHERE id = ?
+            """,
+            (now, conversation_id),
+        )
+
+
+def unlock_paywall(conversation_id: int) -> None:
+    # "Payer": débloque l'étape courante et remet le compteur de relance à zéro
+    now = _utc_now_iso()
+    with get_conn() as conn:
+        conn.execute(
+            "UPDATE conversations SET paywall_unlocked = 1, paywall_counter = 0, updated_at = ? WHERE id = ?",
+            (now, conversation_id),
+        )
+
+
+def get_latest_conversation_for_subscriber(subscriber_id: int) -> Optional[sqlite3.Row]:
+    with get_read_conn() as conn:
+        return conn.execute(
+            "SELECT * FROM conversations WHERE subscriber_id = ? ORDER BY updated_at DESC, id DESC LIMIT 1",
+            (subscriber_id,),
+        ).fetchone()
+
+
 def reset_conversation(conversation_id: int) -> None:
     now = _utc_now_iso()
     with get_conn() as conn:
         conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        conn.execute("DELETE FROM conversation_summaries WHERE conversation_id = ?", (conversation_id,))
         conn.execute(
             "UPDATE conversations SET current_step = 1, paywall_unlocked = 0, script_started = 0, paywall_counter = 0, updated_at = ? WHERE id = ?",
             (now, conversation_id),
@@ -605,24 +1073,59 @@ def reset_conversation(conversation_id: int) -> None:
 
 # --- Messages ---
 
+def _insert_message(conn: sqlite3.Connection, conversation_id: int, role: str, content: str, now: str) -> int:
+    # Message + son vecteur de termes (index de rappel long terme) dans la même transaction
+    cur = conn.execute(
+        "INSERT INTO messages(conversation_id, role, content, created_at) VALUES(?, ?, ?, ?)",
+        (conversation_id, role, content, now),
+    )
+    message_id = int(cur.lastrowid)
+    conn.execute(
+        "INSERT INTO message_vectors(message_id, conversation_id, terms) VALUES(?, ?, ?)",
+        (message_id, conversation_id, vectors.pack(vectors.term_counts(content))),
+    )
+    return message_id
+
+
 def add_message(conversation_id: int, role: str, content: str) -> int:
     now = _utc_now_iso()
     with get_conn() as conn:
-        cur = conn.execute(
-            "INSERT INTO messages(conversation_id, role, content, created_at) VALUES(?, ?, ?, ?)",
-            (conversation_id, role, content, now),
-        )
-        return int(cur.lastrowid)
+        message_id = _insert_message(conn, conversation_id, role, content, now)
+    _messages_written(conversation_id)
+    return message_id
 
 
-def list_messages(conversation_id: int, limit: int = 100) -> List[sqlite3.Row]:
-    with get_conn() as conn:
-        rows = list(
-            conn.execute(
-                "SELECT * FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
-                (conversation_id, limit),
+def list_messages(
+    conversation_id: int,
+    limit: int = 100,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> List[sqlite3.Row]:
+    # Toujours renvoyé en ordre chronologique.
+    # after_id: les `limit` premiers messages après ce curseur (chargement incrémental);
+    # sinon les `limit` derniers, éventuellement avant before_id ("charger plus ancien").
+    with get_read_conn() as conn:
+        if after_id is not None:
+            return list(
+                conn.execute(
+                    "SELECT * FROM messages WHERE conversation_id = ? AND id > ? ORDER BY id ASC LIMIT ?",
+                    (conversation_id, int(after_id), limit),
+                )
+            )
+        if before_id is not None:
+            rows = list(
+                conn.execute(
+                    "SELECT * FROM messages WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (conversation_id, int(before_id), limit),
+                )
+            )
+        else:
+            rows = list(
+                conn.execute(
+                    "SELECT * FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                    (conversation_id, limit),
+                )
             )
-        )
         return list(reversed(rows))
 
 
@@ -632,3 +1135,565 @@ def build_history(conversation_id: int, limit: int = 20) -> List[Dict[str, Any]]
     for r in rows:
         history.append({"role": r["role"], "content": r["content"]})
     return history
+
+
+def _iter_messages_newest_first(conn: sqlite3.Connection, conversation_id: int) -> Iterator[sqlite3.Row]:
+    # Curseur paresseux: fit_history arrête la lecture dès que le budget est plein
+    return iter(
+        conn.execute(
+            "SELECT id, role, content FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+            (conversation_id, MAX_HISTORY_MESSAGES + 1),
+        )
+    )
+
+
+def build_history_budgeted(
+    conversation_id: int,
+    max_tokens: int,
+    max_message_tokens: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    with get_read_conn() as conn:
+        return fit_history(
+            _iter_messages_newest_first(conn, conversation_id),
+            max_tokens,
+            max_message_tokens=max_message_tokens,
+        )
+
+
+# --- Tours de conversation (lecture unique / écriture unique) ---
+
+def load_turn_state(
+    conversation_id: int,
+    history_budgets: Optional[Dict[str, int]] = None,
+) -> Optional[Dict[str, Any]]:
+    # Un seul snapshot de lecture: conversation, persona, étapes et historique (budget selon le mode)
+    with get_read_conn() as conn:
+        conn.execute("BEGIN")
+        try:
+            conv = conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            if not conv:
+                return None
+            bot = conn.execute("SELECT * FROM bots WHERE id = ?", (conv["bot_id"],)).fetchone()
+            steps: List[sqlite3.Row] = []
+            if conv["mode"] == "script" and conv["script_id"]:
+                steps = list(
+                    conn.execute(
+                        "SELECT * FROM script_steps WHERE script_id = ? ORDER BY position ASC",
+                        (conv["script_id"],),
+                    )
+                )
+            summary = conn.execute(
+                "SELECT * FROM conversation_summaries WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+            # Le résumé roulant consomme une part du budget d'historique
+            budget = budget_for_mode(conv["mode"], history_budgets)
+            if summary:
+                budget = max(0, budget - estimate_tokens(summary["summary"]))
+            history, history_report = fit_history(
+                _iter_messages_newest_first(conn, conversation_id),
+                budget,
+            )
+        finally:
+            conn.rollback()
+    return {
+        "conversation": conv,
+        "persona_data": parse_persona_json(bot) if bot else {},
+        "steps": steps,
+        "history": history,
+        "history_report": history_report,
+        "summary": summary,
+    }
+
+
+# Colonnes comparées avant d'écrire la progression d'un tour (compare-and-set)
+STATE_GUARD_COLUMNS = ("mode", "script_id", "script_started", "current_step", "paywall_unlocked", "paywall_counter")
+
+
+def _state_guard(expected: Optional[Dict[str, Any]]) -> Tuple[str, List[Any]]:
+    if not expected:
+        return "", []
+    columns = [c for c in STATE_GUARD_COLUMNS if c in expected]
+    # IS: script_id peut être NULL
+    return "".join(f" AND {c} IS ?" for c in columns), [expected[c] for c in columns]
+
+
+def commit_turn(
+    conversation_id: int,
+    user_content: str,
+    assistant_content: str,
+    state: Optional[Dict[str, Any]] = None,
+    user_role: str = "user",
+    pending_turn_id: Optional[int] = None,
+    expected: Optional[Dict[str, Any]] = None,
+) -> Tuple[int, int]:
+    """Messages user + assistant et progression du script dans une seule transaction.
+
+    `expected`: état de la conversation lu au moment du plan (voir engine.plan_turn). Si l'opérateur
+    l'a modifié pendant la génération (Payer, Lock, changement de mode ou de script), la progression
+    calculée sur l'ancien état n'est pas écrite: les messages sont committés, l'état reste le sien.
+    """
+    now = _utc_now_iso()
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        user_message_id = _insert_message(conn, conversation_id, user_role, user_content, now)
+        assistant_message_id = _insert_message(conn, conversation_id, "assistant", assistant_content, now)
+        updated = 0
+        if state:
+            where, guard = _state_guard(expected)
+            updated = conn.execute(
+                f"""
+                UPDATE conversations
+                SET current_step = ?, paywall_unlocked = ?, paywall_counter = ?, updated_at = ?
+                WHERE id = ?{where}
+                """,
+                (
+                    int(state["current_step"]),
+                    1 if state["paywall_unlocked"] else 0,
+                    int(state["paywall_counter"]),
+                    now,
+                    conversation_id,
+                    *guard,
+                ),
+            ).rowcount
+        if not updated:
+            conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (now, conversation_id))
+        if pending_turn_id is not None:
+            conn.execute(
+                "UPDATE pending_turns SET status = 'done', result = ?, finished_at = ? WHERE id = ?",
+                (assistant_content, now, pending_turn_id),
+            )
+    _messages_written(conversation_id)
+    return user_message_id, assistant_message_id
+
+
+# --- File de tours en attente (traités par app.worker) ---
+
+def enqueue_pending_turn(
+    conversation_id: int,
+    user_msg: str,
+    session_id: Optional[str],
+    api_url: str,
+    idempotency_key: Optional[str] = None,
+) -> int:
+    row, _ = register_pending_turn(conversation_id, user_msg, session_id, api_url, idempotency_key=idempotency_key)
+    return int(row["id"])
+
+
+def register_pending_turn(
+    conversation_id: int,
+    user_msg: str,
+    session_id: Optional[str],
+    api_url: str,
+    idempotency_key: Optional[str] = None,
+    status: str = "pending",
+) -> Tuple[sqlite3.Row, bool]:
+    """Insère le tour, ou renvoie celui qui porte déjà la même clé: (ligne, créé).
+
+    status="waiting": tour exécuté directement par l'appelant (API), jamais réclamé par le worker;
+    l'appelant le démarre avec start_pending_turn().
+    Un tour en 'error' (exception avant tout commit) peut être rejoué avec la même clé.
+    """
+    now = _utc_now_iso()
+    started_at = now if status == "running" else None
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.execute(
+            """
+            INSERT INTO pending_turns(
+                conversation_id, user_msg, session_id, api_url, status, created_at, started_at, idempotency_key
+            )
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(conversation_id, idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+            """,
+            (conversation_id, user_msg, session_id, api_url, status, now, started_at, idempotency_key),
+        )
+        if cur.rowcount:
+            return conn.execute("SELECT * FROM pending_turns WHERE id = ?", (cur.lastrowid,)).fetchone(), True
+        row = conn.execute(
+            "SELECT * FROM pending_turns WHERE conversation_id = ? AND idempotency_key = ?",
+            (conversation_id, idempotency_key),
+        ).fetchone()
+        if row["status"] != "error":
+            return row, False
+        conn.execute(
+            """
+            UPDATE pending_turns
+            SET user_msg = ?, session_id = ?, api_url = ?, status = ?, partial = '', error = NULL,
+                created_at = ?, started_at = ?, finished_at = NULL
+            WHERE id = ?
+            """,
+            (user_msg, session_id, api_url, status, now, started_at, row["id"]),
+        )
+        return conn.execute("SELECT * FROM pending_turns WHERE id = ?", (row["id"],)).fetchone(), True
+
+
+def claim_pending_turn() -> Optional[sqlite3.Row]:
+    # Plus ancien tour en attente dont la conversation n'a pas déjà un tour en cours
+    # (les tours d'une même conversation restent séquentiels, y compris entre process)
+    now = _utc_now_iso()
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            """
+            SELECT p.* FROM pending_turns p
+            WHERE p.status = 'pending'
+              AND NOT EXISTS (
+                SELECT 1 FROM pending_turns r
+                WHERE r.conversation_id = p.conversation_id AND r.status = 'running'
+              )
+            ORDER BY p.id ASC
+            LIMIT 1
+            """
+        ).fetchone()
+        if not row:
+            return None
+        conn.execute(
+            "UPDATE pending_turns SET status = 'running', started_at = ? WHERE id = ?",
+            (now, row["id"]),
+        )
+        return row
+
+
+def start_pending_turn(pending_turn_id: int) -> bool:
+    # Tour 'waiting' (API) -> 'running', seulement si sa conversation n'a aucun tour en cours
+    # (même règle que claim_pending_turn: worker et API ne génèrent jamais en parallèle)
+    now = _utc_now_iso()
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.execute(
+            """
+            UPDATE pending_turns SET status = 'running', started_at = ?
+            WHERE id = ? AND status = 'waiting'
+              AND NOT EXISTS (
+                SELECT 1 FROM pending_turns r
+                WHERE r.conversation_id = pending_turns.conversation_id AND r.status = 'running'
+              )
+            """,
+            (now, pending_turn_id),
+        )
+        return bool(cur.rowcount)
+
+
+def update_pending_turn_partial(pending_turn_id: int, partial: str) -> None:
+    with get_conn() as conn:
+        conn.execute(
+            "UPDATE pending_turns SET partial = ? WHERE id = ? AND status = 'running'",
+            (partial, pending_turn_id),
+        )
+
+
+def fail_pending_turn(pending_turn_id: int, error: str) -> None:
+    now = _utc_now_iso()
+    with get_conn() as conn:
+        conn.execute(
+            # Jamais un tour déjà 'done': ses messages sont committés, la clé ne doit pas être rejouée
+            """
+            UPDATE pending_turns SET status = 'error', error = ?, finished_at = ?
+            WHERE id = ? AND status IN ('waiting', 'pending', 'running')
+            """,
+            (error, now, pending_turn_id),
+        )
+
+
+def requeue_stale_pending_turns(stale_after_s: int) -> int:
+    # Tours restés 'running' après un crash de worker: on les remet en file
+    cutoff = (
+        datetime.now(timezone.utc).replace(microsecond=0) - timedelta(seconds=stale_after_s)
+    ).isoformat()
+    with get_conn() as conn:
+        cur = conn.execute(
+            "UPDATE pending_turns SET status = 'pending', partial = '' WHERE status = 'running' AND started_at < ?",
+            (cutoff,),
+        )
+        return int(cur.rowcount)
+
+
+def list_pending_turns(conversation_id: int) -> List[sqlite3.Row]:
+    with get_read_conn() as conn:
+        return list(
+            conn.execute(
+                """
+                SELECT * FROM pending_turns
+                WHERE conversation_id = ? AND status IN ('pending', 'running')
+                ORDER BY id ASC
+                """,
+                (conversation_id,),
+            )
+        )
+
+
+def get_pending_turn(pending_turn_id: int) -> Optional[sqlite3.Row]:
+    with get_read_conn() as conn:
+        return conn.execute("SELECT * FROM pending_turns WHERE id = ?", (pending_turn_id,)).fetchone()
+
+
+# --- Résumés roulants ---
+
+def get_conversation_summary(conversation_id: int) -> Optional[sqlite3.Row]:
+    with get_read_conn() as conn:
+        return conn.execute(
+            "SELECT * FROM conversation_summaries WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+
+
+def list_messages_between(
+    conversation_id: int,
+    after_id: int,
+    upto_id: int,
+    limit: int = 100,
+) -> List[sqlite3.Row]:
+    with get_read_conn() as conn:
+        return list(
+            conn.execute(
+                """
+                SELECT * FROM messages
+                WHERE conversation_id = ? AND id > ? AND id <= ?
+                ORDER BY id ASC
+                LIMIT ?
+                """,
+                (conversation_id, int(after_id), int(upto_id), limit),
+            )
+        )
+
+
+def save_conversation_summary(
+    conversation_id: int,
+    summary: str,
+    last_message_id: int,
+    expected_last_message_id: int,
+) -> bool:
+    # Écriture optimiste: si un autre worker a déjà avancé le résumé, on abandonne
+    now = _utc_now_iso()
+    with get_conn() as conn:
+        if expected_last_message_id == 0:
+            cur = conn.execute(
+                """
+                INSERT INTO conversation_summaries(conversation_id, summary, last_message_id, updated_at)
+                VALUES(?, ?, ?, ?)
+                ON CONFLICT(conversation_id) DO NOTHING
+                """,
+                (conversation_id, summary, int(last_message_id), now),
+            )
+        else:
+            cur = conn.execute(
+                """
+                UPDATE conversation_summaries
+                SET summary = ?, last_message_id = ?, updated_at = ?
+                WHERE conversation_id = ? AND last_message_id = ?
+                """,
+                (summary, int(last_message_id), now, conversation_id, int(expected_last_message_id)),
+            )
+        return cur.rowcount == 1
+
+
+# --- Index de rappel (app.retrieval) ---
+
+def list_message_vectors(conversation_id: int, after_message_id: int = 0) -> List[sqlite3.Row]:
+    with get_read_conn() as conn:
+        return list(
+            conn.execute(
+                """
+                SELECT message_id, terms FROM message_vectors
+                WHERE conversation_id = ? AND message_id > ?
+                ORDER BY message_id ASC
+                """,
+                (conversation_id, int(after_message_id)),
+            )
+        )
+
+
+def get_messages_by_ids(message_ids: List[int]) -> List[sqlite3.Row]:
+    if not message_ids:
+        return []
+    placeholders = ",".join(["?"] * len(message_ids))
+    with get_read_conn() as conn:
+        return list(
+            conn.execute(
+                f"SELECT * FROM messages WHERE id IN ({placeholders}) ORDER BY id ASC",
+                tuple(int(i) for i in message_ids),
+            )
+        )
+
+
+# --- Recherche plein texte (FTS5) ---
+
+def _fts_query(text: str) -> str:
+    # Chaque mot devient une chaîne FTS5 littérale (pas d'injection de syntaxe MATCH);
+    # le dernier mot est en préfixe pour la recherche au fil de la frappe.
+    terms = ['"' + t.replace('"', '""') + '"' for t in (text or "").split()]
+    if not terms:
+        return ""
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def _has_fts(conn: sqlite3.Connection, table: str) -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row is not None
+
+
+def _like_pattern(text: str) -> str:
+    # Sous-chaîne littérale pour LIKE ... ESCAPE '\' (% et _ tapés par l'utilisateur ne sont pas des jokers)
+    escaped = text.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def search_messages(
+    query: str,
+    limit: int = 20,
+    offset: int = 0,
+    conversation_id: Optional[int] = None,
+    recent_only: bool = True,
+) -> List[sqlite3.Row]:
+    """Messages correspondant à `query`, par pertinence.
+
+    Recherche globale avec recent_only=True (par défaut): seuls les MYFANCRM_SEARCH_CANDIDATES
+    résultats les plus récents sont classés (voir message_search_truncated). recent_only=False
+    cherche dans tout l'historique, au prix d'un tri de tous les résultats du MATCH.
+    """
+    fts = _fts_query(query)
+    if not fts:
+        return []
+    params: List[Any] = []
+    with get_read_conn() as conn:
+        if _has_fts(conn, "messages_fts"):
+            sql = """
+                SELECT
+                    m.id AS message_id,
+                    m.conversation_id,
+                    m.role,
+                    m.created_at,
+                    s.username AS subscriber_username,
+                    snippet(messages_fts, 0, '**', '**', '…', 12) AS snippet
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                JOIN conversations c ON c.id = m.conversation_id
+                JOIN subscribers s ON s.id = c.subscriber_id
+                WHERE messages_fts MATCH ?
+            """
+            params.append(fts)
+            if conversation_id is not None:
+                # Le MATCH porte sur tout l'index, le filtre conversation ne vient qu'après: on le
+                # restreint à la plage d'ids de la conversation (bornes lues sur idx_messages_conv_id).
+                # FTS5 ne parcourt que cette plage, qui reste large pour une conversation longue et
+                # ancienne (les messages des autres conversations de la plage sont évalués aussi).
+                sql += """
+                    AND messages_fts.rowid BETWEEN
+                        (SELECT min(id) FROM messages WHERE conversation_id = ?)
+                        AND (SELECT max(id) FROM messages WHERE conversation_id = ?)
+                """
+                params.extend([int(conversation_id), int(conversation_id)])
+            elif recent_only:
+                # Candidats bornés: rowid du N-ième MATCH le plus récent (parcours FTS5 par rowid
+                # décroissant, arrêté à N), rank calculé seulement au-delà. Sans borne, un mot fréquent
+                # faisait trier des milliers de résultats pour n'en afficher que 10.
+                sql += """
+                    AND messages_fts.rowid >= COALESCE((
+                        SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?
+                        ORDER BY rowid DESC LIMIT 1 OFFSET ?
+                    ), 0)
+                """
+                params.extend([fts, max(0, SEARCH_CANDIDATES - 1)])
+            # Départage stable pour que la pagination par offset ne saute/répète rien
+            order = " ORDER BY rank, m.id DESC"
+        else:
+            sql = """
+                SELECT
+                    m.id AS message_id,
+                    m.conversation_id,
+                    m.role,
+                    m.created_at,
+                    s.username AS subscriber_username,
+                    substr(m.content, 1, 160) AS snippet
+                FROM messages m
+                JOIN conversations c ON c.id = m.conversation_id
+                JOIN subscribers s ON s.id = c.subscriber_id
+                WHERE m.content LIKE ? ESCAPE '\\'
+            """
+            params.append(_like_pattern(query))
+            order = " ORDER BY m.id DESC"
+        if conversation_id is not None:
+            sql += " AND m.conversation_id = ?"
+            params.append(int(conversation_id))
+        sql += order + " LIMIT ? OFFSET ?"
+        params.extend([int(limit), int(offset)])
+        return list(conn.execute(sql, params))
+
+
+def message_search_truncated(query: str) -> bool:
+    # Vrai si la recherche globale recent_only laisse de côté des résultats plus anciens
+    fts = _fts_query(query)
+    if not fts:
+        return False
+    with get_read_conn() as conn:
+        if not _has_fts(conn, "messages_fts"):
+            return False
+        row = conn.execute(
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (fts, SEARCH_CANDIDATES),
+        ).fetchone()
+        return row is not None
+
+
+def search_script_steps(query: str, limit: int = 20, offset: int = 0) -> List[sqlite3.Row]:
+    fts = _fts_query(query)
+    if not fts:
+        return []
+    with get_read_conn() as conn:
+        if _has_fts(conn, "script_steps_fts"):
+            return list(
+                conn.execute(
+                    """
+                    SELECT
+                        st.id AS step_id,
+                        st.script_id,
+                        st.position,
+                        st.step_type,
+                        sc.name AS script_name,
+                        snippet(script_steps_fts, 1, '**', '**', '…', 12) AS snippet
+                    FROM script_steps_fts
+                    JOIN script_steps st ON st.id = script_steps_fts.rowid
+                    JOIN scripts sc ON sc.id = st.script_id
+                    WHERE script_steps_fts MATCH ?
+                    ORDER BY rank, st.id
+                    LIMIT ? OFFSET ?
+                    """,
+                    (fts, int(limit), int(offset)),
+                )
+            )
+        like = _like_pattern(query)
+        return list(
+            conn.execute(
+                """
+                SELECT
+                    st.id AS step_id,
+                    st.script_id,
+                    st.position,
+                    st.step_type,
+                    sc.name AS script_name,
+                    substr(st.script_text, 1, 160) AS snippet
+                FROM script_steps st
+                JOIN scripts sc ON sc.id = st.script_id
+                WHERE st.script_text LIKE ? ESCAPE '\\' OR st.title LIKE ? ESCAPE '\\'
+                ORDER BY st.script_id, st.position
+                LIMIT ? OFFSET ?
+                """,
+                (like, like, int(limit), int(offset)),
+            )
+        )
+
+
+# --- Métriques ---
+# Span (app.metrics) autour de chaque fonction publique, y compris celles ajoutées plus tard
+
+def _instrument_public_functions() -> None:
+    skip = {"get_conn", "get_read_conn", "close_pools", "set_statement_tracer", "set_message_listener"}
+    for name, fn in list(globals().items()):
+        if name.startswith("_") or name in skip or not inspect.isfunction(fn) or fn.__module__ != __name__:
+            continue
+        globals()[name] = metrics.instrument_db(fn)
+
+
+_instrument_public_functions()
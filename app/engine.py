@@ -0,0 +1,279 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app import db
+from app import governor
+from app import history
+from app import metrics
+from app import retrieval
+from app import sinhome_client
+from app import summaries
+from app.sinhome_client import SinhomeClientError
+
+PAYWALL_MARKER = "[[PAYWALL::"
+# Préfixe du message assistant committé quand Sinhome_llm est en erreur
+API_ERROR_PREFIX = "Erreur API: "
+
+_MEDIA_STEP_TYPES = ("media_text", "paywall_media_text")
+
+
+@dataclass
+class TurnPlan:
+    """Ce qu'un tour va faire: quel endpoint appeler et l'état à écrire ensuite."""
+
+    conversation_id: int
+    user_msg: str
+    session_id: Optional[str]
+    history: List[Dict[str, Any]]
+    persona_data: Dict[str, Any]
+    endpoint: Optional[str] = None
+    script: str = ""
+    media: str = ""
+    canned_text: str = ""
+    suffix: str = ""
+    # État conversation (current_step, paywall_unlocked, paywall_counter) à committer avec les messages
+    state: Optional[Dict[str, Any]] = None
+    # Rapport du builder d'historique (tokens utilisés, messages tronqués / non envoyés)
+    history_report: Optional[Dict[str, Any]] = None
+    # État lu pour le plan: `state` n'est écrit que si la conversation n'a pas bougé entre-temps
+    expected_state: Optional[Dict[str, Any]] = None
+    # File du régulateur Sinhome_llm: équité par abonné, "paywall" servi en premier
+    subscriber_id: Optional[int] = None
+    priority: str = "turn"
+
+
+def parse_paywall_marker(content: str) -> Tuple[str, Optional[Dict[str, str]]]:
+    # "texte\n\n[[PAYWALL::titre::prix]]" -> ("texte", {"title": ..., "price": ...})
+    if PAYWALL_MARKER not in content or not content.strip().endswith("]]"):
+        return content, None
+    main_text, meta = content.rsplit(PAYWALL_MARKER, 1)
+    parts = meta.strip()[:-2].split("::")
+    title = (parts[0] if len(parts) > 0 else "Paywall").strip() or "Paywall"
+    price = (parts[1] if len(parts) > 1 else "").strip()
+    return main_text.strip(), {"title": title, "price": price}
+
+
+def _step_value(step: Any, key: str) -> str:
+    return str((step[key] if key in step.keys() else "") or "")
+
+
+def plan_turn(
+    turn_state: Dict[str, Any],
+    user_msg: str,
+    session_id: Optional[str],
+) -> TurnPlan:
+    conv = turn_state["conversation"]
+    steps = turn_state["steps"]
+    history = turn_state["history"]
+    # Mémoire long terme avant la fenêtre récente: souvenirs pertinents, puis résumé roulant en tête
+    recalled = turn_state.get("recalled")
+    if recalled:
+        history = [recalled] + history
+    summary = turn_state.get("summary")
+    if summary:
+        history = [summaries.summary_message(summary["summary"])] + history
+    plan = TurnPlan(
+        conversation_id=int(conv["id"]),
+        user_msg=user_msg,
+        session_id=session_id,
+        history=history,
+        persona_data=turn_state["persona_data"],
+        history_report=turn_state.get("history_report"),
+        subscriber_id=int(conv["subscriber_id"]) if conv["subscriber_id"] is not None else None,
+        expected_state={c: conv[c] for c in db.STATE_GUARD_COLUMNS},
+    )
+
+    if conv["mode"] == "chloe":
+        plan.endpoint = "unpersona_chat"
+        return plan
+
+    if conv["mode"] == "free" or not conv["script_id"]:
+        plan.endpoint = "personality_chat"
+        return plan
+
+    # En script mode, on force une validation via Lock (évite les changements accidentels)
+    if not int(conv["script_started"]):
+        plan.canned_text = "Verrouille le script avec 'Lock' avant de discuter."
+        return plan
+
+    if not steps:
+        plan.canned_text = "Le script n'a pas d'étapes."
+        return plan
+
+    current_step = int(conv["current_step"])
+    unlocked = bool(int(conv["paywall_unlocked"]))
+    paywall_counter = int(conv["paywall_counter"])
+    idx = min(max(0, current_step - 1), len(steps) - 1)
+    step = steps[idx]
+    is_paywall = str(step["step_type"]).startswith("paywall_")
+    if is_paywall:
+        plan.priority = "paywall"
+    plan.script = step["script_text"]
+    plan.media = step["media_desc"] or ""
+    script_endpoint = "script_media" if step["step_type"] in _MEDIA_STEP_TYPES else "script_chat"
+
+    if is_paywall and not unlocked:
+        # tant que non payé: on discute, et tous les 3 messages user on renvoie le paywall
+        counter = paywall_counter + 1
+        plan.state = {"current_step": current_step, "paywall_unlocked": False, "paywall_counter": counter}
+        if counter == 1 or (counter % 3 == 0):
+            title_marker = _step_value(step, "title").strip() or "Paywall"
+            price_marker = _step_value(step, "price").strip()
+            plan.endpoint = script_endpoint
+            plan.suffix = f"\n\n{PAYWALL_MARKER}{title_marker}::{price_marker}]]"
+        else:
+            plan.endpoint = "personality_chat"
+        return plan
+
+    # pas paywall (ou unlock): on répond selon le type, puis on avance d'une étape
+    plan.endpoint = script_endpoint
+    next_step = min(current_step + 1, len(steps))
+    # Si on entre dans un paywall, on reset le compteur pour afficher le paywall immédiatement au prochain message
+    if next_step != current_step and str(steps[next_step - 1]["step_type"]).startswith("paywall_"):
+        paywall_counter = 0
+    # Après une réponse script (paywall ou non), on reset le flag unlock
+    plan.state = {"current_step": next_step, "paywall_unlocked": False, "paywall_counter": paywall_counter}
+    return plan
+
+
+def start_turn(
+    conversation_id: int,
+    user_msg: str,
+    session_id: Optional[str],
+    history_budgets: Optional[Dict[str, int]] = None,
+) -> TurnPlan:
+    turn_state = db.load_turn_state(conversation_id, history_budgets=history_budgets)
+    if turn_state is None:
+        raise ValueError(f"Conversation {conversation_id} introuvable")
+    report = turn_state["history_report"]
+    if retrieval.RETRIEVAL_ENABLED and report.get("dropped_from_id"):
+        # Seulement ce qui est sorti de la fenêtre envoyée telle quelle
+        rows = retrieval.recall(conversation_id, user_msg, before_id=report["oldest_id"])
+        recalled = retrieval.recall_message(rows)
+        if recalled:
+            # Budget pris sur l'historique seulement s'il y a des souvenirs: fenêtre refaite si elle déborde
+            budget = report["budget_tokens"] - history.message_tokens(recalled["content"])
+            if report["used_tokens"] > budget:
+                turn_state["history"], turn_state["history_report"] = db.build_history_budgeted(
+                    conversation_id, max(0, budget)
+                )
+            turn_state["recalled"] = recalled
+    return plan_turn(turn_state, user_msg, session_id)
+
+
+def _call_args(plan: TurnPlan) -> List[Any]:
+    args: List[Any] = [plan.session_id, plan.user_msg, plan.history]
+    if plan.endpoint == "unpersona_chat":
+        return args + [None]
+    args.append(plan.persona_data)
+    if plan.endpoint in ("script_chat", "script_media"):
+        args.append(plan.script)
+    if plan.endpoint == "script_media":
+        args.append(plan.media)
+    return args
+
+
+def generate_reply(api_url: str, plan: TurnPlan) -> str:
+    if not plan.endpoint:
+        return plan.canned_text
+    call = getattr(sinhome_client, plan.endpoint)
+    with sinhome_client.deadline(sinhome_client.TURN_DEADLINE_S), governor.slot(plan.subscriber_id, plan.priority):
+        return call(api_url, *_call_args(plan))
+
+
+def stream_reply(api_url: str, plan: TurnPlan) -> Iterator[str]:
+    # La deadline du tour est posée par l'appelant, autour de la lecture du flux
+    if not plan.endpoint:
+        return iter([plan.canned_text])
+    call = getattr(sinhome_client, f"{plan.endpoint}_stream")
+    return governor.stream(lambda: call(api_url, *_call_args(plan)), plan.subscriber_id, plan.priority)
+
+
+def finish_turn(
+    plan: TurnPlan,
+    reply: Optional[str],
+    error: Optional[str] = None,
+    pending_turn_id: Optional[int] = None,
+) -> str:
+    # Une seule transaction d'écriture; en cas d'erreur API l'état du script ne bouge pas
+    if error is not None:
+        assistant_text = f"{API_ERROR_PREFIX}{error}"
+        db.commit_turn(
+            plan.conversation_id, plan.user_msg, assistant_text, state=None, pending_turn_id=pending_turn_id
+        )
+        return assistant_text
+    assistant_text = f"{reply or ''}{plan.suffix}"
+    db.commit_turn(
+        plan.conversation_id,
+        plan.user_msg,
+        assistant_text,
+        state=plan.state,
+        pending_turn_id=pending_turn_id,
+        expected=plan.expected_state,
+    )
+    return assistant_text
+
+
+def after_turn(api_url: str, plan: TurnPlan) -> None:
+    # Hors chemin critique (worker): replie dans le résumé ce qui est sorti de la fenêtre
+    dropped_from_id = (plan.history_report or {}).get("dropped_from_id")
+    if dropped_from_id:
+        summaries.refresh_summary(plan.conversation_id, int(dropped_from_id), api_url=api_url)
+
+
+# Résumés lancés depuis l'API: un thread par process, un job en attente par conversation
+_after_turn_pending: Dict[int, Tuple[str, TurnPlan]] = {}
+_after_turn_lock = threading.Lock()
+_after_turn_executor: Optional[ThreadPoolExecutor] = None
+_after_turn_pid: Optional[int] = None
+
+
+def after_turn_background(api_url: str, plan: TurnPlan) -> None:
+    """after_turn hors de la requête HTTP: la réponse part sans attendre le résumé."""
+    global _after_turn_executor, _after_turn_pid
+    with _after_turn_lock:
+        queued = plan.conversation_id in _after_turn_pending
+        # Le plan le plus récent gagne: son dropped_from_id couvre celui des précédents
+        _after_turn_pending[plan.conversation_id] = (api_url, plan)
+        if queued:
+            return
+        if _after_turn_executor is None or _after_turn_pid != os.getpid():
+            # Après un fork (workers de l'API), l'exécuteur du parent n'a plus de thread
+            _after_turn_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="after-turn")
+            _after_turn_pid = os.getpid()
+        _after_turn_executor.submit(_after_turn_job, plan.conversation_id)
+
+
+def _after_turn_job(conversation_id: int) -> None:
+    with _after_turn_lock:
+        api_url, plan = _after_turn_pending.pop(conversation_id)
+    try:
+        after_turn(api_url, plan)
+    except Exception:
+        # Le résumé est best-effort: le tour est déjà committé
+        pass
+
+
+def process_turn(
+    api_url: str,
+    conversation_id: int,
+    user_msg: str,
+    session_id: Optional[str],
+    history_budgets: Optional[Dict[str, int]] = None,
+) -> str:
+    with metrics.turn_trace(conversation_id, "engine"):
+        plan = start_turn(conversation_id, user_msg, session_id, history_budgets=history_budgets)
+        try:
+            reply = generate_reply(api_url, plan)
+        except SinhomeClientError as e:
+            return finish_turn(plan, None, error=str(e))
+        assistant_text = finish_turn(plan, reply)
+        try:
+            after_turn(api_url, plan)
+        except Exception:
+            # Le résumé est best-effort: le tour est déjà committé
+            pass
+        return assistant_text
@@ -0,0 +1,281 @@
+"""Régulateur des appels sortants vers Sinhome_llm: concurrence, débit, équité et priorités.
+
+    SINHOME_MAX_CONCURRENCY=8 SINHOME_RATE_PER_S=4 streamlit run streamlit_app.py
+
+Chaque appel LLM d'un tour (app.engine) et des résumés prend un slot via `slot()`. Au-delà de la
+limite de concurrence ou du débit (token bucket), l'appel attend dans une file par priorité
+(paywall > tour > arrière-plan), servie en round-robin entre abonnés: un fan qui enchaîne dix
+messages ne passe pas devant les autres. Une attente de plus de SINHOME_QUEUE_AGING_S fait monter
+d'un cran (pas de famine). L'attente compte dans la deadline du tour. Limites par process: l'API
+pré-forkée (`serve --workers N`) les partage entre ses workers via `split()` avant le fork.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from app import metrics
+from app.sinhome_client import SinhomeDeadlineError, remaining_s
+
+# 0: pas de limite
+MAX_CONCURRENCY = int(os.environ.get("SINHOME_MAX_CONCURRENCY") or 16)
+RATE_PER_S = float(os.environ.get("SINHOME_RATE_PER_S") or 0)
+RATE_BURST = float(os.environ.get("SINHOME_RATE_BURST") or max(1.0, RATE_PER_S))
+_AGING_S = float(os.environ.get("SINHOME_QUEUE_AGING_S") or 10)
+# Attente max hors deadline de tour (résumés en arrière-plan)
+_QUEUE_TIMEOUT_S = float(os.environ.get("SINHOME_QUEUE_TIMEOUT_S") or 120)
+
+# Ordre = priorité: les étapes paywall_* (revenu en jeu) passent en premier
+PRIORITIES = ("paywall", "turn", "background")
+# Attentes gardées par priorité pour les percentiles
+_RECENT_WAITS = 1000
+
+_local = threading.local()
+
+
+class QueueTimeoutError(SinhomeDeadlineError):
+    """Pas de slot libre avant la deadline du tour."""
+
+
+class TokenBucket:
+    def __init__(self, rate_per_s: float, burst: float) -> None:
+        self.rate_per_s = rate_per_s
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate_per_s)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_s(self, now: float) -> float:
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate_per_s)
+
+
+class _Waiter:
+    __slots__ = ("subscriber", "priority", "enqueued", "event", "granted")
+
+    def __init__(self, subscriber: str, priority: str, enqueued: float) -> None:
+        self.subscriber = subscriber
+        self.priority = priority
+        self.enqueued = enqueued
+        self.event = threading.Event()
+        self.granted = False
+
+
+class Governor:
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENCY,
+        rate_per_s: float = RATE_PER_S,
+        burst: float = RATE_BURST,
+        aging_s: float = _AGING_S,
+    ) -> None:
+        self.max_concurrency = max(0, max_concurrency)
+        self.bucket = TokenBucket(rate_per_s, burst) if rate_per_s > 0 else None
+        self.aging_s = aging_s
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        # priorité -> abonné -> attentes FIFO; l'ordre du dict fait le round-robin entre abonnés
+        self.queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {p: OrderedDict() for p in PRIORITIES}
+        self.grants: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        self.timeouts: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        self.waits: Dict[str, Deque[float]] = {p: deque(maxlen=_RECENT_WAITS) for p in PRIORITIES}
+
+    def _can_start(self, now: float) -> bool:
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return False
+        return self.bucket is None or self.bucket.take(now)
+
+    def _start(self, priority: str, waited_s: float) -> None:
+        self.active += 1
+        self.grants[priority] += 1
+        self.waits[priority].append(waited_s)
+        metrics.record_queue_wait(priority, waited_s)
+
+    def _pick(self, now: float) -> _Waiter:
+        best = None
+        for rank, priority in enumerate(PRIORITIES):
+            queue = self.queues[priority]
+            if not queue:
+                continue
+            head = next(iter(queue.values()))[0]
+            effective = rank - int((now - head.enqueued) // self.aging_s) if self.aging_s > 0 else rank
+            if best is None or effective < best[0]:
+                best = (effective, priority)
+        assert best is not None
+        queue = self.queues[best[1]]
+        subscriber, waiters = next(iter(queue.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            # Au tour de l'abonné suivant
+            queue.move_to_end(subscriber)
+        else:
+            del queue[subscriber]
+        return waiter
+
+    def _dispatch(self, now: float) -> None:
+        while self.queued and self._can_start(now):
+            waiter = self._pick(now)
+            self.queued -= 1
+            waiter.granted = True
+            self._start(waiter.priority, now - waiter.enqueued)
+            waiter.event.set()
+        self._publish()
+
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self.queues[waiter.priority]
+        waiters = queue.get(waiter.subscriber)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            if not waiters:
+                del queue[waiter.subscriber]
+
+    def _publish(self) -> None:
+        metrics.set_queue_state({p: sum(len(w) for w in q.values()) for p, q in self.queues.items()}, self.active)
+
+    def acquire(self, subscriber: Optional[Any] = None, priority: str = "turn", timeout_s: Optional[float] = None) -> float:
+        """Bloque jusqu'à obtenir un slot; renvoie l'attente (s). QueueTimeoutError au-delà de timeout_s."""
+        if priority not in self.queues:
+            priority = "turn"
+        started = time.monotonic()
+        with self.lock:
+            if not self.queued and self._can_start(started):
+                self._start(priority, 0.0)
+                self._publish()
+                return 0.0
+            waiter = _Waiter("_" if subscriber is None else str(subscriber), priority, started)
+            self.queues[priority].setdefault(waiter.subscriber, deque()).append(waiter)
+            self.queued += 1
+            self._publish()
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    # Jetons regagnés depuis le dernier passage (personne d'autre ne réveille la file)
+                    self._dispatch(now)
+                    if waiter.granted:
+                        return now - started
+                    remaining = None if timeout_s is None else started + timeout_s - now
+                    if remaining is not None and remaining <= 0:
+                        self._remove(waiter)
+                        self.timeouts[priority] += 1
+                        self._publish()
+                        metrics.record_queue_timeout(priority)
+                        raise QueueTimeoutError(
+                            f"File Sinhome_llm saturée: pas de slot après {now - started:.1f} s ({priority})"
+                        )
+                    wake = None
+                    if self.bucket is not None and not (self.max_concurrency and self.active >= self.max_concurrency):
+                        wake = self.bucket.wait_s(now)
+                delays = [d for d in (remaining, wake) if d is not None]
+                waiter.event.wait(min(delays) if delays else None)
+        except QueueTimeoutError:
+            raise
+        except BaseException:
+            # Thread interrompu pendant l'attente: rendre le slot s'il a été accordé entre-temps
+            with self.lock:
+                if waiter.granted:
+                    self.active -= 1
+                    self._dispatch(time.monotonic())
+                else:
+                    self._remove(waiter)
+                    self._publish()
+            raise
+
+    def release(self) -> None:
+        with self.lock:
+            self.active -= 1
+            self._dispatch(time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            now = time.monotonic()
+            priorities = {}
+            for p, queue in self.queues.items():
+                waits = sorted(self.waits[p])
+                oldest = min((w[0].enqueued for w in queue.values()), default=None)
+                priorities[p] = {
+                    "depth": sum(len(w) for w in queue.values()),
+                    "subscribers": len(queue),
+                    "oldest_wait_ms": round((now - oldest) * 1000, 1) if oldest is not None else 0.0,
+                    "grants": self.grants[p],
+                    "timeouts": self.timeouts[p],
+                    "wait_p50_ms": _percentile_ms(waits, 0.50),
+                    "wait_p95_ms": _percentile_ms(waits, 0.95),
+                    "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+                }
+            return {
+                "max_concurrency": self.max_concurrency,
+                "rate_per_s": self.bucket.rate_per_s if self.bucket is not None else None,
+                "tokens": round(self.bucket.tokens, 2) if self.bucket is not None else None,
+                "active": self.active,
+                "queued": self.queued,
+                "priorities": priorities,
+            }
+
+
+def _percentile_ms(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return round(sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))] * 1000, 1)
+
+
+GOVERNOR = Governor()
+
+
+def split(workers: int) -> Dict[str, Any]:
+    """Partage les limites configurées entre `workers` process; à appeler avant le fork."""
+    global GOVERNOR
+    workers = max(1, workers)
+    # Arrondi vers le bas (total <= limite), mais au moins un appel par worker
+    GOVERNOR = Governor(
+        max_concurrency=max(1, MAX_CONCURRENCY // workers) if MAX_CONCURRENCY > 0 else 0,
+        rate_per_s=RATE_PER_S / workers,
+        burst=RATE_BURST / workers,
+    )
+    return {
+        "workers": workers,
+        "max_concurrency": GOVERNOR.max_concurrency,
+        "rate_per_s": GOVERNOR.bucket.rate_per_s if GOVERNOR.bucket is not None else None,
+    }
+
+
+@contextmanager
+def slot(subscriber: Optional[Any] = None, priority: str = "turn") -> Iterator[None]:
+    """Un appel Sinhome_llm; l'attente est bornée par la deadline du tour (sinhome_client.deadline)."""
+    if getattr(_local, "held", False):
+        # Déjà dans un slot (appel imbriqué): ne pas s'attendre soi-même
+        yield
+        return
+    remaining = remaining_s()
+    GOVERNOR.acquire(subscriber, priority, timeout_s=remaining if remaining is not None else _QUEUE_TIMEOUT_S)
+    _local.held = True
+    try:
+        yield
+    finally:
+        _local.held = False
+        GOVERNOR.release()
+
+
+def stream(open_stream: Callable[[], Iterator[str]], subscriber: Optional[Any] = None, priority: str = "turn") -> Iterator[str]:
+    # Slot pris à la première lecture (dans la deadline posée par l'appelant), rendu à la fin du flux
+    with slot(subscriber, priority):
+        yield from open_stream()
+
+
+def stats() -> Dict[str, Any]:
+    return GOVERNOR.stats()
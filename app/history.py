@@ -0,0 +1,91 @@
+import math
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Budget d'historique (en tokens estimés) envoyé au LLM, par mode de conversation
+HISTORY_TOKEN_BUDGETS: Dict[str, int] = {
+    "free": int(os.environ.get("MYFANCRM_HISTORY_TOKENS_FREE") or 1500),
+    "script": int(os.environ.get("MYFANCRM_HISTORY_TOKENS_SCRIPT") or 1000),
+    "chloe": int(os.environ.get("MYFANCRM_HISTORY_TOKENS_CHLOE") or 2000),
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 1500
+
+# Garde-fou: on ne lit jamais plus de messages que ça, même s'ils sont tous très courts
+MAX_HISTORY_MESSAGES = 200
+
+# Coût fixe par message (rôle + séparateurs du chat template)
+_MESSAGE_OVERHEAD_TOKENS = 4
+# ~4 caractères par token pour du texte FR/EN avec un tokenizer BPE
+CHARS_PER_TOKEN = 4
+_TRUNCATION_MARK = " […]"
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(content: str) -> int:
+    # Coût d'un message dans le budget d'historique
+    return estimate_tokens(content) + _MESSAGE_OVERHEAD_TOKENS
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN - len(_TRUNCATION_MARK))
+    return text[:max_chars].rstrip() + _TRUNCATION_MARK
+
+
+def budget_for_mode(mode: Optional[str], budgets: Optional[Dict[str, int]] = None) -> int:
+    budgets = budgets if budgets is not None else HISTORY_TOKEN_BUDGETS
+    return int(budgets.get(mode or "", DEFAULT_HISTORY_TOKEN_BUDGET))
+
+
+def fit_history(
+    rows_newest_first: Iterable[Any],
+    max_tokens: int,
+    max_message_tokens: Optional[int] = None,
+    max_messages: int = MAX_HISTORY_MESSAGES,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Remplit le budget avec les messages les plus récents (lignes id/role/content).
+
+    Un message plus gros que max_message_tokens (par défaut la moitié du budget) est tronqué.
+    Dès qu'un message ne rentre plus, on s'arrête: l'historique reste contigu.
+    Renvoie (historique chronologique, rapport).
+    """
+    if max_message_tokens is None:
+        max_message_tokens = max(1, max_tokens // 2)
+    picked: List[Dict[str, Any]] = []
+    used = 0
+    truncated_ids: List[int] = []
+    dropped_from_id: Optional[int] = None
+    oldest_id: Optional[int] = None
+    for row in rows_newest_first:
+        if len(picked) >= max_messages:
+            dropped_from_id = int(row["id"])
+            break
+        content = row["content"] or ""
+        cost = message_tokens(content)
+        if cost - _MESSAGE_OVERHEAD_TOKENS > max_message_tokens:
+            content = _truncate_to_tokens(content, max_message_tokens)
+            cost = message_tokens(content)
+            truncated_ids.append(int(row["id"]))
+        if used + cost > max_tokens:
+            if truncated_ids and truncated_ids[-1] == int(row["id"]):
+                truncated_ids.pop()
+            dropped_from_id = int(row["id"])
+            break
+        picked.append({"role": row["role"], "content": content})
+        used += cost
+        oldest_id = int(row["id"])
+    picked.reverse()
+    report = {
+        "budget_tokens": max_tokens,
+        "used_tokens": used,
+        "messages": len(picked),
+        "truncated_ids": truncated_ids,
+        "oldest_id": oldest_id,
+        # Ce message et tous les plus anciens n'ont pas été envoyés
+        "dropped_from_id": dropped_from_id,
+    }
+    return picked, report
@@ -0,0 +1,341 @@
+"""Test de charge du moteur de conversation (SQLite + flux synchrone) contre un LLM stub.
+
+    python -m app loadtest --fans 200 --turns 10 --concurrency 32
+
+Crée N abonnés/conversations synthétiques (upsert_subscriber / create_conversation), puis
+joue en parallèle des flux free, script et paywall via engine.process_turn. Par défaut la DB
+est un fichier temporaire neuf et le stub Sinhome_llm tourne dans le process.
+"""
+
+import inspect
+import json
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app import db
+from app import engine
+from app import governor
+from app.stub_server import StubConfig, parse_latency, start_stub_server
+
+FLOWS = ("free", "script", "paywall")
+
+_FAN_MESSAGES = (
+    "coucou ça va ?",
+    "tu fais quoi ce soir",
+    "j'ai pensé à toi toute la journée",
+    "montre moi un peu plus",
+    "tu es vraiment trop belle",
+    "raconte moi ta journée",
+    "ok je veux voir",
+    "c'est combien ?",
+)
+
+_SCRIPT_STEPS = (
+    ("text", "Intro", "Accueille le fan chaleureusement.", None, None),
+    ("media_text", "Selfie", "Envoie un selfie décontracté.", "selfie miroir", None),
+    ("text", "Question", "Demande-lui ce qu'il aime.", None, None),
+    ("media_text", "Photo", "Partage une photo de ta soirée.", "photo soirée", None),
+)
+_PAYWALL_STEPS = (
+    ("text", "Intro", "Accueille le fan et tease une surprise.", None, None),
+    ("paywall_text", "Message privé", "Propose le message privé payant.", None, "9.99"),
+    ("media_text", "Aperçu", "Remercie et envoie un aperçu.", "aperçu flouté", None),
+    ("paywall_media_text", "Vidéo", "Propose la vidéo exclusive.", "vidéo exclusive", "19.99"),
+    ("text", "Merci", "Remercie chaleureusement.", None, None),
+)
+
+
+class _DbCounter:
+    """Compte, par thread, les appels aux fonctions publiques de app.db et les requêtes SQL exécutées."""
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self._originals: Dict[str, Callable[..., Any]] = {}
+
+    def reset(self) -> None:
+        self.local.calls = 0
+        self.local.statements = 0
+        self.local.depth = 0
+
+    def snapshot(self) -> Tuple[int, int]:
+        return getattr(self.local, "calls", 0), getattr(self.local, "statements", 0)
+
+    def _on_statement(self, sql: str) -> None:
+        self.local.statements = getattr(self.local, "statements", 0) + 1
+
+    def _wrap(self, fn: Callable[..., Any]) -> Callable[..., Any]:
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            depth = getattr(self.local, "depth", 0)
+            if depth == 0:
+                self.local.calls = getattr(self.local, "calls", 0) + 1
+            self.local.depth = depth + 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.depth = depth
+
+        wrapper.__wrapped__ = fn  # type: ignore[attr-defined]
+        return wrapper
+
+    def install(self) -> None:
+        skip = {"get_conn", "get_read_conn", "close_pools", "init_db", "migrate", "get_schema_version", "set_statement_tracer"}
+        for name, fn in list(vars(db).items()):
+            if name.startswith("_") or name in skip or not inspect.isfunction(fn) or fn.__module__ != db.__name__:
+                continue
+            self._originals[name] = fn
+            setattr(db, name, self._wrap(fn))
+        db.set_statement_tracer(self._on_statement)
+
+    def uninstall(self) -> None:
+        for name, fn in self._originals.items():
+            setattr(db, name, fn)
+        self._originals.clear()
+        db.set_statement_tracer(None)
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def _latency_summary(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 2) if ordered else 0.0,
+        "p50_ms": round(1000 * _percentile(ordered, 50), 2),
+        "p90_ms": round(1000 * _percentile(ordered, 90), 2),
+        "p95_ms": round(1000 * _percentile(ordered, 95), 2),
+        "p99_ms": round(1000 * _percentile(ordered, 99), 2),
+        "max_ms": round(1000 * (ordered[-1] if ordered else 0.0), 2),
+    }
+
+
+def _parse_mix(spec: str) -> Dict[str, float]:
+    # "free=0.5,script=0.3,paywall=0.2"
+    mix: Dict[str, float] = {}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in FLOWS:
+            raise ValueError(f"Flux inconnu: {name!r} (attendu: {', '.join(FLOWS)})")
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError(f"Mix invalide: {spec!r}")
+    return mix
+
+
+def _create_script(name: str, bot_id: int, steps: Tuple[Tuple[str, str, str, Optional[str], Optional[str]], ...]) -> int:
+    script_id = db.upsert_script(None, name, "Script généré par le test de charge", bot_id)
+    for step_type, title, script_text, media_desc, price in steps:
+        db.add_step(script_id, step_type, title, script_text, media_desc, price)
+    return script_id
+
+
+def setup_fans(n_fans: int, mix: Dict[str, float], seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    bot_id = db.get_default_bot_id()
+    if bot_id is None:
+        bot_id = db.upsert_bot(None, "Loadtest", {"name": "Loadtest"})
+    tag = f"{int(time.time())}{rng.randrange(1000):03d}"
+    script_ids = {
+        "script": _create_script(f"loadtest-script-{tag}", bot_id, _SCRIPT_STEPS),
+        "paywall": _create_script(f"loadtest-paywall-{tag}", bot_id, _PAYWALL_STEPS),
+    }
+    flows, weights = zip(*mix.items())
+    fans = []
+    for i in range(n_fans):
+        flow = rng.choices(flows, weights=weights)[0]
+        subscriber_id = db.upsert_subscriber(None, f"loadtest_{tag}_{i}", f"Fan {i}")
+        if flow == "free":
+            conversation_id = db.create_conversation(subscriber_id, bot_id, mode="free", script_id=None)
+        else:
+            conversation_id = db.create_conversation(subscriber_id, bot_id, mode="script", script_id=script_ids[flow])
+            db.lock_script(conversation_id)
+        fans.append({"index": i, "flow": flow, "conversation_id": conversation_id})
+    return fans
+
+
+def _is_lock_error(exc: BaseException) -> bool:
+    msg = str(exc).lower()
+    return isinstance(exc, sqlite3.OperationalError) and ("locked" in msg or "busy" in msg)
+
+
+def _run_fan(
+    fan: Dict[str, Any],
+    api_url: str,
+    turns: int,
+    think_time_s: float,
+    pay_probability: float,
+    counter: _DbCounter,
+    seed: int,
+) -> List[Dict[str, Any]]:
+    rng = random.Random(seed + fan["index"])
+    conversation_id = fan["conversation_id"]
+    session_id = f"loadtest-{conversation_id}"
+    results = []
+    for _ in range(turns):
+        counter.reset()
+        outcome = "ok"
+        error = None
+        started = time.perf_counter()
+        try:
+            reply = engine.process_turn(api_url, conversation_id, rng.choice(_FAN_MESSAGES), session_id)
+            if reply.startswith("Erreur API:"):
+                outcome = "api_error"
+            elif engine.PAYWALL_MARKER in reply and rng.random() < pay_probability:
+                # Le fan paie: même appel que le bouton "Payer" de l'UI
+                db.unlock_paywall(conversation_id)
+        except Exception as e:
+            outcome = "lock_error" if _is_lock_error(e) else "error"
+            error = f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - started
+        calls, statements = counter.snapshot()
+        results.append(
+            {
+                "flow": fan["flow"],
+                "outcome": outcome,
+                "latency_s": elapsed,
+                "db_calls": calls,
+                "sql_statements": statements,
+                "error": error,
+            }
+        )
+        if think_time_s > 0:
+            time.sleep(rng.uniform(0, 2 * think_time_s))
+    return results
+
+
+def run_loadtest(
+    fans: int = 50,
+    turns: int = 10,
+    concurrency: int = 16,
+    mix: str = "free=0.4,script=0.3,paywall=0.3",
+    api_url: Optional[str] = None,
+    db_path: Optional[str] = None,
+    think_time_s: float = 0.0,
+    pay_probability: float = 0.5,
+    stub_config: Optional[StubConfig] = None,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    flow_mix = _parse_mix(mix)
+    previous_path = db._DB_PATH
+    tmp_dir = None
+    if db_path is None:
+        tmp_dir = tempfile.mkdtemp(prefix="myfancrm-loadtest-")
+        db_path = os.path.join(tmp_dir, "loadtest.sqlite3")
+    db._DB_PATH = db_path
+    stub = None
+    if not api_url:
+        stub = start_stub_server(stub_config or StubConfig(latency=parse_latency("fixed:0.05"), seed=seed))
+        api_url = stub.url
+    counter = _DbCounter()
+    try:
+        db.init_db()
+        setup_started = time.perf_counter()
+        fan_list = setup_fans(fans, flow_mix, seed)
+        setup_s = time.perf_counter() - setup_started
+
+        counter.install()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            per_fan = list(
+                pool.map(
+                    lambda fan: _run_fan(fan, api_url, turns, think_time_s, pay_probability, counter, seed),
+                    fan_list,
+                )
+            )
+        wall_s = time.perf_counter() - started
+    finally:
+        counter.uninstall()
+        if stub is not None:
+            stub.shutdown()
+            stub.server_close()
+        db._DB_PATH = previous_path
+        db.close_pools()
+
+    results = [r for fan_results in per_fan for r in fan_results]
+    outcomes: Dict[str, int] = {}
+    for r in results:
+        outcomes[r["outcome"]] = outcomes.get(r["outcome"], 0) + 1
+    by_flow = {}
+    for flow in FLOWS:
+        flow_results = [r for r in results if r["flow"] == flow]
+        if flow_results:
+            by_flow[flow] = {
+                "fans": sum(1 for f in fan_list if f["flow"] == flow),
+                "latency": _latency_summary([r["latency_s"] for r in flow_results]),
+            }
+    n = len(results) or 1
+    errors = [r["error"] for r in results if r["error"]]
+    return {
+        "config": {
+            "fans": fans,
+            "turns": turns,
+            "concurrency": concurrency,
+            "mix": flow_mix,
+            "api_url": api_url if stub is None else "stub",
+            "db_path": db_path,
+            "think_time_s": think_time_s,
+            "pay_probability": pay_probability,
+        },
+        "setup_s": round(setup_s, 3),
+        "wall_s": round(wall_s, 3),
+        "turns_total": len(results),
+        "throughput_turns_per_s": round(len(results) / wall_s, 2) if wall_s > 0 else 0.0,
+        "latency": _latency_summary([r["latency_s"] for r in results]),
+        "by_flow": by_flow,
+        "db_calls_per_turn": round(sum(r["db_calls"] for r in results) / n, 2),
+        "sql_statements_per_turn": round(sum(r["sql_statements"] for r in results) / n, 2),
+        "outcomes": outcomes,
+        "lock_errors": outcomes.get("lock_error", 0),
+        "sample_errors": errors[:5],
+        "stub_stats": stub.stats.snapshot() if stub is not None else None,
+        "sinhome_queue": governor.stats(),
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    cfg = report["config"]
+    lines = [
+        f"[MyFanCRM] Test de charge: {cfg['fans']} fans x {cfg['turns']} tours, concurrence {cfg['concurrency']} (DB {cfg['db_path']})",
+        f"  Durée {report['wall_s']} s, {report['turns_total']} tours, {report['throughput_turns_per_s']} tours/s (setup {report['setup_s']} s)",
+    ]
+
+    def _lat(label: str, lat: Dict[str, float]) -> str:
+        return (
+            f"  {label:<8} n={lat['count']:<6} p50={lat['p50_ms']} ms  p90={lat['p90_ms']} ms  "
+            f"p95={lat['p95_ms']} ms  p99={lat['p99_ms']} ms  max={lat['max_ms']} ms"
+        )
+
+    lines.append(_lat("total", report["latency"]))
+    for flow, data in report["by_flow"].items():
+        lines.append(_lat(flow, data["latency"]))
+    lines.append(
+        f"  DB par tour: {report['db_calls_per_turn']} appels app.db, {report['sql_statements_per_turn']} requêtes SQL"
+    )
+    lines.append(f"  Résultats: {json.dumps(report['outcomes'])}  (erreurs de verrou SQLite: {report['lock_errors']})")
+    for err in report["sample_errors"]:
+        lines.append(f"    - {err}")
+    queue = report.get("sinhome_queue")
+    if queue:
+        limit = queue["max_concurrency"] or "∞"
+        lines.append(f"  File Sinhome_llm (max {limit} en parallèle, débit {queue['rate_per_s'] or '∞'}/s):")
+        for priority, q in queue["priorities"].items():
+            if q["grants"] or q["timeouts"]:
+                lines.append(
+                    f"    {priority:<10} {q['grants']:>6} appels  attente p50={q['wait_p50_ms']} ms  "
+                    f"p95={q['wait_p95_ms']} ms  max={q['wait_max_ms']} ms  abandons={q['timeouts']}"
+                )
+    return "\n".join(lines)
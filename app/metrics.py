@@ -0,0 +1,405 @@
+"""Métriques légères en process: compteurs, histogrammes et détail du dernier tour.
+
+Spans posés automatiquement autour de chaque fonction publique de app.db et de chaque appel
+HTTP Sinhome_llm. Export au format texte Prometheus: `GET /metrics` de l'API headless, ou
+fichier réécrit périodiquement (MYFANCRM_METRICS_FILE, "{pid}" remplacé par le pid du process).
+"""
+
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+METRICS_ENABLED = (os.environ.get("MYFANCRM_METRICS") or "on").strip().lower() not in ("0", "off", "false")
+# Panneau "temps du dernier tour" dans la sidebar Streamlit
+DEBUG_PANEL = (os.environ.get("MYFANCRM_DEBUG_PANEL") or "").strip().lower() in ("1", "on", "true")
+METRICS_FILE = os.environ.get("MYFANCRM_METRICS_FILE") or ""
+METRICS_FILE_INTERVAL_S = float(os.environ.get("MYFANCRM_METRICS_FILE_INTERVAL_S") or 15)
+
+# Secondes; couvre une requête SQLite (~50 µs) comme une génération LLM (~60 s)
+_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+_MAX_TRACKED_TURNS = 256
+
+_HELP = {
+    "myfancrm_db_call_duration_seconds": ("histogram", "Durée des appels aux fonctions publiques de app.db"),
+    "myfancrm_db_call_errors_total": ("counter", "Appels app.db terminés par une exception"),
+    "myfancrm_sinhome_request_duration_seconds": ("histogram", "Durée des requêtes HTTP vers Sinhome_llm"),
+    "myfancrm_sinhome_requests_total": ("counter", "Requêtes HTTP vers Sinhome_llm par endpoint et statut"),
+    "myfancrm_sinhome_request_bytes_total": ("counter", "Octets envoyés à Sinhome_llm"),
+    "myfancrm_sinhome_response_bytes_total": ("counter", "Octets reçus de Sinhome_llm"),
+    "myfancrm_sinhome_first_chunk_seconds": ("histogram", "Délai avant le premier morceau d'une réponse streamée"),
+    "myfancrm_sinhome_cache_total": ("counter", "Consultations du cache de réponses Sinhome_llm par niveau et résultat"),
+    "myfancrm_sinhome_retries_total": ("counter", "Nouvelles tentatives vers Sinhome_llm par endpoint et cause"),
+    "myfancrm_sinhome_breaker_transitions_total": ("counter", "Changements d'état du disjoncteur par endpoint"),
+    "myfancrm_sinhome_backend_requests_total": ("counter", "Appels Sinhome_llm par backend du pool et résultat"),
+    "myfancrm_sinhome_backend_health_transitions_total": ("counter", "Changements d'état des health checks par backend"),
+    "myfancrm_sinhome_hedges_total": ("counter", "Requêtes de couverture (hedging) envoyées et gagnées par endpoint"),
+    "myfancrm_sinhome_queue_wait_seconds": ("histogram", "Attente dans la file du régulateur avant un appel Sinhome_llm"),
+    "myfancrm_sinhome_queue_timeouts_total": ("counter", "Appels abandonnés dans la file du régulateur (deadline)"),
+    "myfancrm_sinhome_queue_depth": ("gauge", "Appels Sinhome_llm en attente dans la file du régulateur"),
+    "myfancrm_sinhome_inflight": ("gauge", "Appels Sinhome_llm en cours (slots du régulateur occupés)"),
+    "myfancrm_turn_duration_seconds": ("histogram", "Durée totale d'un tour de conversation"),
+    "myfancrm_turns_total": ("counter", "Tours de conversation traités"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Estimation par borne supérieure de bucket (suffisant pour le panneau debug)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return _BUCKETS[i] if i < len(_BUCKETS) else _BUCKETS[-1]
+        return _BUCKETS[-1]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1.0) -> None:
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0.0) + value
+
+    def set(self, name: str, labels: Labels, value: float) -> None:
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        with self.lock:
+            hist = self.histograms.get((name, labels))
+            if hist is None:
+                hist = self.histograms[(name, labels)] = _Histogram()
+            hist.observe(value)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.gauges.clear()
+
+    def summary(self, name: str) -> List[Dict[str, Any]]:
+        """Une ligne par jeu de labels: nombre, moyenne et p95 estimé (ms)."""
+        with self.lock:
+            items = [(labels, h.count, h.total, h.quantile(0.95)) for (n, labels), h in self.histograms.items() if n == name]
+        rows = [
+            {**dict(labels), "count": count, "avg_ms": round(1000 * total / count, 3), "p95_ms": round(1000 * p95, 3)}
+            for labels, count, total, p95 in items
+            if count
+        ]
+        return sorted(rows, key=lambda r: -r["count"] * r["avg_ms"])
+
+    def render_prometheus(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(
+                ((key, list(h.counts), h.total, h.count) for key, h in self.histograms.items()),
+                key=lambda item: item[0],
+            )
+        lines: List[str] = []
+        declared = set()
+
+        def _declare(name: str) -> None:
+            if name in declared:
+                return
+            declared.add(name)
+            kind, text = _HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            _declare(name)
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), value in gauges:
+            _declare(name)
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), counts, total, count in histograms:
+            _declare(name)
+            cumulative = 0
+            for bound, c in zip(_BUCKETS, counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+REGISTRY = Registry()
+
+_local = threading.local()
+_last_turns: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+_last_turns_lock = threading.Lock()
+
+
+def _span(entry: Dict[str, Any]) -> None:
+    trace = getattr(_local, "turn", None)
+    if trace is not None:
+        trace["spans"].append(entry)
+
+
+# --- Spans ---
+
+def instrument_db(fn: Callable[..., Any]) -> Callable[..., Any]:
+    if not METRICS_ENABLED:
+        return fn
+    name = fn.__name__
+    labels: Labels = (("function", name),)
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        depth = getattr(_local, "db_depth", 0)
+        _local.db_depth = depth + 1
+        started = time.perf_counter()
+        failed = False
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _local.db_depth = depth
+            REGISTRY.observe("myfancrm_db_call_duration_seconds", labels, elapsed)
+            if failed:
+                REGISTRY.inc("myfancrm_db_call_errors_total", labels)
+            # Dans le détail du tour: seulement les appels de premier niveau (pas build_history -> list_messages)
+            if depth == 0:
+                _span({"kind": "db", "name": name, "ms": round(elapsed * 1000, 3), "error": failed})
+
+    return wrapper
+
+
+def record_http(
+    endpoint: str,
+    status: str,
+    request_bytes: int,
+    response_bytes: int,
+    duration_s: float,
+    first_chunk_s: Optional[float] = None,
+) -> None:
+    if not METRICS_ENABLED:
+        return
+    _maybe_start_file_exporter()
+    labels: Labels = (("endpoint", endpoint), ("status", status))
+    REGISTRY.observe("myfancrm_sinhome_request_duration_seconds", labels, duration_s)
+    REGISTRY.inc("myfancrm_sinhome_requests_total", labels)
+    REGISTRY.inc("myfancrm_sinhome_request_bytes_total", (("endpoint", endpoint),), request_bytes)
+    REGISTRY.inc("myfancrm_sinhome_response_bytes_total", (("endpoint", endpoint),), response_bytes)
+    if first_chunk_s is not None:
+        REGISTRY.observe("myfancrm_sinhome_first_chunk_seconds", (("endpoint", endpoint),), first_chunk_s)
+    _span(
+        {
+            "kind": "sinhome",
+            "name": endpoint,
+            "ms": round(duration_s * 1000, 3),
+            "status": status,
+            "request_bytes": request_bytes,
+            "response_bytes": response_bytes,
+            "first_chunk_ms": round(first_chunk_s * 1000, 3) if first_chunk_s is not None else None,
+        }
+    )
+
+
+def record_cache(endpoint: str, result: str, tier: str = "", duration_s: float = 0.0) -> None:
+    """result: "hit" (tier "memory" ou "sqlite") ou "miss"."""
+    if not METRICS_ENABLED:
+        return
+    _maybe_start_file_exporter()
+    labels: Labels = (("endpoint", endpoint), ("result", result))
+    REGISTRY.inc("myfancrm_sinhome_cache_total", labels + ((("tier", tier),) if tier else ()))
+    if result == "hit":
+        _span({"kind": "cache", "name": endpoint, "ms": round(duration_s * 1000, 3), "tier": tier})
+
+
+def record_retry(endpoint: str, reason: str, delay_s: float) -> None:
+    if not METRICS_ENABLED:
+        return
+    REGISTRY.inc("myfancrm_sinhome_retries_total", (("endpoint", endpoint), ("reason", reason)))
+    # Le span compte l'attente avant la nouvelle tentative
+    _span({"kind": "retry", "name": endpoint, "ms": round(delay_s * 1000, 3), "reason": reason})
+
+
+def record_breaker(endpoint: str, state: str) -> None:
+    if not METRICS_ENABLED:
+        return
+    REGISTRY.inc("myfancrm_sinhome_breaker_transitions_total", (("endpoint", endpoint), ("state", state)))
+
+
+def record_backend(backend: str, result: str) -> None:
+    if not METRICS_ENABLED:
+        return
+    REGISTRY.inc("myfancrm_sinhome_backend_requests_total", (("backend", backend), ("result", result)))
+
+
+def record_backend_health(backend: str, state: str) -> None:
+    if not METRICS_ENABLED:
+        return
+    REGISTRY.inc("myfancrm_sinhome_backend_health_transitions_total", (("backend", backend), ("state", state)))
+
+
+def record_hedge(endpoint: str, result: str) -> None:
+    """result: "sent" (couverture lancée), "won" (la couverture a répondu en premier) ou "lost"."""
+    if not METRICS_ENABLED:
+        return
+    REGISTRY.inc("myfancrm_sinhome_hedges_total", (("endpoint", endpoint), ("result", result)))
+
+
+def record_queue_wait(priority: str, wait_s: float) -> None:
+    if not METRICS_ENABLED:
+        return
+    REGISTRY.observe("myfancrm_sinhome_queue_wait_seconds", (("priority", priority),), wait_s)
+    if wait_s > 0:
+        _span({"kind": "queue", "name": f"sinhome ({priority})", "ms": round(wait_s * 1000, 3)})
+
+
+def record_queue_timeout(priority: str) -> None:
+    if not METRICS_ENABLED:
+        return
+    REGISTRY.inc("myfancrm_sinhome_queue_timeouts_total", (("priority", priority),))
+
+
+def set_queue_state(depths: Dict[str, int], inflight: int) -> None:
+    if not METRICS_ENABLED:
+        return
+    for priority, depth in depths.items():
+        REGISTRY.set("myfancrm_sinhome_queue_depth", (("priority", priority),), depth)
+    REGISTRY.set("myfancrm_sinhome_inflight", (), inflight)
+
+
+def current_turn() -> Optional[Dict[str, Any]]:
+    return getattr(_local, "turn", None)
+
+
+@contextmanager
+def bind_turn(trace: Optional[Dict[str, Any]]) -> Iterator[None]:
+    """Rattache les spans d'un autre thread (requête de couverture) au tour de l'appelant."""
+    previous = getattr(_local, "turn", None)
+    _local.turn = trace
+    try:
+        yield
+    finally:
+        _local.turn = previous
+
+
+@contextmanager
+def turn_trace(conversation_id: int, source: str) -> Iterator[Optional[Dict[str, Any]]]:
+    """Regroupe les spans d'un tour (même thread) et garde le détail du dernier tour par conversation."""
+    if not METRICS_ENABLED or getattr(_local, "turn", None) is not None:
+        yield getattr(_local, "turn", None)
+        return
+    _maybe_start_file_exporter()
+    trace: Dict[str, Any] = {"conversation_id": int(conversation_id), "source": source, "spans": [], "at": time.time()}
+    _local.turn = trace
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _local.turn = None
+        elapsed = time.perf_counter() - started
+        trace["total_ms"] = round(elapsed * 1000, 3)
+        REGISTRY.observe("myfancrm_turn_duration_seconds", (("source", source),), elapsed)
+        REGISTRY.inc("myfancrm_turns_total", (("source", source),))
+        with _last_turns_lock:
+            _last_turns[int(conversation_id)] = trace
+            _last_turns.move_to_end(int(conversation_id))
+            while len(_last_turns) > _MAX_TRACKED_TURNS:
+                _last_turns.popitem(last=False)
+
+
+def last_turn(conversation_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    with _last_turns_lock:
+        if conversation_id is not None:
+            return _last_turns.get(int(conversation_id))
+        return next(reversed(_last_turns.values()), None)
+
+
+def turn_breakdown(trace: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Temps agrégé par (type, nom) dans un tour, plus le reste non instrumenté."""
+    totals: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+    for span in trace["spans"]:
+        row = totals.setdefault((span["kind"], span["name"]), {"kind": span["kind"], "name": span["name"], "calls": 0, "ms": 0.0})
+        row["calls"] += 1
+        row["ms"] = round(row["ms"] + span["ms"], 3)
+    rows = list(totals.values())
+    other = trace.get("total_ms", 0.0) - sum(r["ms"] for r in rows)
+    rows.append({"kind": "autre", "name": "python (plan, rendu, index de rappel…)", "calls": 1, "ms": round(max(0.0, other), 3)})
+    return rows
+
+
+# --- Export fichier ---
+
+_exporter_pid: Optional[int] = None
+_exporter_lock = threading.Lock()
+
+
+def write_metrics_file(path: str) -> None:
+    target = path.replace("{pid}", str(os.getpid()))
+    tmp = f"{target}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(REGISTRY.render_prometheus())
+    # Renommage atomique: le collecteur (node_exporter textfile, etc.) ne lit jamais un fichier partiel
+    os.replace(tmp, target)
+
+
+def _maybe_start_file_exporter() -> None:
+    global _exporter_pid
+    if not METRICS_FILE or _exporter_pid == os.getpid():
+        return
+    with _exporter_lock:
+        if _exporter_pid == os.getpid():
+            return
+        _exporter_pid = os.getpid()
+
+        def _loop() -> None:
+            while True:
+                time.sleep(METRICS_FILE_INTERVAL_S)
+                try:
+                    write_metrics_file(METRICS_FILE)
+                except OSError:
+                    pass
+
+        threading.Thread(target=_loop, name="metrics-file-exporter", daemon=True).start()
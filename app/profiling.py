@@ -0,0 +1,258 @@
+"""Profil cProfile de chaque rerun des pages Streamlit (opt-in).
+
+    MYFANCRM_PROFILE_DIR=/tmp/myfancrm-prof streamlit run streamlit_app.py
+    python -m app profile --dir /tmp/myfancrm-prof --top 25      # hotspots de la dernière session
+
+Chaque page appelle `profile_rerun(nom, __file__)` juste après ses imports. Si le profilage est
+actif, la page est ré-exécutée sous cProfile (mêmes globals) puis le run externe s'arrête: le
+profil couvre donc aussi les runs interrompus par st.stop() / st.rerun(). Un fichier .prof par
+rerun dans <dir>/<session>/ et une ligne par rerun (page, déclencheur, durée) dans <dir>/reruns.jsonl.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+PROFILE_DIR = os.environ.get("MYFANCRM_PROFILE_DIR") or ""
+# Hotspots gardés dans l'index de chaque rerun
+_INDEX_TOP = 5
+_STATE_PREFIX = "_profiling_"
+
+_MAX_SESSIONS = 256
+
+_local = threading.local()
+# session -> {"seq", "snapshot", "last_outcome"}. Hors st.session_state: après st.stop() / st.rerun(),
+# toute écriture dans session_state relance l'exception de contrôle et serait perdue.
+_sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_sessions_lock = threading.Lock()
+
+FuncKey = Tuple[str, int, str]
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", text).strip("_").lower() or "page"
+
+
+def _snapshot(state: Any) -> Dict[str, Tuple[int, bool]]:
+    snapshot: Dict[str, Tuple[int, bool]] = {}
+    for key in list(state.keys()):
+        if str(key).startswith(_STATE_PREFIX):
+            continue
+        try:
+            value = state[key]
+            snapshot[str(key)] = (hash(repr(value)), bool(value))
+        except Exception:
+            continue
+    return snapshot
+
+
+def _book(session: str) -> Dict[str, Any]:
+    with _sessions_lock:
+        book = _sessions.pop(session, None) or {"seq": 0, "snapshot": None, "last_outcome": None}
+        _sessions[session] = book
+        while len(_sessions) > _MAX_SESSIONS:
+            _sessions.popitem(last=False)
+        return book
+
+
+def _trigger(state: Any, book: Dict[str, Any]) -> str:
+    """Clés du session_state (widgets avec key) modifiées depuis le début du rerun précédent."""
+    # Photo prise en début de run: après st.stop() / st.rerun(), lire session_state relance l'exception
+    previous: Optional[Dict[str, Tuple[int, bool]]] = book["snapshot"]
+    current = book["snapshot"] = _snapshot(state)
+    if previous is None:
+        return "chargement"
+    # Clé apparue pendant le run précédent: déclencheur seulement si elle est "active" (bouton cliqué...)
+    changed = sorted(
+        k for k, (h, truthy) in current.items() if (previous[k][0] != h if k in previous else truthy)
+    )
+    parts = []
+    if book["last_outcome"] == "rerun":
+        parts.append("st.rerun")
+    parts.extend(changed[:5])
+    if len(changed) > 5:
+        parts.append(f"+{len(changed) - 5}")
+    return ", ".join(parts) or "interaction (widget sans key)"
+
+
+def _outcome(exc: Optional[BaseException]) -> str:
+    # Exceptions de contrôle de Streamlit, reconnues par leur nom (API interne)
+    if exc is None:
+        return "ok"
+    name = type(exc).__name__
+    if name == "RerunException":
+        return "rerun"
+    if name == "StopException":
+        return "stop"
+    return f"erreur:{name}"
+
+
+def _is_noise(key: FuncKey, page_files: Set[str]) -> bool:
+    # Le script de la page lui-même et l'exec qui le lance couvrent 100% du temps
+    filename, _, func = key
+    return (filename in page_files and func == "<module>") or func == "<built-in method builtins.exec>"
+
+
+def top_functions(
+    stats: pstats.Stats, top: int = 20, sort: str = "cumulative", page_files: Optional[Set[str]] = None
+) -> List[Dict[str, Any]]:
+    index = 3 if sort == "cumulative" else 2
+    rows = []
+    for key, (cc, nc, tt, ct, _) in stats.stats.items():  # type: ignore[attr-defined]
+        if _is_noise(key, page_files or set()):
+            continue
+        rows.append((key, nc, tt, ct))
+    rows.sort(key=lambda r: r[index], reverse=True)
+    return [
+        {
+            "function": pstats.func_std_string(key),
+            "calls": nc,
+            "tottime_ms": round(tt * 1000, 3),
+            "cumtime_ms": round(ct * 1000, 3),
+        }
+        for key, nc, tt, ct in rows[: max(0, top)]
+    ]
+
+
+def _write(entry: Dict[str, Any], profiler: cProfile.Profile, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiler.dump_stats(path)
+    with open(os.path.join(PROFILE_DIR, "reruns.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def profile_rerun(page: str, page_file: str) -> None:
+    """Sans MYFANCRM_PROFILE_DIR: ne fait rien. Sinon exécute le reste de la page sous cProfile."""
+    if not PROFILE_DIR or getattr(_local, "active", False):
+        return
+    import streamlit as st
+
+    state = st.session_state
+    session = state.get(f"{_STATE_PREFIX}session")
+    if session is None:
+        session = state[f"{_STATE_PREFIX}session"] = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+    book = _book(session)
+    book["seq"] += 1
+    seq = book["seq"]
+    trigger = _trigger(state, book)
+
+    with open(page_file, encoding="utf-8") as f:
+        code = compile(f.read(), page_file, "exec")
+    page_globals = sys._getframe(1).f_globals
+    profiler = cProfile.Profile()
+    error: Optional[BaseException] = None
+    started = time.perf_counter()
+    _local.active = True
+    try:
+        profiler.enable()
+        try:
+            exec(code, page_globals)
+        finally:
+            profiler.disable()
+    except BaseException as e:
+        error = e
+    finally:
+        _local.active = False
+    duration_ms = (time.perf_counter() - started) * 1000
+
+    outcome = _outcome(error)
+    book["last_outcome"] = outcome
+    path = os.path.join(PROFILE_DIR, session, f"{seq:05d}-{_slug(page)}.prof")
+    try:
+        hotspots = top_functions(pstats.Stats(profiler), _INDEX_TOP, page_files={page_file})
+        entry = {
+            "ts": time.time(),
+            "session": session,
+            "seq": seq,
+            "page": page,
+            "page_file": page_file,
+            "trigger": trigger,
+            "outcome": outcome,
+            "duration_ms": round(duration_ms, 3),
+            "profile": path,
+            "top": hotspots,
+        }
+        _write(entry, profiler, path)
+    except OSError:
+        pass
+
+    if error is not None:
+        raise error
+    # La page a déjà été rendue par l'exécution profilée
+    st.stop()
+
+
+# --- Rapport de session ---
+
+def read_index(directory: str) -> List[Dict[str, Any]]:
+    entries = []
+    path = os.path.join(directory, "reruns.jsonl")
+    if not os.path.exists(path):
+        return entries
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def summarize_session(
+    directory: str,
+    session: Optional[str] = None,
+    page: Optional[str] = None,
+    top: int = 25,
+    sort: str = "cumulative",
+) -> Dict[str, Any]:
+    """Fusionne les profils d'une session (défaut: la plus récente) et classe les hotspots."""
+    entries = read_index(directory)
+    if session is None and entries:
+        session = max(entries, key=lambda e: e.get("ts") or 0).get("session")
+    runs = [
+        e for e in entries
+        if e.get("session") == session and (not page or page.lower() in str(e.get("page", "")).lower())
+    ]
+    files = [e["profile"] for e in runs if os.path.exists(e.get("profile") or "")]
+    pages: Dict[str, Dict[str, Any]] = {}
+    for e in runs:
+        p = pages.setdefault(e["page"], {"page": e["page"], "reruns": 0, "total_ms": 0.0, "max_ms": 0.0, "triggers": {}})
+        p["reruns"] += 1
+        p["total_ms"] += float(e.get("duration_ms") or 0)
+        p["max_ms"] = max(p["max_ms"], float(e.get("duration_ms") or 0))
+        p["triggers"][e.get("trigger") or "?"] = p["triggers"].get(e.get("trigger") or "?", 0) + 1
+    for p in pages.values():
+        p["avg_ms"] = round(p["total_ms"] / p["reruns"], 3)
+        p["total_ms"] = round(p["total_ms"], 3)
+
+    hotspots: List[Dict[str, Any]] = []
+    if files:
+        stats = pstats.Stats(files[0])
+        for extra in files[1:]:
+            stats.add(extra)
+        hotspots = top_functions(stats, top, sort, page_files={str(e.get("page_file")) for e in runs})
+    return {"session": session, "reruns": len(runs), "pages": sorted(pages.values(), key=lambda p: -p["total_ms"]), "hotspots": hotspots}
+
+
+def format_summary(summary: Dict[str, Any], sort: str = "cumulative") -> str:
+    if not summary["session"]:
+        return "[MyFanCRM] Aucun profil (MYFANCRM_PROFILE_DIR vide?)"
+    lines = [f"[MyFanCRM] Session {summary['session']}: {summary['reruns']} rerun(s) profilé(s)"]
+    for p in summary["pages"]:
+        lines.append(
+            f"  {p['page']:<32} {p['reruns']:>5} reruns  moy {p['avg_ms']:>8.1f} ms  max {p['max_ms']:>8.1f} ms"
+        )
+        for trigger, n in sorted(p["triggers"].items(), key=lambda t: -t[1])[:5]:
+            lines.append(f"      {n:>5}x  {trigger}")
+    lines.append(f"[MyFanCRM] Hotspots ({'temps cumulé' if sort == 'cumulative' else 'temps propre'})")
+    for h in summary["hotspots"]:
+        lines.append(f"  {h['cumtime_ms']:>10.1f} ms cum  {h['tottime_ms']:>10.1f} ms propre  {h['calls']:>8}x  {h['function']}")
+    return "\n".join(lines)
@@ -0,0 +1,182 @@
+"""Vérification des plans de requêtes (EXPLAIN QUERY PLAN) de app.db sur une base peuplée.
+
+    python -m app queryplan                  # base synthétique "small" (générée au besoin)
+    python -m app queryplan --db /tmp/bench.sqlite3 --min-rows 500
+
+Toutes les fonctions publiques de app.db sont exécutées (mêmes scénarios que `bench`), chaque
+requête SQL émise est capturée puis expliquée. Code de sortie 1 si une requête fait un parcours
+complet (SCAN sans index) ou un tri temporaire (TEMP B-TREE) sur une table volumineuse.
+"""
+
+import os
+import random
+import re
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app import bench
+from app import db
+
+# Requêtes connues et assumées: (fonction app.db, motif du détail de plan) -> raison
+ALLOWED: Dict[Tuple[str, str], str] = {
+    ("list_conversations_page", "SEARCH s USING INDEX idx_subscribers_username_nocase"): (
+        "recherche par préfixe: seules les conversations des abonnés trouvés sont triées"
+    ),
+    ("search_messages", "VIRTUAL TABLE INDEX"): (
+        "tri par pertinence (rank FTS5) des seuls résultats du MATCH (au plus MYFANCRM_SEARCH_CANDIDATES en global)"
+    ),
+    ("search_script_steps", "VIRTUAL TABLE INDEX"): "tri par pertinence (rank FTS5) des seuls résultats du MATCH",
+}
+
+_SKIP_PREFIXES = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "SAVEPOINT", "RELEASE", "--")
+_TABLE_REF = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE)\s+([A-Za-z_][A-Za-z0-9_]*)(?:\s+(?:AS\s+)?([A-Za-z_][A-Za-z0-9_]*))?", re.I)
+_SQL_KEYWORDS = {"WHERE", "ON", "SET", "JOIN", "LEFT", "INNER", "ORDER", "GROUP", "LIMIT", "VALUES", "USING", "AS"}
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def _normalize(sql: str) -> str:
+    return " ".join(_LITERAL.sub("?", sql).split())
+
+
+class _Capture:
+    """Tracer SQL: garde une requête par forme normalisée, avec la fonction app.db appelante."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.statements: Dict[str, Dict[str, Any]] = {}
+
+    def __call__(self, sql: str) -> None:
+        text = sql.strip()
+        if not text or text.upper().startswith(_SKIP_PREFIXES):
+            return
+        function = _calling_db_function()
+        if function is None:
+            # SQL émis hors app.db (fixtures du benchmark): pas concerné
+            return
+        key = _normalize(text)
+        with self.lock:
+            entry = self.statements.setdefault(key, {"sql": text, "functions": set()})
+            entry["functions"].add(function)
+
+
+def _calling_db_function() -> Optional[str]:
+    frame = sys._getframe(2)
+    found = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == db.__file__ and not code.co_name.startswith("_"):
+            # Fonction publique la plus externe (ex. build_history -> list_messages)
+            found = code.co_name
+        frame = frame.f_back
+    return found
+
+
+def _aliases(sql: str) -> Dict[str, str]:
+    mapping: Dict[str, str] = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        mapping[table] = table
+        if alias and alias.upper() not in _SQL_KEYWORDS:
+            mapping[alias] = table
+    return mapping
+
+
+def _table_sizes() -> Dict[str, int]:
+    with db.get_read_conn() as conn:
+        names = [
+            r[0]
+            for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL%'"
+            )
+            if not re.search(r"_fts_(data|idx|docsize|config|content)$", r[0])
+        ]
+        return {name: int(conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]) for name in names}
+
+
+def explain(sql: str) -> List[str]:
+    with db.get_read_conn() as conn:
+        return [str(r[3]) for r in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def _violations(sql: str, plan: List[str], sizes: Dict[str, int], min_rows: int) -> List[str]:
+    aliases = _aliases(sql)
+    referenced: Set[str] = set()
+    found = []
+    for detail in plan:
+        m = re.match(r"(?:SCAN|SEARCH) (\w+)", detail)
+        if m:
+            referenced.add(aliases.get(m.group(1), m.group(1)))
+    for detail in plan:
+        m = re.match(r"SCAN (\w+)(.*)$", detail)
+        if m and "VIRTUAL TABLE" not in detail and "USING" not in m.group(2):
+            table = aliases.get(m.group(1), m.group(1))
+            if sizes.get(table, 0) >= min_rows:
+                found.append(f"{detail} ({table}: {sizes.get(table, 0)} lignes)")
+        if "USE TEMP B-TREE" in detail:
+            big = [t for t in referenced if sizes.get(t, 0) >= min_rows]
+            if big:
+                found.append(f"{detail} ({', '.join(f'{t}: {sizes[t]} lignes' for t in sorted(big))})")
+    return found
+
+
+def _allowed(functions: Set[str], plan: List[str]) -> Optional[str]:
+    for (function, pattern), reason in ALLOWED.items():
+        if function in functions and any(pattern in d for d in plan):
+            return reason
+    return None
+
+
+def check_query_plans(min_rows: int = 1000, seed: int = 0) -> Dict[str, Any]:
+    """Exécute les scénarios de `bench` une fois sous capture et explique chaque requête."""
+    capture = _Capture()
+    rng = random.Random(seed)
+    db.init_db()
+    sizes = _table_sizes()
+    db.set_statement_tracer(capture)
+    try:
+        fixtures = bench._fixtures(rng)
+        for _, _, make_call in bench._cases():
+            make_call(rng, fixtures)()
+    finally:
+        db.set_statement_tracer(None)
+
+    checked = []
+    failures = []
+    for entry in capture.statements.values():
+        sql = entry["sql"]
+        functions = entry["functions"]
+        plan = explain(sql)
+        problems = _violations(sql, plan, sizes, min_rows)
+        reason = _allowed(functions, plan) if problems else None
+        item = {
+            "functions": sorted(functions),
+            "sql": " ".join(sql.split()),
+            "plan": plan,
+            "problems": problems,
+            "allowed": reason,
+        }
+        checked.append(item)
+        if problems and not reason:
+            failures.append(item)
+    checked.sort(key=lambda i: (i["functions"], i["sql"]))
+    failures.sort(key=lambda i: (i["functions"], i["sql"]))
+    return {"table_sizes": sizes, "min_rows": min_rows, "statements": checked, "failures": failures}
+
+
+def format_report(report: Dict[str, Any], verbose: bool = False) -> str:
+    lines = [
+        f"[MyFanCRM] {len(report['statements'])} requêtes app.db expliquées "
+        f"(tables volumineuses: >= {report['min_rows']} lignes)"
+    ]
+    for item in report["statements"]:
+        if not verbose and not item["problems"]:
+            continue
+        status = "ÉCHEC" if item["problems"] and not item["allowed"] else ("toléré" if item["allowed"] else "ok")
+        lines.append(f"  [{status}] {', '.join(item['functions'])}: {item['sql'][:160]}")
+        for detail in item["plan"] if verbose else item["problems"]:
+            lines.append(f"      {detail}")
+        if item["allowed"]:
+            lines.append(f"      -> {item['allowed']}")
+    lines.append(f"[MyFanCRM] {len(report['failures'])} requête(s) en échec")
+    return "\n".join(lines)
+
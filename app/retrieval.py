@@ -0,0 +1,218 @@
+import heapq
+import math
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app import db
+from app import history
+from app import vectors
+
+# Rappel long terme: quelques anciens messages pertinents pour le nouveau message du fan
+RETRIEVAL_ENABLED = (os.environ.get("MYFANCRM_RETRIEVAL") or "on").strip().lower() not in ("0", "off", "false")
+RECALL_TOP_K = int(os.environ.get("MYFANCRM_RECALL_TOP_K") or 3)
+# Tokens réservés dans le budget d'historique pour les souvenirs
+RECALL_TOKENS = int(os.environ.get("MYFANCRM_RECALL_TOKENS") or 200)
+# Nombre de conversations gardées en mémoire (LRU)
+_MAX_CACHED_CONVERSATIONS = int(os.environ.get("MYFANCRM_RECALL_CACHE") or 256)
+
+# BM25
+_K1 = 1.2
+_B = 0.75
+# Termes présents dans plus de cette fraction des messages: ignorés (peu discriminants, postings longs)
+_MAX_DF_RATIO = 0.2
+# Postings parcourus au plus par terme (les plus récents): borne le coût d'une requête
+_MAX_POSTINGS = int(os.environ.get("MYFANCRM_RECALL_MAX_POSTINGS") or 256)
+# Candidats dont le score est complété sur les postings tronqués
+_RESCORE = 32
+
+_ROLE_LABELS = {"user": "Fan", "assistant": "Créatrice"}
+
+
+class ConversationIndex:
+    """Index inversé en mémoire d'une conversation: bucket -> (positions, poids BM25) en arrays.
+
+    Les messages sont numérotés 0..n-1 dans l'ordre des ids. Le poids tf*(k1+1)/(tf+norme) de chaque
+    posting est précalculé; il n'est recalculé que si la longueur moyenne dérive de plus de 10%.
+    """
+
+    def __init__(self) -> None:
+        self.doc_ids = array("q")
+        self.doc_len = array("I")
+        self.postings: Dict[int, Tuple["array[int]", "array[float]", "array[int]"]] = {}
+        self.total_len = 0
+        self._norm_avg = 0.0
+        self.last_message_id = 0
+        self.lock = threading.Lock()
+
+    def _weight(self, tf: int, length: int) -> float:
+        norm = _K1 * (1 - _B + _B * length / (self._norm_avg or 1.0))
+        return tf * (_K1 + 1) / (tf + norm)
+
+    def _refresh_weights(self) -> None:
+        avg = self.total_len / len(self.doc_ids) if self.doc_ids else 0.0
+        if self._norm_avg and abs(avg - self._norm_avg) <= 0.1 * self._norm_avg:
+            return
+        self._norm_avg = avg or 1.0
+        doc_len = self.doc_len
+        for bucket, (positions, _, tfs) in self.postings.items():
+            weights = array("d", (self._weight(tf, doc_len[p]) for p, tf in zip(positions, tfs)))
+            self.postings[bucket] = (positions, weights, tfs)
+
+    def add(self, message_id: int, counts: Dict[int, int]) -> None:
+        if message_id <= self.last_message_id:
+            return
+        position = len(self.doc_ids)
+        length = sum(counts.values())
+        for bucket, tf in counts.items():
+            plist = self.postings.get(bucket)
+            if plist is None:
+                plist = self.postings[bucket] = (array("I"), array("d"), array("I"))
+            plist[0].append(position)
+            plist[1].append(self._weight(tf, length))
+            plist[2].append(tf)
+        self.doc_ids.append(message_id)
+        self.doc_len.append(length)
+        self.total_len += length
+        self.last_message_id = message_id
+
+    def search(self, query: Dict[int, int], k: int, before_id: Optional[int] = None) -> List[Tuple[float, int]]:
+        """Top-k BM25. Exact si aucun terme de la requête n'a plus de _MAX_POSTINGS occurrences;
+        sinon les postings longs ne sont parcourus que sur leurs messages les plus récents, puis les
+        _RESCORE meilleurs candidats sont complétés sur le reste de ces postings (recherche binaire)."""
+        n_docs = len(self.doc_ids)
+        if not n_docs or not query or k <= 0:
+            return []
+        self._refresh_weights()
+        cutoff = n_docs if before_id is None else bisect_left(self.doc_ids, before_id)
+        max_df = max(1, int(n_docs * _MAX_DF_RATIO))
+        scores: Dict[int, float] = {}
+        truncated = []
+        for bucket in query:
+            plist = self.postings.get(bucket)
+            if plist is None or (len(plist[0]) > max_df and n_docs > 20):
+                continue
+            positions, weights, _ = plist
+            end = bisect_left(positions, cutoff)
+            if not end:
+                continue
+            df = len(positions)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            start = max(0, end - _MAX_POSTINGS)
+            for position, weight in zip(positions[start:end], weights[start:end]):
+                scores[position] = scores.get(position, 0.0) + idf * weight
+            if start:
+                truncated.append((idf, positions, weights, start))
+        if not scores:
+            return []
+        candidates = heapq.nlargest(max(k, _RESCORE), scores, key=scores.__getitem__) if truncated else list(scores)
+        for position in candidates:
+            for idf, positions, weights, start in truncated:
+                if position < positions[start]:
+                    j = bisect_left(positions, position, 0, start)
+                    if positions[j] == position:
+                        scores[position] += idf * weights[j]
+        best = heapq.nlargest(k, candidates, key=lambda p: (scores[p], p))
+        return [(scores[p], self.doc_ids[p]) for p in best]
+
+
+_indexes: "OrderedDict[int, ConversationIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(conversation_id: int) -> ConversationIndex:
+    with _indexes_lock:
+        index = _indexes.get(conversation_id)
+        if index is None:
+            index = ConversationIndex()
+            _indexes[conversation_id] = index
+        _indexes.move_to_end(conversation_id)
+        while len(_indexes) > _MAX_CACHED_CONVERSATIONS:
+            _indexes.popitem(last=False)
+    # Rattrapage incrémental: seuls les vecteurs écrits depuis le dernier chargement (tout process)
+    with index.lock:
+        for row in db.list_message_vectors(conversation_id, after_message_id=index.last_message_id):
+            index.add(int(row["message_id"]), vectors.unpack(row["terms"]))
+    return index
+
+
+_warming: Set[int] = set()
+_warm_lock = threading.Lock()
+_warm_executor: Optional[ThreadPoolExecutor] = None
+_warm_pid: Optional[int] = None
+
+
+def warm(conversation_id: int) -> None:
+    """Rattrapage de l'index en arrière-plan après une écriture: le tour suivant le trouve à jour."""
+    global _warm_executor, _warm_pid
+    with _warm_lock:
+        if conversation_id in _warming:
+            return
+        if _warm_executor is None or _warm_pid != os.getpid():
+            # Après un fork (workers de l'API), l'exécuteur du parent n'a plus de thread
+            _warm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recall-warm")
+            _warm_pid = os.getpid()
+        _warming.add(conversation_id)
+        _warm_executor.submit(_warm_job, conversation_id)
+
+
+def _warm_job(conversation_id: int) -> None:
+    try:
+        get_index(conversation_id)
+    except Exception:
+        # Best-effort: le tour refera le rattrapage lui-même
+        pass
+    finally:
+        with _warm_lock:
+            _warming.discard(conversation_id)
+
+
+def invalidate(conversation_id: int) -> None:
+    with _indexes_lock:
+        _indexes.pop(conversation_id, None)
+
+
+def recall(conversation_id: int, text: str, before_id: Optional[int], k: int = RECALL_TOP_K) -> List[Any]:
+    if before_id is None or k <= 0:
+        return []
+    index = get_index(conversation_id)
+    with index.lock:
+        hits = index.search(vectors.term_counts(text), k, before_id=before_id)
+    # Un message supprimé (reset dans un autre process) disparaît simplement des résultats
+    return db.get_messages_by_ids([message_id for _, message_id in hits])
+
+
+_RECALL_PREFIX = "Souvenirs pertinents de la conversation: "
+_RECALL_SEPARATOR = " | "
+# En dessous, un souvenir tronqué ne dit plus rien: on en garde moins
+_MIN_RECALL_CHARS = 40
+
+
+def recall_message(rows: List[Any], max_tokens: int = RECALL_TOKENS) -> Optional[Dict[str, Any]]:
+    # Tout le texte (préfixe, rôles, séparateurs compris) tient dans max_tokens
+    max_chars = max_tokens * history.CHARS_PER_TOKEN
+    rows = list(rows)
+    while rows:
+        labels = [f"{_ROLE_LABELS.get(r['role'], r['role'])}: " for r in rows]
+        framing = len(_RECALL_PREFIX) + sum(len(label) for label in labels) + len(_RECALL_SEPARATOR) * (len(rows) - 1)
+        per_message_chars = (max_chars - framing) // len(rows)
+        if per_message_chars >= _MIN_RECALL_CHARS:
+            break
+        # Les plus anciens sortent d'abord
+        rows = rows[1:]
+    if not rows:
+        return None
+    parts = []
+    for label, r in zip(labels, rows):
+        content = " ".join((r["content"] or "").split())
+        if len(content) > per_message_chars:
+            content = content[: per_message_chars - 1].rstrip() + "…"
+        parts.append(label + content)
+    return {"role": "system", "content": _RECALL_PREFIX + _RECALL_SEPARATOR.join(parts)}
+
+if RETRIEVAL_ENABLED:
+    db.set_message_listener(warm)
@@ -1,25 +1,1140 @@
-from typing import Any, Dict, List, Optional
+import hashlib
+import json
+import os
+import math
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from app import metrics
+
+_POOL_SIZE = int(os.environ.get("SINHOME_POOL_SIZE") or 32)
+_CONNECT_TIMEOUT_S = float(os.environ.get("SINHOME_CONNECT_TIMEOUT_S") or 3.05)
+_READ_TIMEOUT_S = float(os.environ.get("SINHOME_READ_TIMEOUT_S") or 60)
+
+# Cache de réponses (opt-in): mémoire LRU + niveau SQLite optionnel partagé entre process
+_CACHE_ENABLED = (os.environ.get("SINHOME_CACHE") or "").strip().lower() in ("1", "on", "true")
+_CACHE_SIZE = int(os.environ.get("SINHOME_CACHE_SIZE") or 512)
+_CACHE_TTL_S = float(os.environ.get("SINHOME_CACHE_TTL_S") or 3600)
+_CACHE_DB_PATH = os.environ.get("SINHOME_CACHE_DB") or ""
+# Champs du payload qui déterminent la réponse (session_id et stream n'en font pas partie)
+_CACHE_KEY_FIELDS = ("persona_data", "script", "media", "history", "message")
+
+# Retries: seulement les échecs sans génération côté backend (connexion refusée, 502/503, 429)
+_RETRIES = int(os.environ.get("SINHOME_RETRIES") or 2)
+_RETRY_BASE_S = float(os.environ.get("SINHOME_RETRY_BASE_S") or 0.25)
+_RETRY_MAX_S = float(os.environ.get("SINHOME_RETRY_MAX_S") or 4)
+_RETRY_STATUSES = (429, 502, 503)
+# Budget total d'un tour (tentatives, attentes et lecture du flux compris)
+TURN_DEADLINE_S = float(os.environ.get("SINHOME_TURN_DEADLINE_S") or 90)
+# Disjoncteur par endpoint: ouvert après N échecs consécutifs, un essai après le délai
+_BREAKER_FAILURES = int(os.environ.get("SINHOME_BREAKER_FAILURES") or 5)
+_BREAKER_COOLDOWN_S = float(os.environ.get("SINHOME_BREAKER_COOLDOWN_S") or 30)
+# Pool de backends: SINHOME_API_URL (ou l'URL de la sidebar) peut lister plusieurs URLs séparées par des virgules
+_LB_POLICY = (os.environ.get("SINHOME_LB_POLICY") or "least_outstanding").strip().lower()  # ou "ewma"
+_EWMA_DECAY_S = float(os.environ.get("SINHOME_EWMA_DECAY_S") or 30)
+# Au-delà de N appels en cours sur son backend, une conversation est routée ailleurs (0: jamais)
+_STICKY_MAX_OUTSTANDING = int(os.environ.get("SINHOME_STICKY_MAX_OUTSTANDING") or 8)
+_HEALTH_PATH = os.environ.get("SINHOME_HEALTH_PATH") or "/health"
+_HEALTH_INTERVAL_S = float(os.environ.get("SINHOME_HEALTH_INTERVAL_S") or 10)
+_HEALTH_TIMEOUT_S = float(os.environ.get("SINHOME_HEALTH_TIMEOUT_S") or 2)
+# Pools (une par valeur de SINHOME_API_URL utilisée) gardées par client; au-delà, les inactives sont fermées
+_MAX_POOLS = 8
+# Hedging (opt-in, appels non streamés): 2e backend sollicité si pas de réponse après N ms
+_HEDGE_AFTER_MS = float(os.environ.get("SINHOME_HEDGE_AFTER_MS") or 0)
+_STREAM_HEADERS = {"Accept": "text/event-stream, application/x-ndjson, application/json"}
 
 
 class SinhomeClientError(RuntimeError):
-    pass
+    def __init__(
+        self,
+        message: str,
+        status: Optional[int] = None,
+        retryable: bool = False,
+        retry_after_s: Optional[float] = None,
+    ) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after_s = retry_after_s
+
+
+class SinhomeUnavailableError(SinhomeClientError):
+    """Disjoncteur ouvert: échec immédiat, sans appel réseau."""
 
 
-def _post(url: str, payload: Dict[str, Any], timeout_s: int = 60) -> str:
+class SinhomeDeadlineError(SinhomeClientError):
+    """Budget du tour (deadline) épuisé."""
+
+
+_deadline_local = threading.local()
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """Borne tous les appels Sinhome_llm du bloc (même thread); un bloc imbriqué ne peut que raccourcir."""
+    previous = getattr(_deadline_local, "at", None)
+    at = time.monotonic() + seconds if seconds and seconds > 0 else None
+    if previous is not None and (at is None or previous < at):
+        at = previous
+    _deadline_local.at = at
     try:
-        resp = requests.post(url, json=payload, timeout=timeout_s)
-    except requests.RequestException as e:
-        raise SinhomeClientError(str(e)) from e
+        yield
+    finally:
+        _deadline_local.at = previous
+
+
+def remaining_s() -> Optional[float]:
+    at = getattr(_deadline_local, "at", None)
+    return None if at is None else at - time.monotonic()
+
+
+def _check_deadline() -> None:
+    remaining = remaining_s()
+    if remaining is not None and remaining <= 0:
+        raise SinhomeDeadlineError("Deadline du tour dépassée")
+
+
+def _is_connect_error(e: requests.RequestException) -> bool:
+    # Requête jamais reçue par le backend: la rejouer ne peut pas doubler une génération
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and type(reason).__name__ == "NewConnectionError"
+
+
+def _retry_after_s(resp: requests.Response) -> Optional[float]:
+    raw = (resp.headers.get("Retry-After") or "").strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(raw).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _chunk_text(data: Any) -> str:
+    if isinstance(data, dict):
+        for key in ("token", "delta", "text", "response"):
+            if key in data and data[key] is not None:
+                return str(data[key])
+        if data.get("error"):
+            raise SinhomeClientError(f"Stream error: {data['error']}")
+        return ""
+    return "" if data is None else str(data)
+
+
+def _iter_sse(resp: requests.Response) -> Iterator[str]:
+    data_lines: List[str] = []
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data_lines:
+                raw = "\n".join(data_lines)
+                data_lines = []
+                if raw.strip() == "[DONE]":
+                    return
+                try:
+                    text = _chunk_text(json.loads(raw))
+                except ValueError:
+                    text = raw
+                if text:
+                    yield text
+            continue
+        if line.startswith("data:"):
+            data_lines.append(line[5:].lstrip(" ") if line.startswith("data: ") else line[5:])
+    if data_lines:
+        raw = "\n".join(data_lines)
+        if raw.strip() != "[DONE]":
+            yield raw
+
+
+def _iter_ndjson(resp: requests.Response) -> Iterator[str]:
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line:
+            continue
+        try:
+            text = _chunk_text(json.loads(line))
+        except ValueError as e:
+            raise SinhomeClientError(f"Unexpected stream line: {line}") from e
+        if text:
+            yield text
+
+
+def _endpoint_name(url: str) -> str:
+    return url.rstrip("/").rsplit("/", 1)[-1].split("?", 1)[0] or "unknown"
+
+
+def cache_key(endpoint: str, payload: Dict[str, Any]) -> str:
+    """Hash stable (JSON canonique) de l'endpoint et du contenu de la requête."""
+    content = {"endpoint": endpoint, **{k: payload.get(k) for k in _CACHE_KEY_FIELDS}}
+    raw = json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Réponses Sinhome_llm déjà générées, par contenu de requête (LRU mémoire + SQLite avec TTL)."""
+
+    def __init__(self, size: int = _CACHE_SIZE, ttl_s: float = _CACHE_TTL_S, db_path: str = _CACHE_DB_PATH) -> None:
+        self.size = max(1, size)
+        self.ttl_s = ttl_s
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.counts: Dict[str, int] = {"hit_memory": 0, "hit_sqlite": 0, "miss": 0, "store": 0}
+        self._db: Optional[sqlite3.Connection] = None
+        self._puts = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, endpoint TEXT NOT NULL, response TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _count(self, name: str) -> None:
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def get(self, key: str, endpoint: str) -> Optional[str]:
+        started = time.perf_counter()
+        now = time.time()
+        with self.lock:
+            hit = self.entries.get(key)
+            if hit is not None and now - hit[0] <= self.ttl_s:
+                self.entries.move_to_end(key)
+                self._count("hit_memory")
+                metrics.record_cache(endpoint, "hit", "memory", time.perf_counter() - started)
+                return hit[1]
+            if hit is not None:
+                del self.entries[key]
+            row = None
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT response, created_at FROM responses WHERE key = ? AND created_at >= ?",
+                    (key, now - self.ttl_s),
+                ).fetchone()
+            if row is not None:
+                self._remember(key, float(row[1]), str(row[0]))
+                self._count("hit_sqlite")
+                metrics.record_cache(endpoint, "hit", "sqlite", time.perf_counter() - started)
+                return str(row[0])
+            self._count("miss")
+        metrics.record_cache(endpoint, "miss")
+        return None
+
+    def put(self, key: str, endpoint: str, response: str) -> None:
+        now = time.time()
+        with self.lock:
+            self._remember(key, now, response)
+            self._count("store")
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses(key, endpoint, response, created_at) VALUES (?, ?, ?, ?)",
+                (key, endpoint, response, now),
+            )
+            self._puts += 1
+            if self._puts % 256 == 0:
+                # Purge des entrées expirées de temps en temps, pas à chaque écriture
+                self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_s,))
+            self._db.commit()
+
+    def _remember(self, key: str, created_at: float, response: str) -> None:
+        self.entries[key] = (created_at, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {**self.counts, "entries": len(self.entries)}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class CircuitBreaker:
+    """closed -> open après N échecs consécutifs -> half_open (un seul appel d'essai) après le délai."""
+
+    def __init__(self, url: str, failure_threshold: int = _BREAKER_FAILURES, cooldown_s: float = _BREAKER_COOLDOWN_S) -> None:
+        self.url = url
+        self.endpoint = _endpoint_name(url)
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_s = cooldown_s
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.last_error = ""
+
+    def before_call(self) -> None:
+        with self.lock:
+            if self.state == "closed":
+                return
+            if self.state == "open":
+                wait = self.opened_at + self.cooldown_s - time.monotonic()
+                if wait > 0:
+                    raise SinhomeUnavailableError(
+                        f"{self.endpoint}: Sinhome_llm indisponible (circuit ouvert, nouvel essai dans {wait:.0f} s)"
+                    )
+                self._set_state("half_open")
+            if self.probing:
+                raise SinhomeUnavailableError(f"{self.endpoint}: Sinhome_llm en cours de vérification")
+            self.probing = True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_failure(self, error: str) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            self.last_error = error[:300]
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != "open":
+                    self._set_state("open")
+
+    def is_open(self) -> bool:
+        # Ouvert et délai pas encore écoulé: l'appel échouerait immédiatement
+        with self.lock:
+            return self.state == "open" and time.monotonic() < self.opened_at + self.cooldown_s
+
+    def release(self) -> None:
+        # Appel d'essai abandonné sans verdict (deadline, exception locale)
+        with self.lock:
+            self.probing = False
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        metrics.record_breaker(self.endpoint, state)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            retry_in = max(0.0, self.opened_at + self.cooldown_s - time.monotonic()) if self.state == "open" else 0.0
+            return {
+                "url": self.url,
+                "endpoint": self.endpoint,
+                "state": self.state,
+                "failures": self.failures,
+                "retry_in_s": round(retry_in, 1),
+                "last_error": self.last_error,
+            }
+
+
+def parse_backends(api_base_url: str) -> List[str]:
+    """"http://gpu1:8000, http://gpu2:8000" -> URLs de base distinctes, dans l'ordre."""
+    bases: List[str] = []
+    for part in (api_base_url or "").split(","):
+        base = part.strip().rstrip("/")
+        if base and base not in bases:
+            bases.append(base)
+    return bases
+
+
+def _can_fail_over(e: SinhomeClientError) -> bool:
+    # Même critère que les retries (aucune génération commencée), plus le disjoncteur ouvert
+    return not isinstance(e, SinhomeDeadlineError) and (e.retryable or isinstance(e, SinhomeUnavailableError))
+
+
+class Backend:
+    """Un serveur Sinhome_llm du pool: appels en cours, latence EWMA, verdict du health check."""
+
+    def __init__(self, base: str) -> None:
+        self.base = base
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.ewma_s: Optional[float] = None
+        self._ewma_at = 0.0
+        self.healthy = True
+        self.last_check = 0.0
+        self.last_error = ""
+        self.requests = 0
+
+    def begin(self) -> None:
+        with self.lock:
+            self.outstanding += 1
+            self.requests += 1
+
+    def end(self) -> None:
+        with self.lock:
+            self.outstanding -= 1
+
+    def observe(self, latency_s: float) -> None:
+        # EWMA pondérée par le temps écoulé: un backend peu sollicité oublie vite ses vieilles mesures
+        now = time.monotonic()
+        with self.lock:
+            if self.ewma_s is None:
+                self.ewma_s = latency_s
+            else:
+                w = math.exp(-(now - self._ewma_at) / _EWMA_DECAY_S)
+                self.ewma_s = self.ewma_s * w + latency_s * (1 - w)
+            self._ewma_at = now
+
+    def set_health(self, healthy: bool, error: str = "") -> None:
+        with self.lock:
+            changed = healthy != self.healthy
+            self.healthy = healthy
+            self.last_check = time.time()
+            if error:
+                self.last_error = error[:300]
+        if changed:
+            metrics.record_backend_health(self.base, "up" if healthy else "down")
+
+    def load(self, policy: str) -> Tuple[float, float]:
+        if policy == "ewma":
+            # Latence attendue si on ajoute un appel (backend jamais mesuré: essayé en priorité)
+            return ((self.ewma_s or 0.0) * (self.outstanding + 1), self.outstanding)
+        return (self.outstanding, self.ewma_s or 0.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "url": self.base,
+                "healthy": self.healthy,
+                "outstanding": self.outstanding,
+                "ewma_ms": round(self.ewma_s * 1000, 1) if self.ewma_s is not None else None,
+                "requests": self.requests,
+                "last_check": self.last_check,
+                "last_error": self.last_error,
+            }
+
+
+class _HealthChecker:
+    """Un seul thread par process vérifie tous les pools vivants (aucun thread par pool)."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pools: "weakref.WeakSet[BackendPool]" = weakref.WeakSet()
+        self.wake = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.pid: Optional[int] = None
+
+    def register(self, pool: "BackendPool") -> None:
+        with self.lock:
+            self.pools.add(pool)
+            # Après un fork, le thread du parent n'existe pas dans l'enfant
+            if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._loop, name="sinhome-health", daemon=True)
+                self.thread.start()
+        # Premier check tout de suite
+        self.wake.set()
+
+    def unregister(self, pool: "BackendPool") -> None:
+        with self.lock:
+            self.pools.discard(pool)
+
+    def _loop(self) -> None:
+        while True:
+            self.wake.clear()
+            with self.lock:
+                pools = list(self.pools)
+            for pool in pools:
+                pool.check_health()
+            del pools
+            self.wake.wait(_HEALTH_INTERVAL_S)
+
+
+_health_checker = _HealthChecker()
+
+
+class BackendPool:
+    """Routage entre plusieurs Sinhome_llm.
+
+    Une conversation (session_id) reste sur le même backend tant qu'il est sain et pas surchargé
+    (rendezvous hashing: seules les sessions d'un backend qui tombe sont redistribuées), pour garder
+    chaud le cache de session côté serveur. Sinon: moins d'appels en cours, ou latence EWMA
+    (SINHOME_LB_POLICY=ewma). Bascule sur le backend suivant si l'appel échoue sans génération.
+    """
+
+    def __init__(self, client: "SinhomeClient", bases: List[str], policy: str = _LB_POLICY, hedge_after_ms: float = _HEDGE_AFTER_MS) -> None:
+        self.client = client
+        self.backends = [Backend(b) for b in bases]
+        self.policy = policy
+        self.hedge_after_s = max(0.0, hedge_after_ms) / 1000
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        _health_checker.register(self)
+
+    # --- Health checks ---
+
+    def check_health(self) -> None:
+        for backend in self.backends:
+            try:
+                resp = self.client.session.get(f"{backend.base}{_HEALTH_PATH}", timeout=_HEALTH_TIMEOUT_S)
+                resp.close()
+            except requests.RequestException as e:
+                backend.set_health(False, str(e))
+                continue
+            # 404: serveur vivant sans route de santé; seul un 5xx le déclare malade
+            if resp.status_code >= 500:
+                backend.set_health(False, f"HTTP {resp.status_code} sur {_HEALTH_PATH}")
+            else:
+                backend.set_health(True)
+
+    def outstanding(self) -> int:
+        return sum(b.outstanding for b in self.backends)
+
+    def close(self) -> None:
+        _health_checker.unregister(self)
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    # --- Routage ---
+
+    def _available(self, backend: Backend, endpoint: str) -> bool:
+        if not backend.healthy:
+            return False
+        return not self.client.breaker(self.client._url(backend.base, endpoint)).is_open()
+
+    def route(self, endpoint: str, session_id: Optional[str]) -> List[Backend]:
+        """Backends dans l'ordre d'essai: le premier reçoit l'appel, les suivants la bascule / couverture."""
+        available = [b for b in self.backends if self._available(b, endpoint)]
+        if not available:
+            # Tout est marqué en panne: on tente quand même (le disjoncteur décide)
+            available = list(self.backends)
+        by_load = sorted(available, key=lambda b: b.load(self.policy))
+        if not session_id:
+            return by_load
+        sticky = max(
+            available,
+            key=lambda b: hashlib.sha1(f"{session_id}|{b.base}".encode("utf-8")).digest(),
+        )
+        if _STICKY_MAX_OUTSTANDING and sticky.outstanding >= _STICKY_MAX_OUTSTANDING and by_load[0].outstanding < sticky.outstanding:
+            return by_load
+        return [sticky] + [b for b in by_load if b is not sticky]
+
+    # --- Appels ---
+
+    def _call(self, backend: Backend, endpoint: str, payload: Dict[str, Any], read_timeout_s: Optional[float], retries: Optional[int]) -> str:
+        backend.begin()
+        started = time.perf_counter()
+        try:
+            response = self.client._post(self.client._url(backend.base, endpoint), payload, read_timeout_s, retries=retries)
+        except SinhomeClientError as e:
+            self._failed(backend, e)
+            raise
+        finally:
+            backend.end()
+        backend.observe(time.perf_counter() - started)
+        metrics.record_backend(backend.base, "ok")
+        return response
+
+    def _failed(self, backend: Backend, e: SinhomeClientError) -> None:
+        metrics.record_backend(backend.base, "error")
+        if e.status is None and e.retryable:
+            # Connexion refusée: écarté sans attendre le prochain health check
+            backend.set_health(False, str(e))
+
+    def post(self, endpoint: str, payload: Dict[str, Any], read_timeout_s: Optional[float] = None) -> str:
+        candidates = self.route(endpoint, payload.get("session_id"))
+        if self.hedge_after_s > 0 and len(candidates) > 1:
+            return self._post_hedged(candidates, endpoint, payload, read_timeout_s)
+        error: Optional[SinhomeClientError] = None
+        for i, backend in enumerate(candidates):
+            last = i == len(candidates) - 1
+            try:
+                # Avec un autre backend derrière, la bascule remplace les retries sur le même serveur
+                return self._call(backend, endpoint, payload, read_timeout_s, retries=None if last else 0)
+            except SinhomeClientError as e:
+                if last or not _can_fail_over(e):
+                    raise
+                error = error or e
+        raise error or SinhomeClientError("Aucun backend Sinhome_llm")
+
+    def _post_hedged(self, candidates: List[Backend], endpoint: str, payload: Dict[str, Any], read_timeout_s: Optional[float]) -> str:
+        # Les appels partent dans des threads: on leur transmet la deadline et le tour en cours
+        at = getattr(_deadline_local, "at", None)
+        turn = metrics.current_turn()
+
+        def run(backend: Backend, retries: Optional[int]) -> str:
+            _deadline_local.at = at
+            try:
+                with metrics.bind_turn(turn):
+                    return self._call(backend, endpoint, payload, read_timeout_s, retries)
+            finally:
+                _deadline_local.at = None
+
+        spare = list(candidates)
+        pending: Dict["Future[str]", Backend] = {}
+        hedged = False
+        error: Optional[SinhomeClientError] = None
+
+        def launch() -> None:
+            backend = spare.pop(0)
+            pending[self._pool_executor().submit(run, backend, None if not spare else 0)] = backend
+
+        launch()
+        while pending:
+            done, _ = wait(list(pending), timeout=None if hedged or not spare else self.hedge_after_s, return_when=FIRST_COMPLETED)
+            if not done:
+                # Pas de réponse dans le délai: un seul appel de couverture, sur le backend suivant
+                hedged = True
+                metrics.record_hedge(endpoint, "sent")
+                launch()
+                continue
+            for future in done:
+                backend = pending.pop(future)
+                try:
+                    response = future.result()
+                except SinhomeClientError as e:
+                    error = error or e
+                    if spare and not pending and _can_fail_over(e):
+                        launch()
+                    continue
+                if hedged:
+                    # Le perdant n'est pas annulable (requests): il termine en arrière-plan, réponse ignorée
+                    metrics.record_hedge(endpoint, "won" if backend is not candidates[0] else "lost")
+                return response
+        raise error or SinhomeClientError("Aucun backend Sinhome_llm")
+
+    def _pool_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=_POOL_SIZE, thread_name_prefix="sinhome-hedge")
+            return self._executor
 
-    if resp.status_code >= 400:
-        raise SinhomeClientError(f"HTTP {resp.status_code}: {resp.text}")
+    def post_stream(self, endpoint: str, payload: Dict[str, Any], read_timeout_s: Optional[float] = None) -> Iterator[str]:
+        # Pas de hedging en streaming (deux générations lues en parallèle); bascule avant le 1er morceau
+        candidates = self.route(endpoint, payload.get("session_id"))
+        for i, backend in enumerate(candidates):
+            last = i == len(candidates) - 1
+            started = time.perf_counter()
+            first = True
+            backend.begin()
+            try:
+                for chunk in self.client._post_stream(
+                    self.client._url(backend.base, endpoint), payload, read_timeout_s, retries=None if last else 0
+                ):
+                    if first:
+                        # En streaming, la latence suivie est le délai du premier morceau
+                        first = False
+                        backend.observe(time.perf_counter() - started)
+                    yield chunk
+            except SinhomeClientError as e:
+                self._failed(backend, e)
+                if last or not first or not _can_fail_over(e):
+                    raise
+                continue
+            finally:
+                backend.end()
+            metrics.record_backend(backend.base, "ok")
+            return
 
-    data = resp.json()
-    if not isinstance(data, dict) or "response" not in data:
-        raise SinhomeClientError(f"Unexpected response: {data}")
-    return str(data["response"])
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [b.snapshot() for b in self.backends]
+
+
+class SinhomeClient:
+    """Client HTTP Sinhome_llm: une Session keep-alive partagée par tout le process."""
+
+    def __init__(
+        self,
+        pool_size: int = _POOL_SIZE,
+        connect_timeout_s: float = _CONNECT_TIMEOUT_S,
+        read_timeout_s: float = _READ_TIMEOUT_S,
+        cache: Optional[ResponseCache] = None,
+    ) -> None:
+        self.cache = cache
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._breakers_lock = threading.Lock()
+        self._pools: "OrderedDict[Tuple[str, ...], BackendPool]" = OrderedDict()
+        self.connect_timeout_s = connect_timeout_s
+        self.read_timeout_s = read_timeout_s
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+
+    def _timeout(self, read_timeout_s: Optional[float] = None) -> Tuple[float, float]:
+        connect = self.connect_timeout_s
+        read = read_timeout_s if read_timeout_s is not None else self.read_timeout_s
+        remaining = remaining_s()
+        if remaining is None:
+            return (connect, read)
+        _check_deadline()
+        return (min(connect, remaining), min(read, remaining))
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            b = self._breakers.get(url)
+            if b is None:
+                b = self._breakers[url] = CircuitBreaker(url)
+            return b
+
+    def breaker_states(self) -> List[Dict[str, Any]]:
+        with self._breakers_lock:
+            breakers = list(self._breakers.values())
+        return [b.snapshot() for b in breakers]
+
+    def pool(self, bases: List[str]) -> BackendPool:
+        evicted = []
+        with self._breakers_lock:
+            p = self._pools.get(tuple(bases))
+            if p is None:
+                p = self._pools[tuple(bases)] = BackendPool(self, bases)
+            self._pools.move_to_end(tuple(bases))
+            # URL saisies puis abandonnées (barre latérale): on ferme les plus anciennes sans appel en cours
+            for key, old in list(self._pools.items())[:-1]:
+                if len(self._pools) <= _MAX_POOLS:
+                    break
+                if not old.outstanding():
+                    evicted.append(self._pools.pop(key))
+        for old in evicted:
+            old.close()
+        return p
+
+    def backend_states(self) -> List[Dict[str, Any]]:
+        with self._breakers_lock:
+            pools = list(self._pools.values())
+        return [b for p in pools for b in p.snapshot()]
+
+    def _retry_delay(self, error: SinhomeClientError, attempt: int, retries: Optional[int] = None) -> Optional[float]:
+        if not error.retryable or attempt >= (_RETRIES if retries is None else retries):
+            return None
+        # Backoff exponentiel "full jitter"; Retry-After du 429 prioritaire
+        delay = random.uniform(0, min(_RETRY_MAX_S, _RETRY_BASE_S * (2 ** attempt)))
+        if error.retry_after_s is not None:
+            delay = error.retry_after_s + random.uniform(0, _RETRY_BASE_S)
+        # Pas de retry si l'attente dépasse ce qu'il reste du budget du tour
+        remaining = remaining_s()
+        if delay >= (remaining if remaining is not None else self.read_timeout_s):
+            return None
+        return delay
+
+    def _send(
+        self, url: str, payload: Dict[str, Any], read_timeout_s: Optional[float], stream: bool, retries: Optional[int] = None
+    ) -> Tuple[requests.Response, float]:
+        """Tentatives jusqu'à une réponse < 400 (corps non lu si stream); renvoie (réponse, début)."""
+        endpoint = _endpoint_name(url)
+        breaker = self.breaker(url)
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                return self._attempt(url, payload, read_timeout_s, stream, breaker)
+            except SinhomeClientError as e:
+                delay = self._retry_delay(e, attempt, retries)
+                if delay is None:
+                    raise
+                metrics.record_retry(endpoint, str(e.status) if e.status else "connect", delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _attempt(
+        self,
+        url: str,
+        payload: Dict[str, Any],
+        read_timeout_s: Optional[float],
+        stream: bool,
+        breaker: CircuitBreaker,
+    ) -> Tuple[requests.Response, float]:
+        endpoint = _endpoint_name(url)
+        started = time.perf_counter()
+        try:
+            timeout = self._timeout(read_timeout_s)
+            resp = self.session.post(
+                url, json=payload, timeout=timeout, stream=stream, headers=_STREAM_HEADERS if stream else None
+            )
+        except requests.RequestException as e:
+            metrics.record_http(endpoint, "error", 0, 0, time.perf_counter() - started)
+            remaining = remaining_s()
+            if isinstance(e, requests.Timeout) and remaining is not None and remaining <= 0.05:
+                # Timeout raccourci par notre propre deadline: rien à reprocher au backend
+                breaker.release()
+                raise SinhomeDeadlineError(f"Deadline du tour dépassée ({e})") from e
+            breaker.record_failure(str(e))
+            raise SinhomeClientError(str(e), retryable=_is_connect_error(e)) from e
+        except BaseException:
+            breaker.release()
+            raise
+        if resp.status_code < 400:
+            breaker.record_success()
+            return resp, started
+        with resp:
+            text = resp.text
+        if resp.status_code >= 500:
+            breaker.record_failure(f"HTTP {resp.status_code}")
+        else:
+            # 4xx / 429: le backend répond, il n'est pas en panne
+            breaker.record_success()
+        metrics.record_http(
+            endpoint, str(resp.status_code), len(resp.request.body or b""), len(resp.content), time.perf_counter() - started
+        )
+        raise SinhomeClientError(
+            f"HTTP {resp.status_code}: {text}",
+            status=resp.status_code,
+            retryable=resp.status_code in _RETRY_STATUSES,
+            retry_after_s=_retry_after_s(resp) if resp.status_code == 429 else None,
+        )
+
+    def post(self, url: str, payload: Dict[str, Any], read_timeout_s: Optional[float] = None) -> str:
+        return self._cached(_endpoint_name(url), payload, lambda: self._post(url, payload, read_timeout_s))
+
+    def _cached(self, endpoint: str, payload: Dict[str, Any], fetch: Callable[[], str]) -> str:
+        if self.cache is None:
+            return fetch()
+        key = cache_key(endpoint, payload)
+        cached = self.cache.get(key, endpoint)
+        if cached is not None:
+            return cached
+        response = fetch()
+        self.cache.put(key, endpoint, response)
+        return response
+
+    def _post(self, url: str, payload: Dict[str, Any], read_timeout_s: Optional[float] = None, retries: Optional[int] = None) -> str:
+        resp, started = self._send(url, payload, read_timeout_s, stream=False, retries=retries)
+        try:
+            data = resp.json()
+            if not isinstance(data, dict) or "response" not in data:
+                raise SinhomeClientError(f"Unexpected response: {data}")
+            return str(data["response"])
+        finally:
+            metrics.record_http(
+                _endpoint_name(url),
+                str(resp.status_code),
+                len(resp.request.body or b""),
+                len(resp.content),
+                time.perf_counter() - started,
+            )
+
+    def post_stream(self, url: str, payload: Dict[str, Any], read_timeout_s: Optional[float] = None) -> Iterator[str]:
+        return self._cached_stream(_endpoint_name(url), payload, lambda: self._post_stream(url, payload, read_timeout_s))
+
+    def _cached_stream(self, endpoint: str, payload: Dict[str, Any], open_stream: Callable[[], Iterator[str]]) -> Iterator[str]:
+        if self.cache is None:
+            yield from open_stream()
+            return
+        key = cache_key(endpoint, payload)
+        cached = self.cache.get(key, endpoint)
+        if cached is not None:
+            yield cached
+            return
+        parts: List[str] = []
+        for chunk in open_stream():
+            parts.append(chunk)
+            yield chunk
+        # Seulement un flux lu jusqu'au bout (pas d'erreur, pas d'abandon par l'appelant)
+        if parts:
+            self.cache.put(key, endpoint, "".join(parts))
+
+    def _post_stream(
+        self, url: str, payload: Dict[str, Any], read_timeout_s: Optional[float] = None, retries: Optional[int] = None
+    ) -> Iterator[str]:
+        # Demande une réponse incrémentale (SSE, NDJSON ou texte chunked); si le serveur
+        # répond en JSON classique, on renvoie la réponse complète en un seul morceau.
+        # Retries uniquement avant le premier morceau (statut / connexion).
+        resp, started = self._send(url, {**payload, "stream": True}, read_timeout_s, stream=True, retries=retries)
+        sent = len(resp.request.body or b"")
+        received = 0
+        first_chunk_s: Optional[float] = None
+        try:
+            with resp:
+                for chunk in self._iter_stream(resp):
+                    _check_deadline()
+                    if first_chunk_s is None:
+                        first_chunk_s = time.perf_counter() - started
+                    received += len(chunk.encode("utf-8"))
+                    yield chunk
+        except SinhomeDeadlineError:
+            raise
+        except SinhomeClientError as e:
+            # Flux coupé ou bloqué en cours de génération
+            self.breaker(url).record_failure(str(e))
+            raise
+        finally:
+            metrics.record_http(
+                _endpoint_name(url),
+                str(resp.status_code),
+                sent,
+                received,
+                time.perf_counter() - started,
+                first_chunk_s=first_chunk_s,
+            )
+
+    def _iter_stream(self, resp: requests.Response) -> Iterator[str]:
+        raw_content_type = resp.headers.get("Content-Type") or ""
+        content_type = raw_content_type.split(";")[0].strip().lower()
+        if "charset=" not in raw_content_type.lower():
+            # Sans charset, requests décode text/* en ISO-8859-1 (mojibake sur les accents)
+            resp.encoding = "utf-8"
+        try:
+            if content_type == "text/event-stream":
+                yield from _iter_sse(resp)
+            elif content_type in ("application/x-ndjson", "application/jsonl"):
+                yield from _iter_ndjson(resp)
+            elif content_type == "application/json":
+                data = resp.json()
+                if not isinstance(data, dict) or "response" not in data:
+                    raise SinhomeClientError(f"Unexpected response: {data}")
+                yield str(data["response"])
+            else:
+                for chunk in resp.iter_content(chunk_size=None, decode_unicode=True):
+                    if chunk:
+                        yield chunk
+        except requests.RequestException as e:
+            raise SinhomeClientError(str(e)) from e
+
+    def close_pools(self) -> None:
+        with self._breakers_lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for p in pools:
+            p.close()
+
+    def close(self) -> None:
+        self.close_pools()
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def _url(self, api_base_url: str, endpoint: str) -> str:
+        return f"{api_base_url.rstrip('/')}/{endpoint}"
+
+    def _call(self, api_base_url: str, endpoint: str, payload: Dict[str, Any]) -> str:
+        bases = parse_backends(api_base_url)
+        if len(bases) <= 1:
+            return self.post(self._url(api_base_url, endpoint), payload)
+        pool = self.pool(bases)
+        return self._cached(endpoint, payload, lambda: pool.post(endpoint, payload))
+
+    def _call_stream(self, api_base_url: str, endpoint: str, payload: Dict[str, Any]) -> Iterator[str]:
+        bases = parse_backends(api_base_url)
+        if len(bases) <= 1:
+            return self.post_stream(self._url(api_base_url, endpoint), payload)
+        pool = self.pool(bases)
+        return self._cached_stream(endpoint, payload, lambda: pool.post_stream(endpoint, payload))
+
+    def personality_chat(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Dict[str, Any],
+    ) -> str:
+        return self._call(
+            api_base_url,
+            "personality_chat",
+            _personality_payload(session_id, message, history, persona_data),
+        )
+
+    def personality_chat_stream(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Dict[str, Any],
+    ) -> Iterator[str]:
+        return self._call_stream(
+            api_base_url,
+            "personality_chat",
+            _personality_payload(session_id, message, history, persona_data),
+        )
+
+    def script_chat(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Dict[str, Any],
+        script: str,
+    ) -> str:
+        return self._call(
+            api_base_url,
+            "script_chat",
+            _script_payload(session_id, message, history, persona_data, script),
+        )
+
+    def script_chat_stream(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Dict[str, Any],
+        script: str,
+    ) -> Iterator[str]:
+        return self._call_stream(
+            api_base_url,
+            "script_chat",
+            _script_payload(session_id, message, history, persona_data, script),
+        )
+
+    def script_media(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Dict[str, Any],
+        script: str,
+        media: str,
+    ) -> str:
+        return self._call(
+            api_base_url,
+            "script_media",
+            _media_payload(session_id, message, history, persona_data, script, media),
+        )
+
+    def script_media_stream(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Dict[str, Any],
+        script: str,
+        media: str,
+    ) -> Iterator[str]:
+        return self._call_stream(
+            api_base_url,
+            "script_media",
+            _media_payload(session_id, message, history, persona_data, script, media),
+        )
+
+    def unpersona_chat(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        return self._call(
+            api_base_url,
+            "unpersona_chat",
+            _personality_payload(session_id, message, history, persona_data),
+        )
+
+    def unpersona_chat_stream(
+        self,
+        api_base_url: str,
+        session_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]],
+        persona_data: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        return self._call_stream(
+            api_base_url,
+            "unpersona_chat",
+            _personality_payload(session_id, message, history, persona_data),
+        )
+
+
+def _personality_payload(
+    session_id: Optional[str],
+    message: str,
+    history: List[Dict[str, Any]],
+    persona_data: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    return {
+        "session_id": session_id,
+        "message": message,
+        "history": history,
+        "persona_data": persona_data,
+    }
+
+
+def _script_payload(
+    session_id: Optional[str],
+    message: str,
+    history: List[Dict[str, Any]],
+    persona_data: Dict[str, Any],
+    script: str,
+) -> Dict[str, Any]:
+    return {**_personality_payload(session_id, message, history, persona_data), "script": script}
+
+
+def _media_payload(
+    session_id: Optional[str],
+    message: str,
+    history: List[Dict[str, Any]],
+    persona_data: Dict[str, Any],
+    script: str,
+    media: str,
+) -> Dict[str, Any]:
+    return {**_script_payload(session_id, message, history, persona_data, script), "media": media}
+
+
+_client: Optional[SinhomeClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> SinhomeClient:
+    # Module importé une fois par process Streamlit: le client est partagé par toutes les sessions.
+    # Après un fork (workers de `python -m app serve`), chaque process ouvre ses propres sockets.
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                if _client is not None:
+                    # Client hérité du parent: on libère ses pools (pas sa session, dont les
+                    # sockets appartiennent encore au parent)
+                    _client.close_pools()
+                _client = SinhomeClient(cache=ResponseCache() if _CACHE_ENABLED else None)
+                _client_pid = os.getpid()
+    return _client
+
+
+def breaker_states(api_base_url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """État des disjoncteurs du process (filtré sur une URL de base, ou une liste, si fournie)."""
+    states = get_client().breaker_states()
+    if api_base_url:
+        prefixes = tuple(f"{base}/" for base in parse_backends(api_base_url))
+        states = [b for b in states if b["url"].startswith(prefixes)]
+    return states
+
+
+def backend_states(api_base_url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Backends des pools du process (un pool n'existe qu'après un premier appel multi-URL)."""
+    states = get_client().backend_states()
+    if api_base_url:
+        bases = parse_backends(api_base_url)
+        states = [b for b in states if b["url"] in bases]
+    return states
+
+
+def _post(url: str, payload: Dict[str, Any], timeout_s: Optional[float] = None) -> str:
+    return get_client().post(url, payload, read_timeout_s=timeout_s)
 
 
 def personality_chat(
@@ -29,15 +1144,17 @@ def personality_chat(
     history: List[Dict[str, Any]],
     persona_data: Dict[str, Any],
 ) -> str:
-    return _post(
-        f"{api_base_url.rstrip('/')}/personality_chat",
-        {
-            "session_id": session_id,
-            "message": message,
-            "history": history,
-            "persona_data": persona_data,
-        },
-    )
+    return get_client().personality_chat(api_base_url, session_id, message, history, persona_data)
+
+
+def personality_chat_stream(
+    api_base_url: str,
+    session_id: Optional[str],
+    message: str,
+    history: List[Dict[str, Any]],
+    persona_data: Dict[str, Any],
+) -> Iterator[str]:
+    return get_client().personality_chat_stream(api_base_url, session_id, message, history, persona_data)
 
 
 def script_chat(
@@ -48,16 +1165,18 @@ def script_chat(
     persona_data: Dict[str, Any],
     script: str,
 ) -> str:
-    return _post(
-        f"{api_base_url.rstrip('/')}/script_chat",
-        {
-            "session_id": session_id,
-            "message": message,
-            "history": history,
-            "persona_data": persona_data,
-            "script": script,
-        },
-    )
+    return get_client().script_chat(api_base_url, session_id, message, history, persona_data, script)
+
+
+def script_chat_stream(
+    api_base_url: str,
+    session_id: Optional[str],
+    message: str,
+    history: List[Dict[str, Any]],
+    persona_data: Dict[str, Any],
+    script: str,
+) -> Iterator[str]:
+    return get_client().script_chat_stream(api_base_url, session_id, message, history, persona_data, script)
 
 
 def script_media(
@@ -69,17 +1188,19 @@ def script_media(
     script: str,
     media: str,
 ) -> str:
-    return _post(
-        f"{api_base_url.rstrip('/')}/script_media",
-        {
-            "session_id": session_id,
-            "message": message,
-            "history": history,
-            "persona_data": persona_data,
-            "script": script,
-            "media": media,
-        },
-    )
+    return get_client().script_media(api_base_url, session_id, message, history, persona_data, script, media)
+
+
+def script_media_stream(
+    api_base_url: str,
+    session_id: Optional[str],
+    message: str,
+    history: List[Dict[str, Any]],
+    persona_data: Dict[str, Any],
+    script: str,
+    media: str,
+) -> Iterator[str]:
+    return get_client().script_media_stream(api_base_url, session_id, message, history, persona_data, script, media)
 
 
 def unpersona_chat(
@@ -89,12 +1210,14 @@ def unpersona_chat(
     history: List[Dict[str, Any]],
     persona_data: Optional[Dict[str, Any]] = None,
 ) -> str:
-    return _post(
-        f"{api_base_url.rstrip('/')}/unpersona_chat",
-        {
-            "session_id": session_id,
-            "message": message,
-            "history": history,
-            "persona_data": persona_data,
-        },
-    )
+    return get_client().unpersona_chat(api_base_url, session_id, message, history, persona_data)
+
+
+def unpersona_chat_stream(
+    api_base_url: str,
+    session_id: Optional[str],
+    message: str,
+    history: List[Dict[str, Any]],
+    persona_data: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    return get_client().unpersona_chat_stream(api_base_url, session_id, message, history, persona_data)
@@ -0,0 +1,242 @@
+"""Journal des requêtes SQLite lentes (opt-in, pour une instance en production).
+
+    MYFANCRM_SLOW_QUERY_MS=20 streamlit run streamlit_app.py
+    python -m app slowlog --top 20              # top-N des requêtes lentes journalisées
+
+Chaque connexion du pool reçoit un trace callback (début de requête) et un progress handler
+(compte les instructions de la VM SQLite, par paquets de MYFANCRM_SLOW_QUERY_PROGRESS_OPS).
+La durée d'une requête est le temps réel de son début à la requête suivante sur la connexion,
+ou à son retour au pool: attente du verrou d'écriture (busy_timeout), I/O et fsync comprises,
+même quand la VM ne tourne presque pas (vm_ops, colonne séparée, montre le travail de la VM).
+Au-delà du seuil, on journalise (JSONL, une ligne par requête) le SQL normalisé, la forme des
+paramètres, la durée et la fonction app.db appelante; les valeurs elles-mêmes (messages des
+abonnés...) ne sont jamais écrites.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+_raw_threshold = (os.environ.get("MYFANCRM_SLOW_QUERY_MS") or "").strip()
+SLOW_QUERY_MS: Optional[float] = float(_raw_threshold) if _raw_threshold else None
+ENABLED = SLOW_QUERY_MS is not None
+# Fichier JSONL partagé par les process (Streamlit, workers, API); défaut: à côté de la base
+SLOW_QUERY_FILE = os.environ.get("MYFANCRM_SLOW_QUERY_FILE") or ""
+SLOW_QUERY_FILE_MAX_MB = float(os.environ.get("MYFANCRM_SLOW_QUERY_FILE_MAX_MB") or 16)
+PROGRESS_OPS = int(os.environ.get("MYFANCRM_SLOW_QUERY_PROGRESS_OPS") or 1000)
+# Requêtes lentes gardées en mémoire dans le process
+_RECENT_SIZE = 1000
+# Fonctions de app.db qui ne sont que la plomberie des connexions
+_PLUMBING = {"get_conn", "get_read_conn"}
+
+_LITERAL = re.compile(r"(?P<blob>[xX]'[0-9a-fA-F]*')|(?P<text>'(?:[^']|'')*')|(?P<num>(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b)")
+_PLACEHOLDER_RUN = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def normalize_sql(sql: str) -> Tuple[str, List[str]]:
+    """SQL étendu par sqlite3 (valeurs incluses) -> (SQL avec des "?", forme des paramètres).
+
+    La forme est approximative: un littéral écrit en dur dans le SQL compte comme un paramètre,
+    et un paramètre None apparaît comme NULL (non remplacé).
+    """
+    shape: List[str] = []
+
+    def repl(m: "re.Match[str]") -> str:
+        if m.group("blob"):
+            shape.append(f"blob[{(len(m.group('blob')) - 3) // 2}]")
+        elif m.group("text"):
+            shape.append(f"text[{len(m.group('text')[1:-1].replace(chr(39) * 2, chr(39)))}]")
+        else:
+            v = m.group("num")
+            shape.append("real" if ("." in v or "e" in v.lower()) else "int")
+        return "?"
+
+    normalized = _PLACEHOLDER_RUN.sub("?, …", " ".join(_LITERAL.sub(repl, sql).split()))
+    return normalized, shape
+
+
+def _calling_db_function() -> Optional[str]:
+    db_file = getattr(sys.modules.get("app.db"), "__file__", None)
+    frame = sys._getframe(1)
+    found = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == db_file and not code.co_name.startswith("_") and code.co_name not in _PLUMBING:
+            # Fonction publique la plus externe (ex. build_history -> list_messages)
+            found = code.co_name
+        frame = frame.f_back
+    return found
+
+
+def log_path() -> str:
+    if SLOW_QUERY_FILE:
+        return SLOW_QUERY_FILE
+    from app import db
+
+    return f"{db._DB_PATH}.slowlog.jsonl"
+
+
+class SlowQueryLog:
+    """Requêtes lentes du process (mémoire) + ajout au fichier JSONL partagé."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=_RECENT_SIZE)
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.recent.append(entry)
+            path = log_path()
+            try:
+                if os.path.exists(path) and os.path.getsize(path) > SLOW_QUERY_FILE_MAX_MB * 1024 * 1024:
+                    os.replace(path, f"{path}.1")
+                # Une ligne courte en mode append: pas d'entrelacement entre process
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError:
+                pass
+
+    def top(self, n: int = 20, sort: str = "total") -> List[Dict[str, Any]]:
+        with self.lock:
+            entries = list(self.recent)
+        return summarize(entries, n, sort)
+
+
+LOG = SlowQueryLog()
+
+
+class _StatementTimer:
+    """État d'une connexion: requête en cours, début, ticks de la VM."""
+
+    __slots__ = ("sql", "started", "ticks", "tracer")
+
+    def __init__(self, tracer: Optional[Callable[[str], None]]) -> None:
+        self.sql: Optional[str] = None
+        self.started = 0.0
+        self.ticks = 0
+        self.tracer = tracer
+
+    def on_statement(self, sql: str) -> None:
+        self.finish()
+        self.sql = sql
+        self.started = time.perf_counter()
+        self.ticks = 0
+        if self.tracer is not None:
+            self.tracer(sql)
+
+    def on_progress(self) -> int:
+        self.ticks += 1
+        return 0
+
+    def finish(self) -> None:
+        sql = self.sql
+        if sql is None:
+            return
+        self.sql = None
+        # Temps réel, pas le dernier tick de la VM: un BEGIN IMMEDIATE bloqué sur le verrou ou un
+        # COMMIT qui attend le fsync ne font presque aucune instruction
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        if SLOW_QUERY_MS is None or duration_ms < SLOW_QUERY_MS:
+            return
+        normalized, shape = normalize_sql(sql)
+        LOG.record(
+            {
+                "ts": time.time(),
+                "pid": os.getpid(),
+                "function": _calling_db_function(),
+                "duration_ms": round(duration_ms, 3),
+                "vm_ops": self.ticks * PROGRESS_OPS,
+                "sql": normalized,
+                "params": shape,
+            }
+        )
+
+
+# id(conn) -> timer (sqlite3.Connection n'accepte ni attribut ni weakref)
+_timers: Dict[int, _StatementTimer] = {}
+
+
+def attach(conn: sqlite3.Connection, tracer: Optional[Callable[[str], None]] = None) -> None:
+    """Installe trace callback + progress handler; `tracer` (set_statement_tracer) reste appelé."""
+    timer = _StatementTimer(tracer)
+    _timers[id(conn)] = timer
+    conn.set_trace_callback(timer.on_statement)
+    conn.set_progress_handler(timer.on_progress, PROGRESS_OPS)
+
+
+def finish(conn: sqlite3.Connection) -> None:
+    # Connexion rendue au pool: la dernière requête est terminée
+    timer = _timers.get(id(conn))
+    if timer is not None:
+        timer.finish()
+
+
+def detach(conn: sqlite3.Connection) -> None:
+    _timers.pop(id(conn), None)
+
+
+# --- Rapport ---
+
+def read_log(path: str, window: int = 10000) -> List[Dict[str, Any]]:
+    """Les `window` dernières entrées du fichier (fenêtre glissante)."""
+    entries: Deque[Dict[str, Any]] = deque(maxlen=max(1, window))
+    for candidate in (f"{path}.1", path):
+        if not os.path.exists(candidate):
+            continue
+        with open(candidate, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Ligne tronquée (process tué pendant l'écriture)
+                    continue
+    return list(entries)
+
+
+def summarize(entries: List[Dict[str, Any]], top: int = 20, sort: str = "total") -> List[Dict[str, Any]]:
+    groups: Dict[Tuple[Optional[str], str], Dict[str, Any]] = {}
+    for e in entries:
+        key = (e.get("function"), e.get("sql") or "")
+        g = groups.setdefault(
+            key,
+            {"function": key[0], "sql": key[1], "count": 0, "total_ms": 0.0, "max_ms": 0.0, "params": [], "last_ts": 0.0},
+        )
+        duration = float(e.get("duration_ms") or 0)
+        g["count"] += 1
+        g["total_ms"] += duration
+        if duration >= g["max_ms"]:
+            g["max_ms"] = duration
+            g["params"] = e.get("params") or []
+        g["last_ts"] = max(g["last_ts"], float(e.get("ts") or 0))
+    key_fn = {
+        "total": lambda g: g["total_ms"],
+        "max": lambda g: g["max_ms"],
+        "count": lambda g: g["count"],
+        "recent": lambda g: g["last_ts"],
+    }[sort]
+    rows = sorted(groups.values(), key=key_fn, reverse=True)[: max(0, top)]
+    for g in rows:
+        g["total_ms"] = round(g["total_ms"], 3)
+        g["avg_ms"] = round(g["total_ms"] / g["count"], 3)
+    return rows
+
+
+def format_report(rows: List[Dict[str, Any]], path: str, n_entries: int) -> str:
+    lines = [f"[MyFanCRM] {n_entries} requête(s) lente(s) dans {path}"]
+    for r in rows:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(r["last_ts"])) if r["last_ts"] else "?"
+        lines.append(
+            f"  {r['count']:>6}x  total {r['total_ms']:>10.1f} ms  max {r['max_ms']:>8.1f} ms  "
+            f"moy {r['avg_ms']:>8.1f} ms  {r['function'] or '?'}  (dernière: {when})"
+        )
+        lines.append(f"      {r['sql'][:200]}")
+        if r["params"]:
+            lines.append(f"      paramètres: ({', '.join(r['params'])})")
+    return "\n".join(lines)
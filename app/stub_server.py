@@ -0,0 +1,239 @@
+"""Faux Sinhome_llm local pour les tests de charge et benchmarks (aucun GPU, aucun réseau).
+
+Mêmes endpoints et même forme de payload/réponse que l'API réelle:
+/personality_chat, /script_chat, /script_media, /unpersona_chat -> {"response": "..."}.
+Latence, erreurs, 429 et streaming (SSE / NDJSON / texte chunked) sont configurables.
+
+    python -m app stub --port 8000 --latency lognormal:-1.2,0.5 --error-rate 0.02 --rate-429 0.01 --stream sse
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+ENDPOINTS: Dict[str, Tuple[str, ...]] = {
+    "personality_chat": ("message", "history", "persona_data"),
+    "script_chat": ("message", "history", "persona_data", "script"),
+    "script_media": ("message", "history", "persona_data", "script", "media"),
+    "unpersona_chat": ("message", "history"),
+}
+
+_WORDS = (
+    "coucou mon coeur tu me manques trop aujourd'hui j'ai pensé à toi toute la journée "
+    "raconte moi ce que tu fais ce soir j'ai une petite surprise pour toi"
+).split()
+
+
+def parse_latency(spec: str) -> "LatencyModel":
+    """"fixed:0.3", "uniform:0.1,0.8", "normal:0.5,0.1", "lognormal:mu,sigma" ou "exp:0.4" (secondes)."""
+    kind, _, raw = (spec or "fixed:0").partition(":")
+    params = [float(p) for p in raw.split(",") if p.strip()] if raw else []
+    kind = kind.strip().lower()
+    expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exp": 1}
+    if kind not in expected or len(params) != expected[kind]:
+        raise ValueError(f"Latence invalide: {spec!r}")
+    return LatencyModel(kind, tuple(params))
+
+
+@dataclass
+class LatencyModel:
+    kind: str = "fixed"
+    params: Tuple[float, ...] = (0.0,)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "uniform":
+            value = rng.uniform(*self.params)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.params)
+        elif self.kind == "lognormal":
+            value = rng.lognormvariate(*self.params)
+        elif self.kind == "exp":
+            value = rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        else:
+            value = self.params[0]
+        return max(0.0, value)
+
+
+@dataclass
+class StubConfig:
+    # Temps avant la réponse (ou avant le 1er token en streaming)
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    # Délai entre tokens en streaming
+    token_interval_s: float = 0.02
+    reply_words: int = 24
+    error_rate: float = 0.0
+    rate_429: float = 0.0
+    retry_after_s: int = 1
+    # None: jamais de streaming; "sse" | "ndjson" | "text": format utilisé si le client envoie stream=true
+    stream: Optional[str] = None
+    seed: Optional[int] = None
+
+
+class StubStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def incr(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+
+def _reply_words(endpoint: str, payload: Dict[str, Any], n_words: int, rng: random.Random) -> list:
+    head = [f"[{endpoint}]"]
+    if payload.get("script"):
+        head.append(str(payload["script"]).split()[0] if str(payload["script"]).split() else "")
+    words = [rng.choice(_WORDS) for _ in range(max(1, n_words))]
+    return [w for w in head if w] + words
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, data: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == "/stats":
+            self._send_json(200, self.server.stats.snapshot())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"detail": "Not Found"})
+
+    def do_POST(self) -> None:
+        endpoint = self.path.strip("/").split("?")[0]
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if endpoint not in ENDPOINTS:
+            self._send_json(404, {"detail": "Not Found"})
+            return
+        try:
+            payload = json.loads(raw or b"{}")
+        except ValueError:
+            self._send_json(422, {"detail": "Invalid JSON"})
+            return
+        missing = [k for k in ENDPOINTS[endpoint] if k not in payload]
+        if missing:
+            self._send_json(422, {"detail": f"Missing fields: {', '.join(missing)}"})
+            return
+
+        cfg = self.server.config
+        rng = self.server.rng(endpoint, raw)
+        stats = self.server.stats
+        stats.incr(f"requests.{endpoint}")
+
+        roll = rng.random()
+        if roll < cfg.rate_429:
+            stats.incr("status.429")
+            self._send_json(429, {"detail": "Too Many Requests"}, {"Retry-After": str(cfg.retry_after_s)})
+            return
+        time.sleep(cfg.latency.sample(rng))
+        if roll < cfg.rate_429 + cfg.error_rate:
+            status = rng.choice((500, 502, 503))
+            stats.incr(f"status.{status}")
+            self._send_json(status, {"detail": "Stub backend error"})
+            return
+
+        words = _reply_words(endpoint, payload, cfg.reply_words, rng)
+        stats.incr("status.200")
+        if cfg.stream and payload.get("stream"):
+            self._stream(words, cfg)
+            return
+        self._send_json(200, {"response": " ".join(words)})
+
+    def _stream(self, words: list, cfg: StubConfig) -> None:
+        content_type = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}.get(
+            cfg.stream or "", "text/plain; charset=utf-8"
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(data: bytes) -> None:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        for i, word in enumerate(words):
+            token = word if i == 0 else " " + word
+            if cfg.stream == "sse":
+                chunk(f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n".encode("utf-8"))
+            elif cfg.stream == "ndjson":
+                chunk((json.dumps({"token": token}, ensure_ascii=False) + "\n").encode("utf-8"))
+            else:
+                chunk(token.encode("utf-8"))
+            if cfg.token_interval_s > 0:
+                time.sleep(cfg.token_interval_s)
+        if cfg.stream == "sse":
+            chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address: Tuple[str, int], config: StubConfig) -> None:
+        super().__init__(address, StubHandler)
+        self.config = config
+        self.stats = StubStats()
+        self._seed = config.seed
+        self._seen_lock = threading.Lock()
+        self._seen: Dict[str, int] = {}
+
+    def rng(self, endpoint: str, raw: bytes) -> random.Random:
+        # Un générateur par requête. Avec seed: dérivé du corps et de son rang parmi les requêtes
+        # identiques, pas de l'ordre d'arrivée ni du thread -> même run, mêmes tirages; un retry
+        # du même corps obtient un nouveau tirage.
+        if self._seed is None:
+            return random.Random()
+        digest = hashlib.sha256(endpoint.encode("utf-8") + b"\0" + raw).hexdigest()
+        with self._seen_lock:
+            n = self._seen.get(digest, 0)
+            self._seen[digest] = n + 1
+        return random.Random(f"{self._seed}:{digest}:{n}")
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_stub_server(config: Optional[StubConfig] = None, host: str = "127.0.0.1", port: int = 0) -> StubServer:
+    """Démarre le stub dans un thread daemon (port=0: port libre). `server.shutdown()` pour l'arrêter."""
+    server = StubServer((host, port), config or StubConfig())
+    threading.Thread(target=server.serve_forever, name="sinhome-stub", daemon=True).start()
+    return server
+
+
+def serve(host: str, port: int, config: StubConfig) -> None:
+    server = StubServer((host, port), config)
+    print(f"[MyFanCRM] Stub Sinhome_llm sur {server.url} (stream={config.stream or 'off'})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,140 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+from app import db
+from app import governor
+from app.history import estimate_tokens
+from app.sinhome_client import SinhomeClientError, unpersona_chat
+
+# "local" (extractif, sans appel réseau), "sinhome" (via /unpersona_chat) ou "off"
+SUMMARIZER = (os.environ.get("MYFANCRM_SUMMARIZER") or "local").strip().lower()
+MAX_SUMMARY_TOKENS = int(os.environ.get("MYFANCRM_SUMMARY_TOKENS") or 300)
+# Nombre max de messages repliés dans le résumé par mise à jour
+FOLD_BATCH_SIZE = 100
+
+_ROLE_LABELS = {"user": "Fan", "assistant": "Créatrice"}
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s")
+_PAYWALL_SUFFIX = re.compile(r"\s*\[\[PAYWALL::.*\]\]\s*$", re.S)
+_SEPARATOR = " | "
+_WORD = re.compile(r"\w+")
+_NAMED = re.compile(r"\b[A-ZÀ-Ý][a-zà-ÿ]+")
+_NUMBER = re.compile(r"\d+")
+# Longueur à laquelle une ligne est raccourcie avant qu'on en supprime
+_SHORT_LINE_CHARS = 80
+
+
+def summary_message(summary: str) -> Dict[str, Any]:
+    return {"role": "system", "content": f"Résumé de la conversation jusqu'ici: {summary}"}
+
+
+def _clean(content: str) -> str:
+    return " ".join(_PAYWALL_SUFFIX.sub("", content or "").split())
+
+
+def _line_scores(lines: List[str]) -> List[float]:
+    # Valeur d'une ligne: ses mots rares dans le résumé (un fait isolé bat le bavardage répété),
+    # plus les noms propres et les nombres (prénom, âge, prix, dates)
+    words = [set(w.lower() for w in _WORD.findall(line.split(": ", 1)[-1]) if len(w) > 3) for line in lines]
+    df: Dict[str, int] = {}
+    for ws in words:
+        for w in ws:
+            df[w] = df.get(w, 0) + 1
+    scores = []
+    for line, ws in zip(lines, words):
+        body = line.split(": ", 1)[-1]
+        named = len(_NAMED.findall(body[1:])) + len(_NUMBER.findall(body))
+        scores.append(sum(1 / df[w] for w in ws) + named)
+    return scores
+
+
+def _compress(lines: List[str], max_chars: int) -> List[str]:
+    # Dans le budget sans couper la tête: doublons retirés, lignes longues raccourcies,
+    # puis les lignes les moins informatives (les plus anciennes à égalité) supprimées
+    seen = set()
+    kept = []
+    for line in lines:
+        key = line.lower()
+        if key not in seen:
+            seen.add(key)
+            kept.append(line)
+    total = len(_SEPARATOR.join(kept))
+    for i in sorted(range(len(kept)), key=lambda i: -len(kept[i])):
+        if total <= max_chars or len(kept[i]) <= _SHORT_LINE_CHARS:
+            break
+        short = kept[i][: _SHORT_LINE_CHARS - 1].rsplit(" ", 1)[0] + "…"
+        total -= len(kept[i]) - len(short)
+        kept[i] = short
+    if total <= max_chars:
+        return kept
+    scores = _line_scores(kept)
+    dropped = set()
+    for i in sorted(range(len(kept)), key=lambda i: (scores[i], i)):
+        if total <= max_chars:
+            break
+        dropped.add(i)
+        total -= len(kept[i]) + len(_SEPARATOR)
+    return [line for i, line in enumerate(kept) if i not in dropped]
+
+
+def _local_fold(previous: str, rows: List[Any]) -> str:
+    # Résumé extractif: première phrase de chaque message, compressé dans MAX_SUMMARY_TOKENS
+    max_chars = MAX_SUMMARY_TOKENS * 4
+    lines = []
+    for r in rows:
+        text = _clean(r["content"])
+        if not text:
+            continue
+        first = _SENTENCE_END.split(text, 1)[0]
+        if len(first) > 160:
+            first = first[:157].rstrip() + "…"
+        lines.append(f"{_ROLE_LABELS.get(r['role'], r['role'])}: {first}")
+    # Entrée bornée par passe: un gros lot ne chasse pas tout l'ancien résumé
+    lines = _compress(lines, max_chars // 2)
+    old = []
+    for line in previous.split(_SEPARATOR) if previous else []:
+        # Résumé en prose (repli Sinhome): une ligne par phrase
+        old.extend(_SENTENCE_END.split(line) if len(line) > 160 else [line])
+    return _SEPARATOR.join(_compress(old + lines, max_chars))
+
+
+def _sinhome_fold(api_url: str, previous: str, rows: List[Any]) -> str:
+    transcript = "\n".join(f"{_ROLE_LABELS.get(r['role'], r['role'])}: {_clean(r['content'])}" for r in rows)
+    prompt = (
+        "Mets à jour le résumé d'une conversation entre une créatrice et un fan. "
+        f"Réponds uniquement par le nouveau résumé, en français, en moins de {MAX_SUMMARY_TOKENS * 3 // 4} mots. "
+        "Garde les faits durables (prénom, goûts, achats, promesses, sujets sensibles).\n\n"
+        f"Résumé actuel:\n{previous or '(vide)'}\n\nNouveaux messages:\n{transcript}"
+    )
+    # Hors chemin critique: passe après les tours en attente
+    with governor.slot(None, "background"):
+        summary = unpersona_chat(api_url, None, prompt, [], None).strip()
+    if estimate_tokens(summary) > MAX_SUMMARY_TOKENS:
+        summary = summary[: MAX_SUMMARY_TOKENS * 4 - 1].rstrip() + "…"
+    return summary
+
+
+def refresh_summary(conversation_id: int, upto_message_id: int, api_url: Optional[str] = None) -> bool:
+    """Replie dans le résumé les messages (last_message_id, upto_message_id] qui sortent de la fenêtre.
+
+    Incrémental: seuls les messages plus récents que le dernier id déjà résumé sont lus.
+    """
+    if SUMMARIZER == "off":
+        return False
+    row = db.get_conversation_summary(conversation_id)
+    previous = row["summary"] if row else ""
+    last_id = int(row["last_message_id"]) if row else 0
+    if upto_message_id <= last_id:
+        return False
+    rows = db.list_messages_between(conversation_id, last_id, upto_message_id, limit=FOLD_BATCH_SIZE)
+    if not rows:
+        return False
+    summary = None
+    if SUMMARIZER == "sinhome" and api_url:
+        try:
+            summary = _sinhome_fold(api_url, previous, rows)
+        except SinhomeClientError:
+            summary = None
+    if not summary:
+        summary = _local_fold(previous, rows)
+    return db.save_conversation_summary(conversation_id, summary, int(rows[-1]["id"]), last_id)
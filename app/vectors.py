@@ -0,0 +1,50 @@
+import re
+import struct
+import unicodedata
+import zlib
+from typing import Dict
+
+# Vecteurs creux "hashed TF": token -> bucket (crc32, stable entre process) -> fréquence
+
+_BUCKET_MASK = (1 << 22) - 1
+_WORD_RE = re.compile(r"\w{3,}")
+
+STOPWORDS = frozenset(
+    """
+    les des une est que qui pas pour dans sur avec mais tout tous toute plus moi toi lui elle nous vous ils
+    elles mon ton son mes tes ses notre votre leur leurs sont etre avoir fait faire bien tres aussi comme
+    quoi cest suis etait ete cela ceci car donc alors oui non the and you your are for with that this
+    have not but what was its just can will all
+    """.split()
+)
+
+
+def _normalize(text: str) -> str:
+    # minuscules + suppression des accents (é -> e) pour matcher "envie" / "envié"
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def term_counts(text: str) -> Dict[int, int]:
+    counts: Dict[int, int] = {}
+    for word in _WORD_RE.findall(_normalize(text or "")):
+        if word in STOPWORDS:
+            continue
+        bucket = zlib.crc32(word.encode("utf-8")) & _BUCKET_MASK
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return counts
+
+
+def pack(counts: Dict[int, int]) -> bytes:
+    # [bucket, tf, bucket, tf, ...] en uint32 petit-boutiste: BLOB persisté (message_vectors), lisible
+    # quelle que soit la machine qui a écrit la base
+    flat = []
+    for bucket, tf in counts.items():
+        flat.append(bucket)
+        flat.append(min(tf, 0xFFFFFFFF))
+    return struct.pack(f"<{len(flat)}I", *flat)
+
+
+def unpack(blob: bytes) -> Dict[int, int]:
+    flat = struct.unpack(f"<{len(blob) // 4}I", blob)
+    return {flat[i]: flat[i + 1] for i in range(0, len(flat), 2)}
@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from app import db
+from app import engine
+from app import metrics
+from app import sinhome_client
+from app.sinhome_client import SinhomeClientError
+
+_MAX_WORKERS = int(os.environ.get("MYFANCRM_TURN_WORKERS") or 4)
+_POLL_INTERVAL_S = float(os.environ.get("MYFANCRM_TURN_POLL_S") or 1.0)
+_STALE_AFTER_S = int(os.environ.get("MYFANCRM_TURN_STALE_S") or 300)
+# Tours 'running' orphelins (process voisin tué) remis en file aussi pendant que le worker tourne
+_REQUEUE_INTERVAL_S = min(60.0, float(_STALE_AFTER_S))
+# Fréquence max d'écriture du texte partiel (affiché pendant la génération)
+_PARTIAL_FLUSH_S = 0.5
+
+
+class TurnWorker:
+    """Pool borné de threads qui traite la table pending_turns.
+
+    Le thread du script Streamlit se contente d'enfiler le tour (enqueue_turn);
+    la génération LLM et le commit se font ici, en parallèle sur plusieurs conversations.
+    """
+
+    def __init__(self, max_workers: int = _MAX_WORKERS, poll_interval_s: float = _POLL_INTERVAL_S) -> None:
+        self.max_workers = max(1, max_workers)
+        self.poll_interval_s = poll_interval_s
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="myfancrm-turn")
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._dispatcher and self._dispatcher.is_alive():
+            return
+        db.requeue_stale_pending_turns(_STALE_AFTER_S)
+        self._stop.clear()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="myfancrm-turn-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def stop(self, timeout_s: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._dispatcher:
+            self._dispatcher.join(timeout_s)
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def _requeue_stale(self) -> None:
+        try:
+            db.requeue_stale_pending_turns(_STALE_AFTER_S)
+        except sqlite3.Error:
+            pass
+
+    def _dispatch_loop(self) -> None:
+        next_requeue = time.monotonic() + _REQUEUE_INTERVAL_S
+        while not self._stop.is_set():
+            if time.monotonic() >= next_requeue:
+                # Sinon un tour orphelin bloque sa conversation jusqu'au prochain redémarrage
+                self._requeue_stale()
+                next_requeue = time.monotonic() + _REQUEUE_INTERVAL_S
+            self._slots.acquire()
+            try:
+                row = db.claim_pending_turn()
+            except sqlite3.Error:
+                row = None
+            if row is None:
+                self._slots.release()
+                # Rien à faire (ou conversation déjà en cours): on attend un enqueue ou le poll
+                self._wakeup.wait(self.poll_interval_s)
+                self._wakeup.clear()
+                continue
+            try:
+                self._executor.submit(self._run_turn, row)
+            except RuntimeError:
+                # Exécuteur arrêté (fin de l'interpréteur): le tour réclamé sera remis en file
+                self._slots.release()
+                return
+
+    def _run_turn(self, row) -> None:
+        pending_turn_id = int(row["id"])
+        try:
+            process_pending_turn(row)
+        except Exception as e:
+            db.fail_pending_turn(pending_turn_id, str(e))
+        finally:
+            self._slots.release()
+            # Un tour terminé peut débloquer le suivant de la même conversation
+            self._wakeup.set()
+
+
+def process_pending_turn(row) -> str:
+    with metrics.turn_trace(int(row["conversation_id"]), "worker"):
+        return _process_pending_turn(row)
+
+
+def _process_pending_turn(row) -> str:
+    pending_turn_id = int(row["id"])
+    plan = engine.start_turn(int(row["conversation_id"]), row["user_msg"], row["session_id"])
+    parts = []
+    last_flush = time.monotonic()
+    try:
+        with sinhome_client.deadline(sinhome_client.TURN_DEADLINE_S):
+            for chunk in engine.stream_reply(row["api_url"], plan):
+                parts.append(chunk)
+                now = time.monotonic()
+                if now - last_flush >= _PARTIAL_FLUSH_S:
+                    db.update_pending_turn_partial(pending_turn_id, "".join(parts))
+                    last_flush = now
+    except SinhomeClientError as e:
+        # Erreurs Sinhome_llm (y compris deadline) seulement: un bug ou une erreur SQLite remonte à
+        # _run_turn (fail_pending_turn) au lieu d'être committé comme une réponse "Erreur API"
+        return engine.finish_turn(plan, None, error=str(e), pending_turn_id=pending_turn_id)
+    assistant_text = engine.finish_turn(plan, "".join(parts), pending_turn_id=pending_turn_id)
+    try:
+        engine.after_turn(row["api_url"], plan)
+    except Exception:
+        # Le résumé est best-effort: le tour est déjà committé
+        pass
+    return assistant_text
+
+
+_worker: Optional[TurnWorker] = None
+_worker_lock = threading.Lock()
+
+
+def get_worker() -> TurnWorker:
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = TurnWorker()
+                _worker.start()
+    return _worker
+
+
+def enqueue_turn(
+    conversation_id: int,
+    user_msg: str,
+    session_id: Optional[str],
+    api_url: str,
+    idempotency_key: Optional[str] = None,
+) -> int:
+    # Même clé déjà en base: on renvoie le tour existant (pas de 2e génération)
+    pending_turn_id = db.enqueue_pending_turn(
+        conversation_id, user_msg, session_id, api_url, idempotency_key=idempotency_key
+    )
+    get_worker().notify()
+    return pending_turn_id
@@ -2,6 +2,9 @@ import json
 import streamlit as st
 
 from app.db import get_creator_bot_id, get_bot, parse_persona_json, upsert_bot
+from app.profiling import profile_rerun
+
+profile_rerun("Configuration créatrice", __file__)
 
 st.set_page_config(page_title="Configuration créatrice", layout="wide")
 
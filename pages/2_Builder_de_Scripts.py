@@ -8,9 +8,13 @@ from app.db import (
     list_scripts,
     list_steps,
     move_step,
+    search_script_steps,
     update_step,
     upsert_script,
 )
+from app.profiling import profile_rerun
+
+profile_rerun("Builder de Scripts", __file__)
 
 st.set_page_config(page_title="Builder de Scripts", layout="wide")
 
@@ -29,6 +33,20 @@ with left:
         st.session_state["script_edit_id"] = None
         st.rerun()
 
+    step_query = st.text_input("Rechercher dans les étapes", key="step_search")
+    if step_query.strip():
+        hits = search_script_steps(step_query, limit=20)
+        if not hits:
+            st.caption("Aucun résultat.")
+        for h in hits:
+            if st.button(
+                f"{h['script_name']} · étape {int(h['position'])} — {h['snippet']}",
+                key=f"step_hit_{h['step_id']}",
+            ):
+                st.session_state["script_edit_id"] = int(h["script_id"])
+                st.rerun()
+        st.divider()
+
     if not scripts:
         st.info("Aucun script")
     else:
@@ -11,6 +11,9 @@ from app.db import (
     update_step,
     upsert_script,
 )
+from app.profiling import profile_rerun
+
+profile_rerun("Éditer Script", __file__)
 
 st.set_page_config(page_title="Éditer Script", layout="wide")
 
@@ -1,46 +1,115 @@
+import time
 import uuid
 import os
 
 import streamlit as st
 
 from app.db import (
-    add_message,
-    build_history,
-    get_bot,
     create_conversation,
     get_default_bot_id,
     delete_conversation,
-    list_conversations,
+    list_conversations_page,
     list_messages,
+    list_pending_turns,
     list_scripts,
     list_steps,
-    parse_persona_json,
+    lock_script,
     reset_conversation,
-    increment_paywall_counter,
-    set_paywall_counter,
+    SEARCH_CANDIDATES,
+    message_search_truncated,
+    search_messages,
     set_script_started,
+    unlock_paywall,
     update_conversation_mode,
-    update_conversation_state,
     upsert_subscriber,
 )
-from app.sinhome_client import SinhomeClientError, personality_chat, script_chat, script_media, unpersona_chat
+from app.engine import parse_paywall_marker
+from app.governor import stats as governor_stats
+from app.metrics import DEBUG_PANEL, REGISTRY, last_turn, turn_breakdown
+from app.profiling import profile_rerun
+from app.retrieval import invalidate as invalidate_recall_index
+from app.sinhome_client import backend_states, breaker_states
+from app.worker import enqueue_turn
+
+profile_rerun("Conversations Abonnés", __file__)
 
 st.set_page_config(page_title="Conversations Abonnés", layout="wide")
 
 st.title("Conversations Abonnés")
 
-api_url = os.environ.get("SINHOME_API_URL") or "http://127.0.0.1:8001"
+# Valeur de la barre latérale (page d'accueil), sinon l'environnement; virgules = plusieurs backends
+api_url = st.session_state.get("api_url") or os.environ.get("SINHOME_API_URL") or "http://127.0.0.1:8001"
+
+CONVERSATIONS_PAGE_SIZE = 25
+CHAT_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 10
+# Résultats de recherche réutilisés entre reruns (clics, fragment de polling) pendant ce délai
+SEARCH_CACHE_TTL_S = 30.0
+
+
+def _search_hits(query: str, offset: int, conversation_id=None, recent_only: bool = True) -> tuple:
+    # Une requête FTS par (recherche, conversation, portée, page), pas une par rerun
+    key = (query.strip(), conversation_id, recent_only, offset)
+    cache = st.session_state.setdefault("msg_search_cache", {})
+    cached = cache.get(key)
+    if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL_S:
+        return cached[1]
+    hits = [
+        dict(h)
+        for h in search_messages(
+            query, limit=SEARCH_PAGE_SIZE + 1, offset=offset, conversation_id=conversation_id, recent_only=recent_only
+        )
+    ]
+    truncated = recent_only and conversation_id is None and message_search_truncated(query)
+    if len(cache) >= 20:
+        cache.clear()
+    cache[key] = (time.monotonic(), (hits, truncated))
+    return hits, truncated
+
+
+def _chat_entry(row) -> dict:
+    # Marqueur paywall parsé une seule fois, à l'entrée dans le cache
+    content = row["content"] or ""
+    text, paywall = (content, None)
+    if row["role"] == "assistant":
+        text, paywall = parse_paywall_marker(content)
+    return {"id": int(row["id"]), "role": row["role"], "text": text, "paywall": paywall}
+
 
 # --- Layout ---
 left, right = st.columns([1, 2])
 
 with left:
     st.subheader("Conversations")
-    conversations = list_conversations()
+    search = st.text_input("Rechercher un abonné", key="conv_search", placeholder="Début du pseudo…")
+
+    # Pile des curseurs keyset: [None, curseur page 2, curseur page 3, ...]
+    if st.session_state.get("conv_page_search") != search:
+        st.session_state["conv_page_search"] = search
+        st.session_state["conv_page_cursors"] = [None]
+    page_cursors = st.session_state.setdefault("conv_page_cursors", [None])
+    conversations, next_cursor = list_conversations_page(
+        limit=CONVERSATIONS_PAGE_SIZE,
+        cursor=page_cursors[-1],
+        username_prefix=search,
+    )
 
     if "selected_conversation_id" not in st.session_state:
         st.session_state["selected_conversation_id"] = None
 
+    if len(page_cursors) > 1 or next_cursor:
+        nav_l, nav_m, nav_r = st.columns([1, 2, 1])
+        with nav_l:
+            if st.button("◀", key="conv_page_prev", disabled=len(page_cursors) <= 1):
+                page_cursors.pop()
+                st.rerun()
+        with nav_m:
+            st.caption(f"Page {len(page_cursors)}")
+        with nav_r:
+            if st.button("▶", key="conv_page_next", disabled=not next_cursor):
+                page_cursors.append(next_cursor)
+                st.rerun()
+
     if conversations:
         for c in conversations:
             row_l, row_r = st.columns([6, 1])
@@ -57,6 +126,36 @@ with left:
     else:
         st.info("Aucune conversation.")
 
+    with st.expander("Recherche dans les messages"):
+        msg_query = st.text_input("Mots-clés", key="msg_search")
+        msg_all = st.checkbox("Tout l'historique (plus lent)", key="msg_search_all")
+        if st.session_state.get("msg_search_last") != (msg_query, msg_all):
+            st.session_state["msg_search_last"] = (msg_query, msg_all)
+            st.session_state["msg_search_offset"] = 0
+        msg_offset = int(st.session_state.get("msg_search_offset") or 0)
+        hits, truncated = _search_hits(msg_query, msg_offset, recent_only=not msg_all) if msg_query.strip() else ([], False)
+        if truncated:
+            st.caption(
+                f"Seuls les {SEARCH_CANDIDATES} résultats les plus récents sont classés: "
+                "coche « Tout l'historique » pour chercher plus loin."
+            )
+        for h in hits[:SEARCH_PAGE_SIZE]:
+            if st.button(f"{h['subscriber_username']} — {h['snippet']}", key=f"msg_hit_{h['message_id']}"):
+                st.session_state["selected_conversation_id"] = int(h["conversation_id"])
+                st.rerun()
+        if msg_query.strip() and not hits:
+            st.caption("Aucun résultat.")
+        if msg_offset > 0 or len(hits) > SEARCH_PAGE_SIZE:
+            s_l, s_r = st.columns(2)
+            with s_l:
+                if st.button("◀", key="msg_search_prev", disabled=msg_offset <= 0):
+                    st.session_state["msg_search_offset"] = max(0, msg_offset - SEARCH_PAGE_SIZE)
+                    st.rerun()
+            with s_r:
+                if st.button("▶", key="msg_search_next", disabled=len(hits) <= SEARCH_PAGE_SIZE):
+                    st.session_state["msg_search_offset"] = msg_offset + SEARCH_PAGE_SIZE
+                    st.rerun()
+
     st.divider()
     st.subheader("+")
     conv_name = st.text_input("Nom", key="new_conv_name")
@@ -69,6 +168,7 @@ with left:
             subscriber_id = upsert_subscriber(None, conv_name.strip(), "")
             new_id = create_conversation(subscriber_id=subscriber_id, bot_id=int(default_bot_id), mode="free", script_id=None)
             st.session_state["selected_conversation_id"] = int(new_id)
+            st.session_state["conv_page_cursors"] = [None]
             st.rerun()
 
 
@@ -94,13 +194,10 @@ active_mode = (
     else ("Chloé" if (conv_row and conv_row["mode"] == "chloe") else "Script Mode")
 )
 active_script_id = int(conv_row["script_id"]) if (conv_row and conv_row["script_id"]) else None
-active_bot_id = int(conv_row["bot_id"]) if conv_row else None
 
 script_started = bool(int(conv_row["script_started"])) if conv_row and "script_started" in conv_row.keys() else False
 paywall_counter = int(conv_row["paywall_counter"]) if conv_row and "paywall_counter" in conv_row.keys() else 0
 
-bot_row = get_bot(active_bot_id) if active_bot_id else None
-persona_data = parse_persona_json(bot_row) if bot_row else {}
 
 with left:
     st.divider()
@@ -146,6 +243,8 @@ with left:
 
     if st.button("Reset conversation"):
         reset_conversation(conversation_id)
+        invalidate_recall_index(conversation_id)
+        st.session_state.pop("chat_cache", None)
         st.rerun()
 
 with right:
@@ -157,45 +256,90 @@ with right:
     from app.db import get_conversation as _get_conversation_ui
 
     conv_row_ui = _get_conversation_ui(conversation_id)
-    paywall_counter_ui = int(conv_row_ui["paywall_counter"]) if (conv_row_ui and "paywall_counter" in conv_row_ui.keys()) else 0
 
-    messages = list_messages(conversation_id, limit=200)
-    for m in messages:
-        with st.chat_message(m["role"]):
-            content = m["content"] or ""
-            marker = "[[PAYWALL::"
-            if m["role"] == "assistant" and marker in content and content.strip().endswith("]]" ):
-                main_text, meta = content.rsplit(marker, 1)
-                meta = meta[:-2]
-                parts = meta.split("::")
-                title_ui = (parts[0] if len(parts) > 0 else "Paywall").strip() or "Paywall"
-                price_ui = (parts[1] if len(parts) > 1 else "").strip()
-                st.write(main_text.strip())
-
-                # Afficher le bouton payer si on est toujours bloqué sur un paywall
-                show_pay = False
-                unlocked_ui = False
-                if active_mode == "Script Mode" and active_script_id and script_started and steps and conv_row_ui:
-                    current_step_ui = int(conv_row_ui["current_step"])
-                    idx_ui = max(0, current_step_ui - 1)
-                    if idx_ui >= len(steps):
-                        idx_ui = len(steps) - 1
-                    step_ui = steps[idx_ui]
-                    is_paywall_ui = str(step_ui["step_type"]).startswith("paywall_")
-                    unlocked_ui = bool(int(conv_row_ui["paywall_unlocked"]))
-                    show_pay = is_paywall_ui and (not unlocked_ui)
+    # Afficher le bouton payer si on est toujours bloqué sur un paywall
+    show_pay = False
+    if active_mode == "Script Mode" and active_script_id and script_started and steps and conv_row_ui:
+        idx_ui = min(max(0, int(conv_row_ui["current_step"]) - 1), len(steps) - 1)
+        is_paywall_ui = str(steps[idx_ui]["step_type"]).startswith("paywall_")
+        show_pay = is_paywall_ui and not bool(int(conv_row_ui["paywall_unlocked"]))
+
+    # Cache des messages affichés: on ne relit que les nouveaux (after_id) à chaque rerun
+    chat = st.session_state.get("chat_cache")
+    if not chat or chat["conversation_id"] != conversation_id:
+        rows = list_messages(conversation_id, limit=CHAT_PAGE_SIZE)
+        chat = {
+            "conversation_id": conversation_id,
+            "messages": [_chat_entry(r) for r in rows],
+            "has_older": len(rows) == CHAT_PAGE_SIZE,
+        }
+        st.session_state["chat_cache"] = chat
+    else:
+        newest_id = chat["messages"][-1]["id"] if chat["messages"] else 0
+        while True:
+            rows = list_messages(conversation_id, limit=CHAT_PAGE_SIZE, after_id=newest_id)
+            chat["messages"].extend(_chat_entry(r) for r in rows)
+            if len(rows) < CHAT_PAGE_SIZE:
+                break
+            newest_id = rows[-1]["id"]
+
+    if chat["has_older"] and st.button("Charger les messages plus anciens", key="chat_load_older"):
+        oldest_id = chat["messages"][0]["id"]
+        rows = list_messages(conversation_id, limit=CHAT_PAGE_SIZE, before_id=oldest_id)
+        chat["messages"][:0] = [_chat_entry(r) for r in rows]
+        chat["has_older"] = len(rows) == CHAT_PAGE_SIZE
+        st.rerun()
 
+    for m in chat["messages"]:
+        with st.chat_message(m["role"]):
+            st.write(m["text"])
+            paywall = m["paywall"]
+            if paywall:
                 st.divider()
-                st.markdown(f"**{title_ui}**")
-                if price_ui:
-                    st.caption(f"Prix: {price_ui}")
+                st.markdown(f"**{paywall['title']}**")
+                if paywall["price"]:
+                    st.caption(f"Prix: {paywall['price']}")
                 if st.button("Payer", key=f"paywall_pay_msg_{m['id']}", type="primary", disabled=(not show_pay)):
-                    if conv_row_ui:
-                        update_conversation_state(conversation_id, int(conv_row_ui["current_step"]), True)
-                    set_paywall_counter(conversation_id, 0)
+                    unlock_paywall(conversation_id)
                     st.rerun()
-            else:
-                st.write(content)
+
+    # Tours en cours de génération par app.worker (polling tant qu'il en reste)
+    if list_pending_turns(conversation_id):
+
+        @st.fragment(run_every=1.0)
+        def _pending_turns_view() -> None:
+            pending = list_pending_turns(conversation_id)
+            if not pending:
+                st.rerun(scope="app")
+            for p in pending:
+                with st.chat_message("user"):
+                    st.write(p["user_msg"])
+                with st.chat_message("assistant"):
+                    if p["partial"]:
+                        st.write(p["partial"] + " ▌")
+                    else:
+                        st.caption("⏳ En attente de la réponse…" if p["status"] == "running" else "⏳ En file…")
+
+        _pending_turns_view()
+
+    # Disjoncteurs Sinhome_llm de ce process: backend en panne -> échec immédiat des tours
+    # (avec plusieurs backends, les tours basculent sur les autres: simple avertissement)
+    backends = backend_states(api_url)
+    for backend in backends:
+        if not backend["healthy"]:
+            st.warning(f"Backend Sinhome_llm {backend['url']} hors service (health check): {backend['last_error']}")
+    for breaker in breaker_states(api_url):
+        if breaker["state"] == "open" and len(backends) > 1:
+            st.warning(
+                f"Backend {breaker['url']} écarté (circuit ouvert, nouvel essai dans {breaker['retry_in_s']:.0f} s)"
+            )
+        elif breaker["state"] == "open":
+            st.error(
+                f"Sinhome_llm indisponible ({breaker['endpoint']}): {breaker['failures']} échecs consécutifs, "
+                f"nouvel essai dans {breaker['retry_in_s']:.0f} s. Dernière erreur: {breaker['last_error']}"
+            )
+        elif breaker["state"] == "half_open":
+            st.warning(f"Sinhome_llm ({breaker['endpoint']}): vérification du backend en cours…")
 
     user_text = st.chat_input("Ton message")
 
@@ -210,9 +354,7 @@ if active_mode == "Script Mode" and active_script_id:
         if not script_started:
             lock_disabled = (not steps)
             if st.button("Lock", disabled=lock_disabled, type="primary"):
-                set_script_started(conversation_id, True)
-                set_paywall_counter(conversation_id, 0)
-                update_conversation_state(conversation_id, 1, False)
+                lock_script(conversation_id)
                 st.rerun()
         else:
             if st.button("Unlock"):
@@ -220,90 +362,49 @@ if active_mode == "Script Mode" and active_script_id:
                 st.rerun()
     with c2:
         if st.button("Payer", disabled=(not script_started) or unlocked):
-            current_step = int(conv_row["current_step"]) if conv_row else 1
-            update_conversation_state(conversation_id, current_step, True)
-            set_paywall_counter(conversation_id, 0)
+            unlock_paywall(conversation_id)
             st.rerun()
 
-send_as = "user"
-
+# --- Debug perfs (MYFANCRM_DEBUG_PANEL=1) ---
+if DEBUG_PANEL:
+    with st.sidebar.expander("⏱️ Temps du dernier tour", expanded=True):
+        trace = last_turn(conversation_id)
+        if not trace:
+            st.caption("Aucun tour mesuré pour cette conversation dans ce process.")
+        else:
+            st.metric("Durée totale", f"{trace['total_ms']:.0f} ms")
+            st.dataframe(turn_breakdown(trace), hide_index=True, use_container_width=True)
+            for span in trace["spans"]:
+                if span["kind"] == "sinhome":
+                    first = f", 1er morceau {span['first_chunk_ms']:.0f} ms" if span["first_chunk_ms"] is not None else ""
+                    st.caption(
+                        f"{span['name']}: HTTP {span['status']}, {span['request_bytes']} o envoyés, "
+                        f"{span['response_bytes']} o reçus{first}"
+                    )
+                elif span["kind"] == "cache":
+                    st.caption(f"{span['name']}: réponse servie par le cache ({span['tier']})")
+                elif span["kind"] == "queue":
+                    st.caption(f"{span['name']}: {span['ms']:.0f} ms d'attente d'un slot Sinhome_llm")
+        queue = governor_stats()
+        st.caption(
+            f"File Sinhome_llm: {queue['active']} appel(s) en cours (max {queue['max_concurrency'] or '∞'}), "
+            f"{queue['queued']} en attente"
+        )
+        st.dataframe(
+            [{"priorité": p, **q} for p, q in queue["priorities"].items()], hide_index=True, use_container_width=True
+        )
+        st.caption("Cumul du process (moyenne / p95 estimé)")
+        st.dataframe(REGISTRY.summary("myfancrm_sinhome_request_duration_seconds"), hide_index=True, use_container_width=True)
+        st.dataframe(REGISTRY.summary("myfancrm_db_call_duration_seconds")[:10], hide_index=True, use_container_width=True)
 
-def _call_llm(user_msg: str) -> str:
-    history = build_history(conversation_id, limit=20)
-    if history and history[-1].get("role") == "user" and history[-1].get("content") == user_msg:
-        history = history[:-1]
-    session_id = st.session_state["conv"]["session_id"]
-
-    # état conversation à jour (évite le stale après paiement / progression)
-    from app.db import get_conversation as _get_conversation
-
-    conv_row_live = _get_conversation(conversation_id)
-    current_step_live = int(conv_row_live["current_step"]) if conv_row_live else 1
-    paywall_unlocked_live = bool(int(conv_row_live["paywall_unlocked"])) if conv_row_live else False
-
-    if active_mode == "Chloé":
-        return unpersona_chat(api_url, session_id, user_msg, history, None)
-
-    if active_mode == "Free Talking" or not active_script_id:
-        return personality_chat(api_url, session_id, user_msg, history, persona_data)
-
-    # En script mode, on force une validation via Lock (évite les changements accidentels)
-    if not script_started:
-        return "Verrouille le script avec 'Lock' avant de discuter."
-
-    if not steps:
-        return "Le script n'a pas d'étapes."
-
-    current_step = current_step_live
-    idx = max(0, current_step_live - 1)
-    if idx >= len(steps):
-        idx = len(steps) - 1
-    step = steps[idx]
-
-    step_script = step["script_text"]
-    is_paywall = str(step["step_type"]).startswith("paywall_")
-    unlocked = paywall_unlocked_live
-
-    if is_paywall and not unlocked:
-        # tant que non payé: on discute, et tous les 3 messages user on renvoie le paywall
-        c = increment_paywall_counter(conversation_id)
-        if c == 1 or (c % 3 == 0):
-            title_marker = ((step["title"] if (hasattr(step, "keys") and "title" in step.keys()) else "") or "Paywall").strip() or "Paywall"
-            price_marker = ((step["price"] if (hasattr(step, "keys") and "price" in step.keys()) else "") or "").strip()
-            if step["step_type"] in ("media_text", "paywall_media_text"):
-                resp = script_media(api_url, session_id, user_msg, history, persona_data, step_script, step["media_desc"] or "")
-            else:
-                resp = script_chat(api_url, session_id, user_msg, history, persona_data, step_script)
-            return f"{resp}\n\n[[PAYWALL::{title_marker}::{price_marker}]]"
-        return personality_chat(api_url, session_id, user_msg, history, persona_data)
-
-    # pas paywall (ou unlock): on répond selon le type
-    if step["step_type"] in ("media_text", "paywall_media_text"):
-        resp = script_media(api_url, session_id, user_msg, history, persona_data, step_script, step["media_desc"] or "")
-    else:
-        resp = script_chat(api_url, session_id, user_msg, history, persona_data, step_script)
-
-    # avance automatiquement d'une étape après chaque échange
-    next_step = current_step + 1
-    if next_step > len(steps):
-        next_step = len(steps)
-    # Si on entre dans un paywall, on reset le compteur pour afficher le paywall immédiatement au prochain message
-    if next_step != current_step and steps:
-        try:
-            step_next = steps[max(0, next_step - 1)]
-            if str(step_next["step_type"]).startswith("paywall_"):
-                set_paywall_counter(conversation_id, 0)
-        except Exception:
-            pass
-    # Après une réponse script (paywall ou non), on reset le flag unlock
-    update_conversation_state(conversation_id, next_step, False)
-    return resp
+send_as = "user"
 
 if user_text:
-    add_message(conversation_id, send_as, user_text)
-    try:
-        ai_text = _call_llm(user_text)
-    except SinhomeClientError as e:
-        ai_text = f"Erreur API: {e}"
-    add_message(conversation_id, "assistant", ai_text)
+    # Une clé par envoi, gardée jusqu'à ce que le tour soit en file: un rerun interrompu puis rejoué
+    # (entrée x2 pendant l'envoi) réutilise la même clé, un nouvel envoi volontaire du même texte non
+    turn_key = st.session_state.setdefault("turn_key", uuid.uuid4().hex)
+    enqueue_turn(
+        conversation_id, user_text, st.session_state["conv"]["session_id"], api_url, idempotency_key=turn_key
+    )
+    del st.session_state["turn_key"]
     st.rerun()
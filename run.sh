@@ -16,6 +16,8 @@ echo "- MYFANCRM_DB_PATH=$MYFANCRM_DB_PATH"
 echo "- HOST=$HOST"
 echo "- PORT=$PORT"
 
+python -m app migrate
+
 exec streamlit run streamlit_app.py \
   --server.address "$HOST" \
   --server.port "$PORT" \
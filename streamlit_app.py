@@ -2,6 +2,9 @@ import os
 import streamlit as st
 
 from app.db import init_db
+from app.profiling import profile_rerun
+
+profile_rerun("MyFanCRM", __file__)
 
 st.set_page_config(page_title="MyFanCRM", layout="wide")
 
@@ -13,6 +16,7 @@ api_url = st.sidebar.text_input(
     value=st.session_state.get("api_url")
     or os.environ.get("SINHOME_API_URL")
     or "http://127.0.0.1:8000",
+    help="Plusieurs backends: URLs séparées par des virgules (répartition de charge, une conversation reste sur le même serveur).",
 )
 st.session_state["api_url"] = api_url
 
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import db, retrieval  # noqa: E402
+
+
+@pytest.fixture
+def fresh_db(tmp_path):
+    # Base SQLite neuve par test (même bascule de chemin que app.loadtest)
+    previous = db._DB_PATH
+    db.close_pools()
+    db._DB_PATH = str(tmp_path / "test.sqlite3")
+    db.init_db()
+    # Index de rappel en cache: ids de conversation d'une autre base
+    with retrieval._indexes_lock:
+        retrieval._indexes.clear()
+    try:
+        yield db
+    finally:
+        db.close_pools()
+        db._DB_PATH = previous
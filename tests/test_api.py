@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from app import api
+from app.stub_server import StubConfig, parse_latency, start_stub_server
+
+
+@pytest.fixture
+def conversation_id(fresh_db):
+    bot_id = fresh_db.upsert_bot(None, "Test", {})
+    subscriber_id = fresh_db.upsert_subscriber(None, "fan", "Fan")
+    return fresh_db.create_conversation(subscriber_id=subscriber_id, bot_id=bot_id, mode="free", script_id=None)
+
+
+def test_turns_without_key_are_serialized_per_conversation(conversation_id, monkeypatch):
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def fake_generate(conversation_id, message, session_id, api_url, pending_turn_id=None):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        api.db.commit_turn(conversation_id, message, "ok", pending_turn_id=pending_turn_id)
+        return {"conversation_id": conversation_id}
+
+    monkeypatch.setattr(api, "_generate_turn", fake_generate)
+    threads = [
+        threading.Thread(target=api._run_turn, args=({"conversation_id": conversation_id, "message": f"m{i}"},))
+        for i in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak[0] == 1
+    assert len(api.db.list_messages(conversation_id)) == 8
+
+
+def test_turn_waits_for_turn_running_elsewhere(conversation_id, monkeypatch):
+    # Tour 'running' d'un autre process (ou du worker) sur la même conversation
+    row, _ = api.db.register_pending_turn(conversation_id, "avant", None, "http://x", status="waiting")
+    assert api.db.start_pending_turn(int(row["id"]))
+    monkeypatch.setattr(api, "_TURN_WAIT_S", 0.3)
+    with pytest.raises(api.ApiError) as excinfo:
+        api._run_turn({"conversation_id": conversation_id, "message": "après"})
+    assert excinfo.value.status == 409
+
+
+def test_batch_reports_unexpected_error_per_item(conversation_id, monkeypatch):
+    def fake_run_turn(item):
+        if item["message"] == "boom":
+            raise RuntimeError("panne")
+        return {"conversation_id": item["conversation_id"], "reply": "ok"}
+
+    monkeypatch.setattr(api, "_run_turn", fake_run_turn)
+    results = api._run_batch([
+        {"conversation_id": conversation_id, "message": "boom"},
+        {"conversation_id": conversation_id, "message": "salut"},
+    ])
+    assert results[0]["status"] == 500
+    assert results[1]["reply"] == "ok"
+
+
+def test_failure_after_commit_keeps_turn_done_and_replays(conversation_id, monkeypatch):
+    server = start_stub_server(StubConfig(latency=parse_latency("fixed:0"), seed=1))
+    generated = []
+    real_generate = api.engine.generate_reply
+    monkeypatch.setattr(api.engine, "generate_reply", lambda *a, **k: generated.append(1) or real_generate(*a, **k))
+    real_result = api._turn_result
+    calls = []
+
+    def flaky_result(*args):
+        calls.append(1)
+        if len(calls) == 1:
+            raise api.db.sqlite3.OperationalError("database is locked")
+        return real_result(*args)
+
+    monkeypatch.setattr(api, "_turn_result", flaky_result)
+    item = {"conversation_id": conversation_id, "message": "salut", "idempotency_key": "k1", "api_url": server.url}
+    try:
+        with pytest.raises(api.db.sqlite3.OperationalError):
+            api._run_turn(item)
+        result = api._run_turn(item)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert result["replayed"] is True
+    assert len(generated) == 1
+    assert len(api.db.list_messages(conversation_id)) == 2
+
+
+def test_summary_runs_after_the_reply(conversation_id, monkeypatch):
+    release, done = threading.Event(), threading.Event()
+
+    def slow_summary(api_url, plan):
+        release.wait(5)
+        done.set()
+
+    monkeypatch.setattr(api.engine, "after_turn", slow_summary)
+    server = start_stub_server(StubConfig(latency=parse_latency("fixed:0"), seed=1))
+    try:
+        started = time.monotonic()
+        result = api._run_turn({"conversation_id": conversation_id, "message": "salut", "api_url": server.url})
+        assert time.monotonic() - started < 2
+        assert result["error"] is None and not done.is_set()
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+    assert done.wait(5)
@@ -0,0 +1,67 @@
+from app import db
+
+
+def test_search_messages_ranks_only_recent_candidates(fresh_db, monkeypatch):
+    bot_id = db.upsert_bot(None, "Test", {})
+    conversation_id = db.create_conversation(
+        subscriber_id=db.upsert_subscriber(None, "fan", "Fan"), bot_id=bot_id, mode="free", script_id=None
+    )
+    ids = [db.add_message(conversation_id, "user", f"plage numéro {i}") for i in range(10)]
+    monkeypatch.setattr(db, "SEARCH_CANDIDATES", 3)
+    hits = db.search_messages("plage", limit=20)
+    assert sorted(h["message_id"] for h in hits) == ids[-3:]
+    assert db.message_search_truncated("plage")
+    assert len(db.search_messages("plage", limit=20, recent_only=False)) == 10
+    # Dans une conversation: pas de borne
+    assert len(db.search_messages("plage", limit=20, conversation_id=conversation_id)) == 10
+    # Moins de candidats que la borne: tout est trouvé
+    monkeypatch.setattr(db, "SEARCH_CANDIDATES", 500)
+    assert len(db.search_messages("plage", limit=20)) == 10
+    assert not db.message_search_truncated("plage")
+
+
+def test_search_like_fallback_treats_wildcards_literally(fresh_db, monkeypatch):
+    bot_id = db.upsert_bot(None, "Test", {})
+    conversation_id = db.create_conversation(
+        subscriber_id=db.upsert_subscriber(None, "fan", "Fan"), bot_id=bot_id, mode="free", script_id=None
+    )
+    db.add_message(conversation_id, "user", "code abc")
+    literal = db.add_message(conversation_id, "user", "code a_c")
+    monkeypatch.setattr(db, "_has_fts", lambda conn, table: False)
+    assert [h["message_id"] for h in db.search_messages("a_c")] == [literal]
+    assert db.search_messages("100%") == []
+
+
+def _reinit():
+    # Nouveau process sur la même base
+    db._migrated_paths.discard(db._DB_PATH)
+    db.init_db()
+
+
+def test_fts_created_when_fts5_becomes_available(tmp_path, monkeypatch):
+    previous = db._DB_PATH
+    db.close_pools()
+    db._DB_PATH = str(tmp_path / "nofts.sqlite3")
+    try:
+        monkeypatch.setattr(db, "_fts5_available", lambda conn: False)
+        db.init_db()
+        bot_id = db.upsert_bot(None, "Test", {})
+        conversation_id = db.create_conversation(db.upsert_subscriber(None, "fan", "Fan"), bot_id, mode="free", script_id=None)
+        message_id = db.add_message(conversation_id, "user", "randonnée en montagne")
+        with db.get_read_conn() as conn:
+            assert not db._has_fts(conn, "messages_fts")
+        monkeypatch.undo()
+        _reinit()
+        with db.get_read_conn() as conn:
+            assert db._has_fts(conn, "messages_fts") and db._has_fts(conn, "script_steps_fts")
+        assert [h["message_id"] for h in db.search_messages("montagne")] == [message_id]
+    finally:
+        db.close_pools()
+        db._DB_PATH = previous
+
+
+def test_single_creator_restored_on_init(fresh_db):
+    with db.get_conn() as conn:
+        conn.execute("DELETE FROM bots")
+    _reinit()
+    assert [b["name"] for b in db.list_bots()] == ["Créatrice"]
@@ -0,0 +1,91 @@
+from app import db, engine, history, retrieval
+
+
+def _paywall_conversation():
+    bot_id = db.upsert_bot(None, "Test", {"name": "Test"})
+    script_id = db.upsert_script(None, "Script", "", bot_id)
+    db.add_step(script_id, "text", "Intro", "Dis bonjour.", None, None)
+    db.add_step(script_id, "paywall_text", "Message privé", "Propose le message privé.", None, "9.99")
+    subscriber_id = db.upsert_subscriber(None, "fan", "Fan")
+    conversation_id = db.create_conversation(subscriber_id, bot_id, mode="script", script_id=script_id)
+    db.lock_script(conversation_id)
+    db.update_conversation_state(conversation_id, current_step=2, paywall_unlocked=False)
+    return conversation_id
+
+
+def test_unlock_during_turn_is_not_overwritten(fresh_db):
+    conversation_id = _paywall_conversation()
+    plan = engine.start_turn(conversation_id, "salut", None)
+    assert plan.priority == "paywall" and plan.state["paywall_counter"] == 1
+
+    # "Payer" cliqué pendant la génération de la réponse
+    db.unlock_paywall(conversation_id)
+    engine.finish_turn(plan, "réponse")
+
+    conv = db.get_conversation(conversation_id)
+    assert int(conv["paywall_unlocked"]) == 1
+    assert int(conv["paywall_counter"]) == 0
+    assert int(conv["current_step"]) == 2
+    # Les messages du tour sont committés quand même
+    contents = [m["content"] for m in db.list_messages(conversation_id)]
+    assert "salut" in contents and any(c.startswith("réponse") for c in contents)
+
+
+def test_mode_switch_during_turn_keeps_operator_state(fresh_db):
+    conversation_id = _paywall_conversation()
+    db.unlock_paywall(conversation_id)
+    plan = engine.start_turn(conversation_id, "salut", None)
+
+    db.update_conversation_mode(conversation_id, "free", None)
+    engine.finish_turn(plan, "réponse")
+
+    conv = db.get_conversation(conversation_id)
+    assert conv["mode"] == "free"
+    assert int(conv["current_step"]) == 1
+
+
+def test_turn_without_concurrent_change_advances(fresh_db):
+    conversation_id = _paywall_conversation()
+    plan = engine.start_turn(conversation_id, "salut", None)
+    engine.finish_turn(plan, "réponse")
+
+    conv = db.get_conversation(conversation_id)
+    assert int(conv["paywall_counter"]) == 1
+
+
+def test_summary_failure_does_not_fail_committed_turn(fresh_db, monkeypatch):
+    from app.stub_server import StubConfig, parse_latency, start_stub_server
+
+    bot_id = db.upsert_bot(None, "Test", {"name": "Test"})
+    conversation_id = db.create_conversation(db.upsert_subscriber(None, "fan", "Fan"), bot_id, mode="free", script_id=None)
+
+    def broken_summary(*args, **kwargs):
+        raise RuntimeError("résumé en panne")
+
+    monkeypatch.setattr(engine, "after_turn", broken_summary)
+    server = start_stub_server(StubConfig(latency=parse_latency("fixed:0"), seed=1))
+    try:
+        reply = engine.process_turn(server.url, conversation_id, "salut", None)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert reply.startswith("[personality_chat]")
+    assert len(db.list_messages(conversation_id)) == 2
+
+
+def test_recall_budget_taken_only_when_something_is_recalled(fresh_db):
+    subscriber_id = db.upsert_subscriber(None, "fan", "Fan")
+    conversation_id = db.create_conversation(subscriber_id, db.upsert_bot(None, "Test", {}), mode="free", script_id=None)
+    db.add_message(conversation_id, "user", "mon chien s'appelle Biscotte")
+    for i in range(60):
+        db.add_message(conversation_id, "user" if i % 2 else "assistant", f"message numéro {i} sans rapport")
+    budgets = {"free": 200}
+
+    plan = engine.start_turn(conversation_id, "il fait beau", None, history_budgets=budgets)
+    assert plan.history[0]["role"] != "system"
+    assert plan.history_report["used_tokens"] > 200 - retrieval.RECALL_TOKENS
+
+    plan = engine.start_turn(conversation_id, "comment va Biscotte ?", None, history_budgets=budgets)
+    recalled = plan.history[0]
+    assert recalled["role"] == "system" and "Biscotte" in recalled["content"]
+    assert plan.history_report["used_tokens"] + history.message_tokens(recalled["content"]) <= 200
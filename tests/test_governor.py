@@ -0,0 +1,13 @@
+from app import governor
+
+
+def test_split_shares_limits_between_workers(monkeypatch):
+    monkeypatch.setattr(governor, "GOVERNOR", governor.GOVERNOR)
+    monkeypatch.setattr(governor, "MAX_CONCURRENCY", 16)
+    monkeypatch.setattr(governor, "RATE_PER_S", 6.0)
+    monkeypatch.setattr(governor, "RATE_BURST", 6.0)
+    budget = governor.split(3)
+    assert budget == {"workers": 3, "max_concurrency": 5, "rate_per_s": 2.0}
+    assert governor.stats()["max_concurrency"] == 5
+    # Jamais zéro (zéro = sans limite)
+    assert governor.split(32)["max_concurrency"] == 1
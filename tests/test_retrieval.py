@@ -0,0 +1,75 @@
+import math
+import random
+import time
+
+from app import db, history, retrieval, vectors
+
+
+def _brute_force(docs, query, k, before_id):
+    # BM25 de référence, mêmes paramètres que l'index
+    n = len(docs)
+    avg = sum(sum(c.values()) for c in docs.values()) / n
+    max_df = max(1, int(n * retrieval._MAX_DF_RATIO))
+    scores = {}
+    for bucket in query:
+        df = sum(1 for c in docs.values() if bucket in c)
+        if not df or (df > max_df and n > 20):
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for message_id, counts in docs.items():
+            tf = counts.get(bucket)
+            if tf and message_id < before_id:
+                norm = retrieval._K1 * (1 - retrieval._B + retrieval._B * sum(counts.values()) / avg)
+                scores[message_id] = scores.get(message_id, 0.0) + idf * tf * (retrieval._K1 + 1) / (tf + norm)
+    return [m for m, _ in sorted(scores.items(), key=lambda kv: (-kv[1], -kv[0]))[:k]]
+
+
+def test_search_matches_bm25_when_postings_are_short():
+    rng = random.Random(3)
+    words = [f"mot{i}" for i in range(400)]
+    docs = {i: vectors.term_counts(" ".join(rng.choice(words) for _ in range(rng.randint(3, 12)))) for i in range(1, 501)}
+    index = retrieval.ConversationIndex()
+    for message_id, counts in docs.items():
+        index.add(message_id, counts)
+    for _ in range(50):
+        query = vectors.term_counts(" ".join(rng.choice(words) for _ in range(5)))
+        got = [m for _, m in index.search(query, 3, before_id=450)]
+        assert got == _brute_force(docs, query, 3, 450)
+
+
+def test_rare_old_term_found_in_long_conversation():
+    index = retrieval.ConversationIndex()
+    index.add(1, vectors.term_counts("mon chien s'appelle Biscotte et adore la plage"))
+    for message_id in range(2, 5001):
+        index.add(message_id, vectors.term_counts(f"plage soleil journée message{message_id % 50}"))
+    hits = index.search(vectors.term_counts("comment va Biscotte à la plage ?"), 3, before_id=4900)
+    assert hits[0][1] == 1
+
+
+def test_index_kept_warm_by_writes(fresh_db):
+    subscriber_id = db.upsert_subscriber(None, "fan", "Fan")
+    conversation_id = db.create_conversation(subscriber_id, db.upsert_bot(None, "Test", {}), mode="free", script_id=None)
+    message_id = db.add_message(conversation_id, "user", "j'adore les randonnées en montagne")
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        index = retrieval._indexes.get(conversation_id)
+        if index is not None and index.last_message_id == message_id:
+            break
+        time.sleep(0.01)
+    assert retrieval._indexes[conversation_id].last_message_id == message_id
+
+
+def test_vector_blob_is_little_endian():
+    blob = vectors.pack({1: 2, 0x010203: 1})
+    assert blob == bytes([1, 0, 0, 0, 2, 0, 0, 0, 3, 2, 1, 0, 1, 0, 0, 0])
+    assert vectors.unpack(blob) == {1: 2, 0x010203: 1}
+
+
+def test_recall_message_fits_its_budget():
+    rows = [{"role": "user" if i % 2 else "assistant", "content": "souvenir " * 200} for i in range(3)]
+    for max_tokens in (30, 60, 200):
+        message = retrieval.recall_message(rows, max_tokens=max_tokens)
+        assert message is None or history.estimate_tokens(message["content"]) <= max_tokens
+    assert retrieval.recall_message(rows, max_tokens=5) is None
+    # Budget serré: moins de souvenirs plutôt que des bouts illisibles
+    assert retrieval.recall_message(rows, max_tokens=30)["content"].count(": souvenir") == 1
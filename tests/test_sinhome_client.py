@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+from app import sinhome_client
+from app.sinhome_client import SinhomeClient
+from app.stub_server import StubConfig, start_stub_server
+
+
+@pytest.mark.parametrize("stream", ["sse", "ndjson", "text"])
+def test_stream_decodes_utf8_without_charset(stream):
+    # Le stub n'annonce pas de charset en SSE / NDJSON: le client doit quand même lire de l'UTF-8
+    server = start_stub_server(StubConfig(stream=stream, token_interval_s=0, reply_words=8, seed=1))
+    client = SinhomeClient()
+    try:
+        text = "".join(client.script_chat_stream(server.url, "s1", "salut", [], {}, "journée très réussie"))
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    assert text.startswith("[script_chat] journée")
+    assert "Ã" not in text
+
+
+def _health_threads():
+    return [t for t in threading.enumerate() if t.name == "sinhome-health"]
+
+
+def test_pools_share_one_health_thread_and_are_closed():
+    clients = [SinhomeClient() for _ in range(3)]
+    try:
+        pools = [
+            c.pool([f"http://127.0.0.1:9/{i}", f"http://127.0.0.1:9/{i}b"]) for c in clients for i in range(sinhome_client._MAX_POOLS + 2)
+        ]
+        assert len(_health_threads()) == 1
+        # Pools inactives au-delà de la limite: fermées et retirées du health check
+        assert all(len(c._pools) == sinhome_client._MAX_POOLS for c in clients)
+        assert len(sinhome_client._health_checker.pools) == 3 * sinhome_client._MAX_POOLS
+    finally:
+        for c in clients:
+            c.close()
+    del pools
+    assert len(sinhome_client._health_checker.pools) == 0
+
+
+def test_get_client_rebuild_closes_previous_pools(monkeypatch):
+    old = sinhome_client.get_client()
+    pool = old.pool(["http://127.0.0.1:9/a", "http://127.0.0.1:9/b"])
+    # Comme après un fork: autre pid -> nouveau client
+    monkeypatch.setattr(sinhome_client, "_client_pid", -1)
+    assert sinhome_client.get_client() is not old
+    assert pool not in sinhome_client._health_checker.pools
+    assert not old._pools
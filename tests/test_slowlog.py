@@ -0,0 +1,31 @@
+import sqlite3
+
+from app import slowlog
+
+
+def test_lock_wait_is_logged_with_wall_clock_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(slowlog, "SLOW_QUERY_MS", 100.0)
+    monkeypatch.setattr(slowlog, "SLOW_QUERY_FILE", str(tmp_path / "slow.jsonl"))
+    path = str(tmp_path / "lock.sqlite3")
+    holder = sqlite3.connect(path, isolation_level=None)
+    holder.execute("PRAGMA journal_mode = WAL")
+    holder.execute("CREATE TABLE t (x)")
+    holder.execute("BEGIN IMMEDIATE")
+    waiter = sqlite3.connect(path, isolation_level=None, timeout=0.3)
+    slowlog.attach(waiter)
+    recorded = len(slowlog.LOG.recent)
+    try:
+        try:
+            waiter.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            pass
+        # Fin de la requête: retour au pool
+        slowlog.finish(waiter)
+    finally:
+        slowlog.detach(waiter)
+        waiter.close()
+        holder.close()
+    entries = list(slowlog.LOG.recent)[recorded:]
+    assert [e["sql"] for e in entries] == ["BEGIN IMMEDIATE"]
+    # Presque aucune instruction VM, mais ~300 ms d'attente du verrou
+    assert entries[0]["duration_ms"] >= 250
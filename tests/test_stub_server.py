@@ -0,0 +1,33 @@
+import threading
+
+import requests
+
+from app.stub_server import StubConfig, start_stub_server
+
+
+def _replies(seed):
+    server = start_stub_server(StubConfig(seed=seed, reply_words=8))
+    try:
+        payloads = [
+            {"message": f"message {i}", "history": [], "persona_data": {}} for i in range(8)
+        ]
+        replies = {}
+
+        def post(i):
+            replies[i] = requests.post(f"{server.url}/personality_chat", json=payloads[i], timeout=5).json()["response"]
+
+        # Ordre d'arrivée et threads du serveur différents d'un run à l'autre
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(len(payloads))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return [replies[i] for i in range(len(payloads))]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_seeded_stub_is_reproducible_under_concurrency():
+    assert _replies(42) == _replies(42)
+    assert _replies(42) != _replies(43)
@@ -0,0 +1,35 @@
+import random
+
+from app import summaries
+
+_CHATTER = (
+    "coucou mon coeur tu me manques trop aujourd'hui j'ai pensé à toi toute la journée "
+    "raconte moi ce que tu fais ce soir j'ai une petite surprise pour toi"
+).split()
+
+
+def _rows(rng, n, first=None):
+    rows = []
+    for i in range(n):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = " ".join(rng.choice(_CHATTER) for _ in range(rng.randint(6, 14))) + "."
+        rows.append({"role": role, "content": content})
+    if first:
+        rows[0] = {"role": "user", "content": first}
+    return rows
+
+
+def test_early_fact_survives_several_folds():
+    rng = random.Random(7)
+    summary = summaries._local_fold("", _rows(rng, 40, first="Je m'appelle Julien, j'ai 34 ans et je vis à Lyon."))
+    for _ in range(6):
+        summary = summaries._local_fold(summary, _rows(rng, summaries.FOLD_BATCH_SIZE))
+        assert len(summary) <= summaries.MAX_SUMMARY_TOKENS * 4
+    assert "Julien" in summary
+
+
+def test_recent_messages_still_enter_the_summary():
+    rng = random.Random(11)
+    summary = summaries._local_fold("", _rows(rng, summaries.FOLD_BATCH_SIZE))
+    summary = summaries._local_fold(summary, [{"role": "user", "content": "Demain je pars en vacances en Bretagne."}])
+    assert "Bretagne" in summary
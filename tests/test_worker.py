@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from app import db, engine, worker
+from app.stub_server import StubConfig, parse_latency, start_stub_server
+
+
+@pytest.fixture
+def conversation_id(fresh_db):
+    bot_id = db.upsert_bot(None, "Test", {})
+    return db.create_conversation(db.upsert_subscriber(None, "fan", "Fan"), bot_id, mode="free", script_id=None)
+
+
+def test_programming_error_is_not_committed_as_api_error(conversation_id, monkeypatch):
+    def broken_stream(api_url, plan):
+        raise TypeError("bug")
+        yield ""
+
+    monkeypatch.setattr(engine, "stream_reply", broken_stream)
+    pending_turn_id = db.enqueue_pending_turn(conversation_id, "salut", None, "http://127.0.0.1:9")
+    tw = worker.TurnWorker(max_workers=1)
+    tw._slots.acquire()
+    tw._run_turn(db.get_pending_turn(pending_turn_id))
+    row = db.get_pending_turn(pending_turn_id)
+    assert row["status"] == "error" and "bug" in row["error"]
+    assert db.list_messages(conversation_id) == []
+
+
+def test_orphaned_running_turn_is_requeued_while_worker_runs(conversation_id, monkeypatch):
+    monkeypatch.setattr(worker, "_REQUEUE_INTERVAL_S", 0.05)
+    server = start_stub_server(StubConfig(latency=parse_latency("fixed:0"), seed=1))
+    tw = worker.TurnWorker(max_workers=1, poll_interval_s=0.05)
+    tw.start()
+    try:
+        # Tour laissé 'running' par un process voisin tué, après le démarrage du worker
+        pending_turn_id = db.enqueue_pending_turn(conversation_id, "salut", None, server.url)
+        with db.get_conn() as conn:
+            conn.execute(
+                "UPDATE pending_turns SET status = 'running', started_at = '2000-01-01T00:00:00+00:00' WHERE id = ?",
+                (pending_turn_id,),
+            )
+        deadline = time.monotonic() + 5
+        while db.get_pending_turn(pending_turn_id)["status"] != "done" and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        tw.stop(2)
+        server.shutdown()
+        server.server_close()
+    assert db.get_pending_turn(pending_turn_id)["status"] == "done"